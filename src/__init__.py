@@ -1,4 +1,15 @@
-from src.olfactometer_arduino import Olfactometers
+# voyeur is the top level package, so that it is initialized before src.voyeur
+from __future__ import absolute_import
+from voyeur.qtcompat import HEADLESS
+if not HEADLESS:
+    # Qt widgets and Chaco overlays
+    from src.olfactometer_arduino import Olfactometers
+    from src.range_selections_overlay import RangeSelectionsOverlay
 from src.stimulus import LaserTrainStimulus
-from src.range_selections_overlay import RangeSelectionsOverlay
+from src.stream_buffers import SignalRingBuffer, EventChannelRasterizer, MinMaxDecimator, decimate_minmax,\
+    IntervalMask
+from src.render_scheduler import RenderScheduler
+from src.performance import GrowableArray, SlidingWindowRate, PerformanceTracker
+from src.stimulus_blocks import generate_block
+from src.session_schedule import SessionSchedule
 from src.voyeur_utilities import parse_rig_config, find_odor_vial
\ No newline at end of file
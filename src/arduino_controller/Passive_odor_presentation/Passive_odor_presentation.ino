@@ -138,6 +138,12 @@ int state = 0;
 // The command code sent from the master (python).
 int code = 0;
 
+// Push mode streaming (codes 92/93): send a stream packet every STREAM_PUSH_INTERVAL ms
+// without waiting for a request from python.
+#define STREAM_PUSH_INTERVAL 10
+boolean push_streaming = false;
+unsigned long last_push_time = 0;
+
 // Indices to keep track when transmitting the sniffing data in the sniff buffer
 int last_sent_sniff_data_index = -1, current_sniff_data_index = 0;
 
@@ -473,6 +479,11 @@ void loop() {
   //==========================================================================
 
 
+  if (push_streaming && (totalms - last_push_time) >= STREAM_PUSH_INTERVAL) {
+    last_push_time = totalms;
+    RunSerialCom(87);
+  }
+
   if (Serial.available() > 0) {
 
     code = Serial.read();
@@ -494,7 +505,7 @@ void loop() {
         state = 0;
         Serial.print(3);
         Serial.print(",");
-        Serial.print("*");
+        Serial.println("*");
         break;
 
       case 90: // Start trial state (i.e. need to read from the serial port)
@@ -509,6 +520,21 @@ void loop() {
         RunSerialCom(code);
         break;
 
+      case 92: // Start pushing stream packets continuously
+        push_streaming = true;
+        last_push_time = totalms;
+        Serial.print(2);
+        Serial.print(",");
+        Serial.println("*");
+        break;
+
+      case 93: // Stop pushing stream packets
+        push_streaming = false;
+        Serial.print(2);
+        Serial.print(",");
+        Serial.println("*");
+        break;
+
     }
   }
 }
@@ -12,35 +12,38 @@ platform. This includes the protocol behaviour as well as visualization (GUI).
 
 #  Python library imports
 import os, time
-from numpy import append, arange, hstack, nan, isnan, negative
-from random import choice, randint, shuffle, seed, random
-from itertools import chain, groupby
+from numpy import clip, nan, negative
+from random import choice, randint, Random
 
 # Voyeur imports
 import voyeur.db as db
 from voyeur import Monitor, Protocol, TrialParameters, time_stamp
+from voyeur.qtcompat import HEADLESS, QTimer
 
-# Olfactometer module
-from src import Olfactometers, LaserTrainStimulus,\
-    RangeSelectionsOverlay, parse_rig_config, find_odor_vial
+from src import LaserTrainStimulus,\
+    EventChannelRasterizer, MinMaxDecimator, decimate_minmax,\
+    IntervalMask, RenderScheduler, PerformanceTracker, GrowableArray, generate_block,\
+    SessionSchedule, parse_rig_config, find_odor_vial
 
-# Enthought's traits imports (For GUI) - Place these imports under
-# voyeur imports since voyeur will select the GUI toolkit to be QT
-# By default traits will pick wx as the GUI toolkit. By importing voyeur
-# first, QT is set and used subsequently for all gui related things
-from chaco.api import ArrayPlotData, Plot, VPlotContainer, DataRange1D
-from chaco.axis import PlotAxis
-from chaco.scales.api import TimeScale
-from chaco.scales_tick_generator import ScalesTickGenerator
-from enable.component import Component
-from enable.component_editor import ComponentEditor
-from pyface.timer.api import Timer
-from pyface.api import FileDialog, OK
 from traits.api import Int, Str, Array, Float, Enum, Bool, Range,Instance, Trait
 from traits.has_traits import on_trait_change
 from traits.trait_types import Button
-from traitsui.api import View, Group, HGroup, VGroup, Item, spring
-from traitsui.editors import ButtonEditor
+
+# Olfactometer module and Enthought's GUI imports - Place these imports under
+# voyeur imports since voyeur will select the GUI toolkit to be QT
+# By default traits will pick wx as the GUI toolkit. By importing voyeur
+# first, QT is set and used subsequently for all gui related things.
+# Headless, no GUI toolkit is imported (see voyeur.qtcompat).
+if not HEADLESS:
+    from src import Olfactometers, RangeSelectionsOverlay
+    from chaco.api import ArrayPlotData, Plot, VPlotContainer, DataRange1D
+    from chaco.axis import PlotAxis
+    from chaco.scales.api import TimeScale
+    from chaco.scales_tick_generator import ScalesTickGenerator
+    from enable.component_editor import ComponentEditor
+    from pyface.api import FileDialog, OK
+    from traitsui.api import View, Group, HGroup, VGroup, Item, spring
+    from traitsui.editors import ButtonEditor
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -53,9 +56,40 @@ class Passive_odor_presentation(Protocol):
 
     # Streaming plot window size in milliseconds.
     STREAM_SIZE = 5000
+
+    # Streaming plots redraws per second. Packets received in between are drawn together.
+    PLOT_REFRESH_RATE = 30
+
+    # Number of min/max columns the streaming plots are drawn with, about the
+    # plot width in pixels. Drawing cost depends on this, not on STREAM_SIZE.
+    DISPLAY_COLUMNS = 1000
+
+    # Binary event channels of the stream (lick ports, trigger lines) as
+    # (name, value plotted while on, value plotted while off).
+    EVENT_CHANNELS = (('lick1', 1, nan),
+                      ('lick2', 1, nan),
+                      ('mri', -20, 10))
     
     # Number of trials in a block.
     BLOCK_SIZE = 20
+    # Number of trials of each stimulus category in a block, e.g.
+    # {"Left": 12, "Right": 8}. None repeats the whole stimulus set to fill
+    # BLOCK_SIZE trials.
+    BLOCK_QUOTAS = None
+    # Largest number of trials of the same category in a row within a block.
+    MAX_BLOCK_RUN = 3
+    # Seed of the stimulus block order. None picks one, stored in the session
+    # metadata.
+    BLOCK_SEED = None
+
+    # Plan the stimuli, free water and inter trial intervals of the whole
+    # session ahead of time from SCHEDULE_SEED instead of at the end of each
+    # trial. The plan is stored in the database (see SessionSchedule).
+    PRECOMPUTED_SCHEDULE = False
+    # Seed of the session plan. None picks one, stored in the session metadata.
+    SCHEDULE_SEED = None
+    # Number of trials planned at the start of the session.
+    SCHEDULE_TRIALS = 1000
 
     # Flag to indicate whether we have an arduino_controller, Olfactometer, Scanner connected. Set to 0 for
     # debugging.
@@ -80,6 +114,13 @@ class Passive_odor_presentation(Protocol):
     # Number of trials in one sliding window used for continuous
     # visualizing of session performance.
     SLIDING_WINDOW = 400
+    # Trial type and whether the trial was correct for each response code.
+    RESPONSE_OUTCOMES = {1: ("Go", True),
+                         2: ("NoGo", True),
+                         3: ("Go", False),
+                         4: ("NoGo", False),
+                         5: ("Go", False),
+                         6: ("NoGo", False)}
 
     # Amount of time in milliseconds for odorant vial to be ON prior to
     # trial start. This should be sufficiently large so that odorant makes it to
@@ -243,47 +284,43 @@ class Passive_odor_presentation(Protocol):
     # next_stimulus = Instance(LaserTrainStimulus)
     # Current block of stimuli. Used when stimuli is arranged in blocks.
     stimulus_block = []
+    # Random number generator of the stimulus block order, seeded from
+    # BLOCK_SEED in __init__.
+    _block_random = Instance(Random)
+    # Precomputed session plan, if PRECOMPUTED_SCHEDULE.
+    _schedule = Instance(SessionSchedule)
     
     # Olfactometer object that has the interface and representation of the
     # odor delivery hardware.
-    olfactometer = Instance(Olfactometers)
+    olfactometer = Instance('src.olfactometer_arduino.Olfactometers')
     
-    # Arrays for the responses plot.
-    trial_number_tick = Array
     # All response codes (results of each trial) for the session.
-    responses = Array
-    # Internal arrays for the plotting of results for each trial type.
-    _go_trials_line = Array
-    _nogo_trials_line = Array
+    responses = Instance(GrowableArray, (int,))
+    # Totals and sliding window performance of each trial type, plotted in the
+    # responses plot.
+    _performance = Instance(PerformanceTracker)
 
     # Arrays for the streaming data plots.
     iteration = Array
+    # sniff is the min/max envelope kept by _sniff_display.
     sniff = Array
+    _sniff_display = Instance(MinMaxDecimator)
     lick1 = Array
     lick2 = Array
     odor = Array
     mri = Array
+    # lick1, lick2 and mri are envelopes of the _event_channels buffer.
+    _event_channels = Instance(EventChannelRasterizer)
+    # Applies the streaming plot updates at PLOT_REFRESH_RATE.
+    _render_scheduler = Instance(RenderScheduler)
 
     # Internal indices uses for the streaming plots.
     _last_stream_index = Float(0)
-    _last_lick_index = 0
-    _last_mri_index = 0
-    _previous_last_stream_index = 0
-    
-    # Running total of each trial result type.
-    # Displayed on the console after each trial.
-    _total_go_hits = 0
-    _total_go_misses = 0
-    _total_nogo_hits = 0
-    _total_nogo_misses = 0
-    
-    # Used for sliding window performance calculations.
-    _sliding_window_go_hits = 0
-    _sliding_window_nogo_hits = 0
-    # values of Go trials for the current sliding window period.
-    _sliding_window_go_array = []
-    # Values of NoGo trials for the current sliding window period.
-    _sliding_window_nogo_array = []
+    _previous_columns_started = 0
+    # Trial windows shown by the trial mask overlay, in stream sample times.
+    _trial_mask = Instance(IntervalMask, ())
+    # Data source whose 'trials_mask' metadata the overlay draws.
+    _trial_mask_datasource = Instance(object)
     
     # Time stamp of when voyeur requested the parameters to send to arduino_controller.
     _parameters_sent_time = float()
@@ -296,19 +333,22 @@ class Passive_odor_presentation(Protocol):
     # This is the voyeur backend monitor. It handles data acquisition, storage,
     # and trial to trial communications with the controller (arduino_controller).
     monitor = Instance(Monitor)
+    # Headless, no plots are built and the streams are only stored (see voyeur.qtcompat).
+    headless = Bool(HEADLESS)
     # used as an alias for trial_number. Included because the monitor wants to
     # access the trialNumber member not trial_number. monitor will be updated
     # in the future to be more pythonesque.
     trialNumber = Int()
     
     # GUI elements.
-    event_plot = Instance(Plot, label="Success Rate")
-    stream_plots = Instance(Component)   # Container for the streaming plots.
+    # Classes given by name, imported only when a plot is assigned.
+    event_plot = Instance('chaco.api.Plot', label="Success Rate")
+    stream_plots = Instance('enable.component.Component')   # Container for the streaming plots.
     # This plot contains the continuous signals (sniff, and laser currently).
-    stream_plot = Instance(Plot, label="Sniff")
+    stream_plot = Instance('chaco.api.Plot', label="Sniff")
     # This is the plot that has the event signals (licks, mri etc.)
-    stream_lick_plot = Instance(Plot, label="Licks")
-    stream_mri_plot = Instance(Plot, label="MRI")
+    stream_lick_plot = Instance('chaco.api.Plot', label="Licks")
+    stream_mri_plot = Instance('chaco.api.Plot', label="MRI")
 
     start_button = Button()
     start_label = Str('Start')
@@ -358,209 +398,211 @@ class Passive_odor_presentation(Protocol):
     #--------------------------------------------------------------------------
     # GUI layout
     #--------------------------------------------------------------------------
-    control = VGroup(
-                     HGroup(
-                            Item('start_button',
-                                 editor=ButtonEditor(label_value='start_label'),
-                                 show_label=False),
-                            Item('mockmri_button',
-                                 editor=ButtonEditor(label_value='mockmri_label'),
-                                 show_label=False),
-                            Item('pause_button',
-                                 editor=ButtonEditor(label_value='pause_label'),
-                                 show_label=False,
-                                 enabled_when='monitor.running'),
-                            Item('save_as_button',
-                                 show_label=False,
-                                 enabled_when='not monitor.running'),
-                            Item('olfactometer_button',
-                                 editor=ButtonEditor(label_value='olfactometer_label'),
-                                 show_label=False),
-                            label='Application Control',
-                            show_border=True
-                            ),
-                     VGroup(
-                             HGroup(
-                                    Item('auto_final_valve',
-                                         editor=ButtonEditor(
-                                                             style="button",
-                                                             label_value='auto_final'
-                                                                        '_valve_label'),
-                                         show_label=False,
-                                         enabled_when='not monitor.running'),
-                                    Item('auto_final_valve_on_duration'),
-                                    Item('auto_final_valve_off_duration',
-                                         visible_when='auto_final_valve_mode != \
-                                                       "Single"'),
-                                    show_border=False
-                                    ),
-                             HGroup(
-                                    Item('auto_final_valve_mode'),
-                                    spring,
-                                    Item('auto_final_valve_repetitions',
-                                         visible_when='auto_final_valve_mode == \
-                                                         "Repeated"',
-                                         show_label=False,
-                                         width=-70),
-                                    Item("auto_final_valve_repetitions_label",
-                                         visible_when='auto_final_valve_mode == \
-                                                 "Repeated"',
-                                         show_label=False,
-                                         style='readonly'),
-                                    spring,
-                                    Item('auto_final_valve_repetitions_off_time',
-                                         visible_when='auto_final_valve_mode == \
-                                                                "Repeated"',
-                                         width=-70),
-                                    label='',
-                                    show_border=False,
-                                    ),
-                             label = '',
-                             show_border = True,
-                             )
-                     )
+    # Headless, there is no view.
+    if not HEADLESS:
+        control = VGroup(
+                         HGroup(
+                                Item('start_button',
+                                     editor=ButtonEditor(label_value='start_label'),
+                                     show_label=False),
+                                Item('mockmri_button',
+                                     editor=ButtonEditor(label_value='mockmri_label'),
+                                     show_label=False),
+                                Item('pause_button',
+                                     editor=ButtonEditor(label_value='pause_label'),
+                                     show_label=False,
+                                     enabled_when='monitor.running'),
+                                Item('save_as_button',
+                                     show_label=False,
+                                     enabled_when='not monitor.running'),
+                                Item('olfactometer_button',
+                                     editor=ButtonEditor(label_value='olfactometer_label'),
+                                     show_label=False),
+                                label='Application Control',
+                                show_border=True
+                                ),
+                         VGroup(
+                                 HGroup(
+                                        Item('auto_final_valve',
+                                             editor=ButtonEditor(
+                                                                 style="button",
+                                                                 label_value='auto_final'
+                                                                            '_valve_label'),
+                                             show_label=False,
+                                             enabled_when='not monitor.running'),
+                                        Item('auto_final_valve_on_duration'),
+                                        Item('auto_final_valve_off_duration',
+                                             visible_when='auto_final_valve_mode != \
+                                                           "Single"'),
+                                        show_border=False
+                                        ),
+                                 HGroup(
+                                        Item('auto_final_valve_mode'),
+                                        spring,
+                                        Item('auto_final_valve_repetitions',
+                                             visible_when='auto_final_valve_mode == \
+                                                             "Repeated"',
+                                             show_label=False,
+                                             width=-70),
+                                        Item("auto_final_valve_repetitions_label",
+                                             visible_when='auto_final_valve_mode == \
+                                                     "Repeated"',
+                                             show_label=False,
+                                             style='readonly'),
+                                        spring,
+                                        Item('auto_final_valve_repetitions_off_time',
+                                             visible_when='auto_final_valve_mode == \
+                                                                    "Repeated"',
+                                             width=-70),
+                                        label='',
+                                        show_border=False,
+                                        ),
+                                 label = '',
+                                 show_border = True,
+                                 )
+                         )
     
-    arduino_group = VGroup(
-                           HGroup(
-                                  Item('final_valve_button',
-                                            editor=ButtonEditor(
-                                            style="button",
-                                            label_value='final_valve_label'),
-                                            show_label=False),
-                                  VGroup(
-                                       Item('go_water_button',
-                                            editor=ButtonEditor(
-                                            style="button",
-                                            label_value='go_water_label'),
-                                            show_label=False),
-                                       Item('go_water_calibrate_button',
-                                            editor=ButtonEditor(
-                                            style="button",
-                                            label_value='go_water_calibrate_label'),
-                                            show_label=False),
-                                       Item('water_duration1'),
-                                       ),
-                                  VGroup(
-                                       Item('nogo_water_button',
-                                            editor=ButtonEditor(
-                                            style="button",
-                                            label_value='nogo_water_label'),
-                                            show_label=False),
-                                       Item('nogo_water_calibrate_button',
-                                            editor=ButtonEditor(
-                                            style="button",
-                                            label_value='nogo_water_calibrate_label'),
-                                            show_label=False),
-                                       Item('water_duration2'),
-                                       ),
-                                  ),
-                           label="arduino_controller Control",
-                           show_border=True
-                           )
+        arduino_group = VGroup(
+                               HGroup(
+                                      Item('final_valve_button',
+                                                editor=ButtonEditor(
+                                                style="button",
+                                                label_value='final_valve_label'),
+                                                show_label=False),
+                                      VGroup(
+                                           Item('go_water_button',
+                                                editor=ButtonEditor(
+                                                style="button",
+                                                label_value='go_water_label'),
+                                                show_label=False),
+                                           Item('go_water_calibrate_button',
+                                                editor=ButtonEditor(
+                                                style="button",
+                                                label_value='go_water_calibrate_label'),
+                                                show_label=False),
+                                           Item('water_duration1'),
+                                           ),
+                                      VGroup(
+                                           Item('nogo_water_button',
+                                                editor=ButtonEditor(
+                                                style="button",
+                                                label_value='nogo_water_label'),
+                                                show_label=False),
+                                           Item('nogo_water_calibrate_button',
+                                                editor=ButtonEditor(
+                                                style="button",
+                                                label_value='nogo_water_calibrate_label'),
+                                                show_label=False),
+                                           Item('water_duration2'),
+                                           ),
+                                      ),
+                               label="arduino_controller Control",
+                               show_border=True
+                               )
     
-    session_group = Group(
-                          HGroup(
-                                 Item('stamp', style='readonly',
-                                      width=-195),
-                                 Item('protocol_name', style='readonly'),
-                                ),
-                          HGroup(
-                                 Item('rig', style='readonly', width=-217),
-                                 Item('sniff_phase', style='readonly')
-                                ),
-                          HGroup(
-                                 Item('mouse',
-                                      enabled_when='not monitor.running',
-                                      width=-196),
-                                 Item('session',
-                                      enabled_when='not monitor.running'),
-                                 ),
-                          label='Session',
-                          show_border=True
-                          )
-
-    result_group = Group(HGroup(
-                                 Item('rewards', style='readonly', width=-67),
-                                 Item('rewards_go', style='readonly', width=-66),
-                                 Item('rewards_nogo', style='readonly'),
-                                 ),
-                          HGroup(
-                                 Item('percent_correct', style='readonly',width=-60),
-                                 Item('percent_go_correct', style='readonly',width=-60),
-                                 Item('percent_nogo_correct', style='readonly'),
-                                 ),
-                          label='Result',
-                          show_border=True
-                          )
+        session_group = Group(
+                              HGroup(
+                                     Item('stamp', style='readonly',
+                                          width=-195),
+                                     Item('protocol_name', style='readonly'),
+                                    ),
+                              HGroup(
+                                     Item('rig', style='readonly', width=-217),
+                                     Item('sniff_phase', style='readonly')
+                                    ),
+                              HGroup(
+                                     Item('mouse',
+                                          enabled_when='not monitor.running',
+                                          width=-196),
+                                     Item('session',
+                                          enabled_when='not monitor.running'),
+                                     ),
+                              label='Session',
+                              show_border=True
+                              )
+
+        result_group = Group(HGroup(
+                                     Item('rewards', style='readonly', width=-67),
+                                     Item('rewards_go', style='readonly', width=-66),
+                                     Item('rewards_nogo', style='readonly'),
+                                     ),
+                              HGroup(
+                                     Item('percent_correct', style='readonly',width=-60),
+                                     Item('percent_go_correct', style='readonly',width=-60),
+                                     Item('percent_nogo_correct', style='readonly'),
+                                     ),
+                              label='Result',
+                              show_border=True
+                              )
 
     
-    current_trial_group = Group(
-                                HGroup(
-                                       Item('trial_number', style='readonly', width=-100),
-                                       Item('trial_type', style='readonly'),
-                                       ),
-                                HGroup(
-                                       Item('odorant', style='readonly', width=-157),
-                                       Item('odorvalve', style='readonly'),
-                                       ),
-                                HGroup(
-                                        Item('inter_trial_interval', style='readonly',  width=-171),
-                                        Item('free_water')
-                                ),
-                                label='Current Trial',
-                                show_border=True
-                                )
-
-    next_trial_group = Group(
-                             HGroup(
-                                    Item('next_trial_number', style='readonly', width=-100),
-                                    Item('next_trial_type', style='readonly'),
-                                    ),
-                             HGroup(
-                                    Item('next_odorant', style="readonly", width=-157),
-                                    Item('next_odorvalve', style='readonly'),
+        current_trial_group = Group(
+                                    HGroup(
+                                           Item('trial_number', style='readonly', width=-100),
+                                           Item('trial_type', style='readonly'),
+                                           ),
+                                    HGroup(
+                                           Item('odorant', style='readonly', width=-157),
+                                           Item('odorvalve', style='readonly'),
+                                           ),
+                                    HGroup(
+                                            Item('inter_trial_interval', style='readonly',  width=-171),
+                                            Item('free_water')
                                     ),
-                             label='Next Trial',
-                             show_border=True
-                             )
-
-    event = Group(
-                  Item('event_plot',
-                       editor=ComponentEditor(),
-                       show_label=False,
-                       height=125),
-                       label='Performance',
-                       show_border=False,
-                  )
-
-    stream = Group(
-                   Item('stream_plots',
-                        editor=ComponentEditor(),
-                        show_label=False,
-                        height=250),
-                        label='Streaming',
-                        show_border=False,
-                   )
-
-    # Arrangement of all the component groups.
-    main = View(
-                VGroup(
-                       HGroup(control, arduino_group),
-                       HGroup(session_group,
-                              result_group,
-                              current_trial_group,
-                              next_trial_group),
-                       stream,
-                       event,
-                       show_labels=True,
-                       ),
-                title= "Passive Odor Presentation",
-                width=1300,
-                height=768,
-                x=30,
-                y=70,
-                resizable=True,
-                )
+                                    label='Current Trial',
+                                    show_border=True
+                                    )
+
+        next_trial_group = Group(
+                                 HGroup(
+                                        Item('next_trial_number', style='readonly', width=-100),
+                                        Item('next_trial_type', style='readonly'),
+                                        ),
+                                 HGroup(
+                                        Item('next_odorant', style="readonly", width=-157),
+                                        Item('next_odorvalve', style='readonly'),
+                                        ),
+                                 label='Next Trial',
+                                 show_border=True
+                                 )
+
+        event = Group(
+                      Item('event_plot',
+                           editor=ComponentEditor(),
+                           show_label=False,
+                           height=125),
+                           label='Performance',
+                           show_border=False,
+                      )
+
+        stream = Group(
+                       Item('stream_plots',
+                            editor=ComponentEditor(),
+                            show_label=False,
+                            height=250),
+                            label='Streaming',
+                            show_border=False,
+                       )
+
+        # Arrangement of all the component groups.
+        main = View(
+                    VGroup(
+                           HGroup(control, arduino_group),
+                           HGroup(session_group,
+                                  result_group,
+                                  current_trial_group,
+                                  next_trial_group),
+                           stream,
+                           event,
+                           show_labels=True,
+                           ),
+                    title= "Passive Odor Presentation",
+                    width=1300,
+                    height=768,
+                    x=30,
+                    y=70,
+                    resizable=True,
+                    )
     
     def _stream_plots_default(self):
         """ Build and return the container for the streaming plots."""
@@ -580,13 +622,15 @@ class Passive_odor_presentation(Protocol):
 
         # Initialize the data arrays and re-assign the values to the
         # ArrayPlotData collection.
-        # X-axis values/ticks. Initialize them. They are static.
-        range_in_sec = self.STREAM_SIZE / 1000.0
-        self.iteration = arange(0.001, range_in_sec + 0.001, 0.001)
-        # Sniff data array initialization to nans.
+        # X-axis values/ticks, one (or a min and a max) per display column.
+        # Initialize them. They are static.
+        samples_per_column = max(1, self.STREAM_SIZE // self.DISPLAY_COLUMNS)
+        self._sniff_display = MinMaxDecimator(self.STREAM_SIZE // samples_per_column, samples_per_column)
+        self.iteration = self._sniff_display.axis()
+        # Sniff data envelope initialization to nans.
         # This is so that no data is plotted until we receive it and append it
         # to the right of the screen.
-        self.sniff = [nan] * len(self.iteration)
+        self.sniff = self._sniff_display.y()
         self.stream_plot_data.set_data("iteration", self.iteration)
         self.stream_plot_data.set_data("sniff", self.sniff)
 
@@ -651,8 +695,9 @@ class Passive_odor_presentation(Protocol):
                                                    metadata_name='trials_mask')
             first_plot.overlays.append(rangeselector)
             datasource = getattr(first_plot, "index", None)
-            # Add the trial timestamps as metadata to the x values datasource.
+            # Add the trial bounds as metadata to the x values datasource.
             datasource.metadata.setdefault("trials_mask", [])
+            self._trial_mask_datasource = datasource
 
         
         # ---------------------------------------------------------------------
@@ -670,15 +715,16 @@ class Passive_odor_presentation(Protocol):
         plot = Plot(self.stream_events_data, padding=20, padding_left=80, padding_top=0,
                     padding_bottom=0, border_visible=False)
 
-        # # Data array for the signal.
-        # # The last value is not nan so that the first incoming streaming value
-        # # can be set to nan. Implementation detail on how we start streaming.
-        self.lick1 = [nan] * len(self.iteration)
-        self.lick1[-1] = 0
-        self.lick2 = [nan] * len(self.iteration)
-        self.lick2[-1] = 0
-        self.mri = [nan] * len(self.iteration)
-        self.mri[-1] = 0
+        # Data arrays for the signals. They are nan (not plotted) until the
+        # first state change of each channel.
+        names, on_values, off_values = zip(*self.EVENT_CHANNELS)
+        self._event_channels = EventChannelRasterizer(names,
+                                                      self._sniff_display.columns * samples_per_column,
+                                                      on_values,
+                                                      off_values)
+        self.lick1 = self._event_envelope("lick1")
+        self.lick2 = self._event_envelope("lick2")
+        self.mri = self._event_envelope("mri")
 
         self.stream_events_data.set_data("iteration", self.iteration)
         self.stream_events_data.set_data("lick1", self.lick1)
@@ -718,6 +764,12 @@ class Passive_odor_presentation(Protocol):
 
         self.stream_events_plot = plot
 
+        # Stream packets only mark the plot data dirty, the scheduler redraws.
+        self._render_scheduler = RenderScheduler(self.PLOT_REFRESH_RATE)
+        if self.monitor is not None:
+            self._render_scheduler.instrumentation = self.monitor.instrumentation
+        self._render_scheduler.start()
+
         # Two plots will be overlaid with no separation.
         container = VPlotContainer(bgcolor="transparent")
 
@@ -727,59 +779,40 @@ class Passive_odor_presentation(Protocol):
         return container
 
 
+    def _event_envelope(self, name):
+        """ Min/max envelope of an event channel on the display columns. """
+        return decimate_minmax(self._event_channels.channel(name), self._sniff_display.samples_per_column)
+
     def _addtrialmask(self):
         """ Add a masking overlay to mark the time windows when a trial was \
         occuring """
-        
-        # TODO: eventually rewrite this using signal objects that handle the
-        # overlays.
-        # Get the sniff plot and add a selection overlay ability to it
-        if 'Sniff' in self.stream_plot.plots.keys():
-            sniff = self.stream_plot.plots['Sniff'][0]
-            datasource = getattr(sniff, "index", None)
-            data = self.iteration
-            # The trial time window has already passed through our window size.
-            if self._last_stream_index - self.trial_end >= self.STREAM_SIZE:
-                return
-            # Part of the trial window is already beyond our window size.
-            elif self._last_stream_index - self.trial_start >= self.STREAM_SIZE:
-                start = data[0]
-            else:
-                start = data[-self._last_stream_index + self.trial_start - 1]
-            end = data[-self._last_stream_index + self.trial_end - 1]
-            # Add the new trial bounds to the masking overlay.
-            datasource.metadata['trials_mask'] += (start, end)
 
-    def __last_stream_index_changed(self):
-        """ The end time tick in our plots has changed. Recompute signals. """
+        self._trial_mask.add(self.trial_start, self.trial_end)
+        self._update_trial_mask()
 
-        shift = self._last_stream_index - self._previous_last_stream_index
-        self._previous_last_stream_index = self._last_stream_index
+    def _update_trial_mask(self):
+        """ Map the trial windows still in view onto the display columns axis
+        for the overlay. """
 
-        streams = self.stream_definition()
-        # Nothing to display if no streaming data
-        if streams == None:
+        if self._trial_mask_datasource is None:
             return
-        # Currently this code is dependent on the sniff signal. Needs to change.
-        # TODO: Uncouple the dependence on a particular signal.
-        if 'Sniff' in streams.keys():
-            # Get the sniff plot and update the selection overlay mask.
-            if 'Sniff' in self.stream_plot.plots.keys():
-                sniff = self.stream_plot.plots['Sniff'][0]
-                datasource = getattr(sniff, "index", None)
-                mask = datasource.metadata['trials_mask']
-                new_mask = []
-                for index in range(len(mask)):
-                    mask_point = mask[index] - shift / 1000.0
-                    if mask_point < 0.001:
-                        if index % 2 == 0:
-                            new_mask.append(0.001)
-                        else:
-                            del new_mask[-1]
-                    else:
-                        new_mask.append(mask_point)
-                datasource.metadata['trials_mask'] = new_mask
+        self._trial_mask.cull(self._last_stream_index - self.STREAM_SIZE)
+        x = self._sniff_display.x_of(self._trial_mask.intervals, self._last_stream_index)
+        self._trial_mask_datasource.metadata['trials_mask'] = clip(x, self.iteration[0], self.iteration[-1])
 
+    def __last_stream_index_changed(self):
+        """ The end time tick in our plots has changed. Recompute signals. """
+
+        # Headless or replaying without plots there is no display to scroll.
+        if self._sniff_display is None:
+            return
+        # The plots scroll by whole display columns, so the trial mask only
+        # moves when a new column starts.
+        columns_started = self._sniff_display.columns_started
+        if columns_started != self._previous_columns_started:
+            self._previous_columns_started = columns_started
+            if len(self._trial_mask):
+                self._update_trial_mask()
 
     def _restart(self):
 
@@ -790,18 +823,8 @@ class Passive_odor_presentation(Protocol):
         self.corrects = 0
         self.corrects_go = 0
         self.corrects_nogo = 0
-        self._go_trials_line = [1]
-        self._nogo_trials_line = [1]
-        self.trial_number_tick = [0]
-        self.responses = [0]
-        self._sliding_window_go_array = []
-        self._sliding_window_nogo_array = []
-        self._total_go_hits = 0
-        self._total_go_misses = 0
-        self._total_nogo_hits = 0
-        self._total_nogo_misses = 0
-        self._sliding_window_go_hits = 0
-        self._sliding_window_nogo_hits = 0
+        self.responses.clear()
+        self._performance.reset()
         self.calculate_next_trial_parameters()
         
         time.clock()
@@ -893,95 +916,18 @@ class Passive_odor_presentation(Protocol):
         """
         self.trialNumber = self.trial_number
 
-    def _responses_changed(self):
+    def _update_performance(self, response):
+        """ Adds the result of the trial that just ended to the performance
+        plot. """
 
-        if len(self.responses) == 1:
+        trial_type, correct = self.RESPONSE_OUTCOMES[response]
+        self._performance.add(trial_type, correct, self.trial_number)
+        if self.event_plot is None:
             return
 
-        gocorrect = int
-        nogocorrect = int
-        lastelement = self.responses[-1]
-
-        if(lastelement == 1):  # GO HIT
-            self._total_go_hits += 1
-            if len(self._sliding_window_go_array) == self.SLIDING_WINDOW:
-                del self._sliding_window_go_array[:]
-                if self._sliding_window_go_hits != 0:
-                    del self._sliding_window_go_hits
-                del self._go_trials_line
-                self._sliding_window_go_hits += 1
-            else:
-                self._sliding_window_go_hits += 1
-            self._sliding_window_go_array.append(lastelement)
-
-        elif (lastelement == 2):  # NOGO HIT
-            self._total_nogo_hits += 1
-            if len(self._sliding_window_nogo_array) == self.SLIDING_WINDOW:
-                del self._sliding_window_nogo_array[:]
-                if self._sliding_window_nogo_hits != 0:
-                    del self._sliding_window_nogo_hits
-                del self._nogo_trials_line
-                self._sliding_window_nogo_hits += 1
-            else:
-                self._sliding_window_nogo_hits += 1
-            self._sliding_window_nogo_array.append(lastelement)
-
-        elif (lastelement == 3):  # GO MISS
-            self._total_go_misses += 1
-            if len(self._sliding_window_go_array) == self.SLIDING_WINDOW:
-                del self._sliding_window_go_array[:]
-                if self._sliding_window_go_hits != 0:
-                    del self._sliding_window_go_hits
-                self._go_trials_line = [1]
-            self._sliding_window_go_array.append(lastelement)
-
-        elif (lastelement == 4):  # NOGO MISS
-            self._total_nogo_misses += 1
-            if len(self._sliding_window_nogo_array) == self.SLIDING_WINDOW:
-                del self._sliding_window_nogo_array[:]
-                if self._sliding_window_nogo_hits != 0:
-                    del self._sliding_window_nogo_hits
-                self._nogo_trials_line = [1]
-            self._sliding_window_nogo_array.append(lastelement)
-
-        elif (lastelement == 5):  # GO NO RESPONSE
-            self._total_go_misses += 1
-            if len(self._sliding_window_go_array) == self.SLIDING_WINDOW:
-                del self._sliding_window_go_array[:]
-                if self._sliding_window_go_hits != 0:
-                    del self._sliding_window_go_hits
-                self._go_trials_line = [1]
-            self._sliding_window_go_array.append(lastelement)
-
-        elif (lastelement == 6):  # NOGO NO RESPONSE
-            self._total_nogo_misses += 1
-            if len(self._sliding_window_nogo_array) == self.SLIDING_WINDOW:
-                del self._sliding_window_nogo_array[:]
-                if self._sliding_window_nogo_hits != 0:
-                    del self._sliding_window_nogo_hits
-                self._nogo_trials_line = [1]
-            self._sliding_window_nogo_array.append(lastelement)
-        
-        # sliding window data arrays
-        slwgotrials = len(self._sliding_window_go_array)
-        if slwgotrials == 0:
-            gocorrect = 0
-        else:
-            gocorrect = self._sliding_window_go_hits*1.0/slwgotrials
-        
-        slwnogotrials = len(self._sliding_window_nogo_array)
-        if slwnogotrials == 0:
-            nogocorrect = 0
-        else:
-            nogocorrect = self._sliding_window_nogo_hits*1.0/slwnogotrials
-                
-        self._go_trials_line = append(self._go_trials_line, gocorrect*100)
-        self._nogo_trials_line = append(self._nogo_trials_line, nogocorrect*100)
-        self.trial_number_tick = append(self.trial_number_tick, self.trial_number)
-        
-        self.event_plot_data.set_data("trial_number_tick", self.trial_number_tick)        
-        self.event_plot_data.set_data("_go_trials_line", self._go_trials_line)
-        self.event_plot_data.set_data("_nogo_trials_line", self._nogo_trials_line)
+        self.event_plot_data.set_data("trial_number_tick", self._performance.trials.data)
+        self.event_plot_data.set_data("_go_trials_line", self._performance.line("Go"))
+        self.event_plot_data.set_data("_nogo_trials_line", self._performance.line("NoGo"))
         self.event_plot.request_redraw()
 
     # TODO: fix the cycle
@@ -992,7 +938,7 @@ class Passive_odor_presentation(Protocol):
         triggering of the final valve.
         """
         if self.start_label == "Start" and  self.auto_final_valve_label == "Final valve cycling (ON)":
-            Timer.singleShot(self.auto_final_valve_on_duration, self._callibrate)
+            QTimer.singleShot(self.auto_final_valve_on_duration, self._callibrate)
 
         self._final_valve_button_fired()
 
@@ -1017,8 +963,7 @@ class Passive_odor_presentation(Protocol):
             self.start_label = 'Stop'
             self._restart()
             self._odorvalveon()
-            VoyeurData = os.path.join('/VoyeurData/')
-            self.monitor.database_file = VoyeurData + self.db
+            self.monitor.database_file = os.path.join(self.monitor.data_directory, self.db)
             self.monitor.start_acquisition()
             # TODO: make the monitor start acquisition start an ITI, not a trial.
         return
@@ -1057,8 +1002,8 @@ class Passive_odor_presentation(Protocol):
             if self.final_valve_label == "Final Valve (OFF)":
                 self._final_valve_button_fired()
                 self.auto_final_valve_label = 'Final valve cycling (ON)'
-                Timer.singleShot(self.auto_final_valve_on_duration,
-                                 self._auto_final_valve_fired)
+                QTimer.singleShot(self.auto_final_valve_on_duration,
+                                  self._auto_final_valve_fired)
             else:
                 self._final_valve_button_fired()
                 self.auto_final_valve_label = 'Final valve cycling (OFF)'
@@ -1066,12 +1011,12 @@ class Passive_odor_presentation(Protocol):
                 self.auto_final_valve_mode == 'Repeated':
             if self.final_valve_label == "Final Valve (OFF)":
                 self._final_valve_button_fired()
-                Timer.singleShot(self.auto_final_valve_on_duration,
-                                 self._auto_final_valve_fired)
+                QTimer.singleShot(self.auto_final_valve_on_duration,
+                                  self._auto_final_valve_fired)
             elif self.final_valve_label == "Final Valve (ON)":
                 self._final_valve_button_fired()
-                Timer.singleShot(self.auto_final_valve_off_duration,
-                                 self._auto_final_valve_fired)
+                QTimer.singleShot(self.auto_final_valve_off_duration,
+                                  self._auto_final_valve_fired)
             # At this point we are still cycling through the final valve
             self.auto_final_valve_label = 'Final valve cycling (ON)'
             
@@ -1206,7 +1151,23 @@ class Passive_odor_presentation(Protocol):
         self.water_duration2 = self.config['waterValveDurations']['valve_2_right']['0.5ul']
         self.olfas = self.config['olfas']
 
+        # Metadata of this session only, not the dictionary shared by the class
+        self.metadata = dict(self.metadata)
+        block_seed = self.BLOCK_SEED
+        if block_seed is None:
+            block_seed = Random().randint(0, 2 ** 31 - 1)
+        self._block_random = Random(block_seed)
+        self.metadata['block_seed'] = block_seed
+
         self._build_stimulus_set()
+        if self.PRECOMPUTED_SCHEDULE:
+            self._schedule = SessionSchedule(self._stimulus_block,
+                                             self._free_water,
+                                             self.ITI_BOUNDS_CORRECT,
+                                             self.ITI_BOUNDS_FALSE_ALARM,
+                                             seed=self.SCHEDULE_SEED,
+                                             trials=self.SCHEDULE_TRIALS)
+            self.metadata['schedule_seed'] = self._schedule.seed
         self.calculate_next_trial_parameters()
         self.calculate_current_trial_parameters()
         
@@ -1232,66 +1193,74 @@ class Passive_odor_presentation(Protocol):
         self.corrects_nogo = 0
         self.max_rewards = max_rewards
         
+        self._performance = PerformanceTracker(("Go", "NoGo"), self.SLIDING_WINDOW)
         # Setup the performance plots
-        self.event_plot_data = ArrayPlotData(trial_number_tick=self.trial_number_tick,
-                                             _go_trials_line=self._go_trials_line,
-                                             _nogo_trials_line=self._nogo_trials_line)
-        plot = Plot(self.event_plot_data, padding=20, padding_left=80, padding_bottom=40, border_visible=False)
-        self.event_plot = plot
-        plot.plot(('trial_number_tick', '_go_trials_line'), type='scatter', marker='circle', marker_size=6,
-                  color='blue', outline_color='transparent', name="Go Trial")
-        plot.plot(('trial_number_tick', '_nogo_trials_line'), type='scatter', marker='circle', marker_size=6,
-                  color='red', outline_color='transparent', name="NoGo Trial")
-        plot.legend.visible = True
-        plot.legend.bgcolor = "white"
-        plot.legend.align = "ul"
-        plot.legend.border_visible = False
-        plot.legend.line_spacing = 6
-        plot.legend.font = "Arial 14"
-        plot.y_axis.title = "% Correct"
-        y_range = DataRange1D(low=0, high=100)
-        plot.value_range = y_range
-        plot.x_grid = None
-
-        AXIS_DEFAULTS = {
-            'axis_line_weight': 1,
-            'tick_weight': 1,
-            'tick_label_font': 'Arial 14',
-            'tick_interval': 1
-        }
+        if not self.headless:
+            self.event_plot_data = ArrayPlotData(trial_number_tick=self._performance.trials.data,
+                                                 _go_trials_line=self._performance.line("Go"),
+                                                 _nogo_trials_line=self._performance.line("NoGo"))
+            plot = Plot(self.event_plot_data, padding=20, padding_left=80, padding_bottom=40, border_visible=False)
+            self.event_plot = plot
+            plot.plot(('trial_number_tick', '_go_trials_line'), type='scatter', marker='circle', marker_size=6,
+                      color='blue', outline_color='transparent', name="Go Trial")
+            plot.plot(('trial_number_tick', '_nogo_trials_line'), type='scatter', marker='circle', marker_size=6,
+                      color='red', outline_color='transparent', name="NoGo Trial")
+            plot.legend.visible = True
+            plot.legend.bgcolor = "white"
+            plot.legend.align = "ul"
+            plot.legend.border_visible = False
+            plot.legend.line_spacing = 6
+            plot.legend.font = "Arial 14"
+            plot.y_axis.title = "% Correct"
+            y_range = DataRange1D(low=0, high=100)
+            plot.value_range = y_range
+            plot.x_grid = None
+
+            AXIS_DEFAULTS = {
+                'axis_line_weight': 1,
+                'tick_weight': 1,
+                'tick_label_font': 'Arial 14',
+                'tick_interval': 1
+            }
+
+            x_axis = PlotAxis(orientation='bottom',
+                              mapper=plot.x_mapper,
+                              component=plot,
+                              **AXIS_DEFAULTS)
+            y_axis = PlotAxis(orientation='left',
+                              mapper=plot.y_mapper,
+                              tick_interval=20,
+                              component=plot)
+
+            plot.x_axis = x_axis
+            plot.y_axis = y_axis
 
-        x_axis = PlotAxis(orientation='bottom',
-                          mapper=plot.x_mapper,
-                          component=plot,
-                          **AXIS_DEFAULTS)
-        y_axis = PlotAxis(orientation='left',
-                          mapper=plot.y_mapper,
-                          tick_interval=20,
-                          component=plot)
-
-        plot.x_axis = x_axis
-        plot.y_axis = y_axis
-
-        self.trial_number_tick = [0]
-        self.responses = [0]
-        
         time.clock()
 
-        if self.OLFA:
-            self.olfactometer = Olfactometers(config_obj=self.config)
-        else:
-            self.olfactometer = Olfactometers(config_obj=None)
-
-        if len(self.olfactometer.olfas) == 0:
-            print "self.olfactometer = None"
+        if HEADLESS:
+            # The olfactometers are driven from their Qt window
+            print "Headless: self.olfactometer = None"
             self.olfactometer = None
         else:
-            self.olfactometer.olfas[0].valves.set_background_valve(valve_state=0)
+            if self.OLFA:
+                self.olfactometer = Olfactometers(config_obj=self.config)
+            else:
+                self.olfactometer = Olfactometers(config_obj=None)
+
+            if len(self.olfactometer.olfas) == 0:
+                print "self.olfactometer = None"
+                self.olfactometer = None
+            else:
+                self.olfactometer.olfas[0].valves.set_background_valve(valve_state=0)
         self._setflows()
 
         if self.ARDUINO:
-            self.monitor = Monitor()
+            # A monitor may be given, e.g. by voyeur.supervisor for one rig of several
+            if self.monitor is None:
+                self.monitor = Monitor()
             self.monitor.protocol = self
+            if self._render_scheduler is not None:
+                self._render_scheduler.instrumentation = self.monitor.instrumentation
 
 
     def trial_parameters(self):
@@ -1425,6 +1394,7 @@ class Passive_odor_presentation(Protocol):
         self.parameters_received_time = int(event['parameters_received_time'])
         self.trial_start = int(event['trial_start'])
         self.trial_end = int(event['trial_end'])
+        self._addtrialmask()
 
         response = int(event['response'])
         if (response == 1) : # a go hit.
@@ -1439,7 +1409,7 @@ class Passive_odor_presentation(Protocol):
             self.total_available_rewards_go += 1
             if self.rewards >= self.max_rewards and self.start_label == 'Stop':
                 self._start_button_fired()  # ends the session if the reward target has been reached.
-            self.inter_trial_interval = randint(self.iti_bounds[0], self.iti_bounds[1])
+            self.inter_trial_interval = self._inter_trial_interval()
 
         if (response == 2) : # a nogo hit.
             self.rewards += 1
@@ -1453,7 +1423,7 @@ class Passive_odor_presentation(Protocol):
             self.total_available_rewards_nogo += 1
             if self.rewards >= self.max_rewards and self.start_label == 'Stop':
                 self._start_button_fired()  # ends the session if the reward target has been reached.
-            self.inter_trial_interval = randint(self.iti_bounds[0], self.iti_bounds[1])
+            self.inter_trial_interval = self._inter_trial_interval()
 
         if (response == 3) : # a go false alarm
             if self.go_free_water:
@@ -1461,7 +1431,7 @@ class Passive_odor_presentation(Protocol):
                 self.rewards_go += 1
             self.total_available_rewards += 1
             self.total_available_rewards_go += 1
-            self.inter_trial_interval = randint(self.iti_bounds_false_alarm[0],self.iti_bounds_false_alarm[1])
+            self.inter_trial_interval = self._inter_trial_interval(false_alarm=True)
 
         if (response == 4):  # a nogo false alarm
             if self.nogo_free_water:
@@ -1469,7 +1439,7 @@ class Passive_odor_presentation(Protocol):
                 self.rewards_nogo += 1
             self.total_available_rewards += 1
             self.total_available_rewards_nogo += 1
-            self.inter_trial_interval = randint(self.iti_bounds_false_alarm[0], self.iti_bounds_false_alarm[1])
+            self.inter_trial_interval = self._inter_trial_interval(false_alarm=True)
 
         if (response == 5) : # no response
             if self.go_free_water:
@@ -1477,7 +1447,7 @@ class Passive_odor_presentation(Protocol):
                 self.rewards_go += 1
             self.total_available_rewards += 1
             self.total_available_rewards_go += 1
-            self.inter_trial_interval = randint(self.iti_bounds[0],self.iti_bounds[1])
+            self.inter_trial_interval = self._inter_trial_interval()
 
         if (response == 6) : # no response
             if self.nogo_free_water:
@@ -1485,9 +1455,10 @@ class Passive_odor_presentation(Protocol):
                 self.rewards_nogo += 1
             self.total_available_rewards += 1
             self.total_available_rewards_nogo += 1
-            self.inter_trial_interval = randint(self.iti_bounds[0],self.iti_bounds[1])
+            self.inter_trial_interval = self._inter_trial_interval()
 
-        self.responses = append(self.responses, response)
+        self.responses.append(response)
+        self._update_performance(response)
         
         # Update a couple last parameters from the next_stimulus object, then make it the current_stimulus..
         self.calculate_current_trial_parameters()
@@ -1514,7 +1485,7 @@ class Passive_odor_presentation(Protocol):
             print "Warning! nextvalveontime < 0"
             nextvalveontime = 20
             self.next_trial_start = 1000
-        Timer.singleShot(int(nextvalveontime), self._odorvalveon)
+        QTimer.singleShot(int(nextvalveontime), self._odorvalveon)
         
         return
 
@@ -1526,35 +1497,30 @@ class Passive_odor_presentation(Protocol):
             num_sniffs = stream['sniff_samples']
             packet_sent_time = stream['packet_sent_time']
 
-            if packet_sent_time > self._last_stream_index + num_sniffs:
-                lostsniffsamples = packet_sent_time - self._last_stream_index - num_sniffs
-                if lostsniffsamples > self.STREAM_SIZE:
-                    lostsniffsamples = self.STREAM_SIZE
-                lostsniffsamples = int(lostsniffsamples)
-                # Pad sniff signal with last value for the lost samples first then append received sniff signal
-                new_sniff = hstack((self.sniff[-self.STREAM_SIZE + lostsniffsamples:], [self.sniff[-1]] * lostsniffsamples))
-                if stream['sniff'] is not None:
-                    self.sniff = hstack((new_sniff[-self.STREAM_SIZE + num_sniffs:], negative(stream['sniff'])))
-            else:
+            # Nothing to draw until the streaming plots are built. Headless they never are.
+            if self._render_scheduler is not None:
+                if packet_sent_time > self._last_stream_index + num_sniffs:
+                    lostsniffsamples = packet_sent_time - self._last_stream_index - num_sniffs
+                    # Pad sniff signal with last value for the lost samples first then append received sniff signal
+                    self._sniff_display.pad(lostsniffsamples)
                 if stream['sniff'] is not None:
-                    new_sniff = hstack((self.sniff[-self.STREAM_SIZE + num_sniffs:], negative(stream['sniff'])))
-            self.sniff = new_sniff
-            self.stream_plot_data.set_data("sniff", self.sniff)
+                    self._sniff_display.append(negative(stream['sniff']))
+                self.sniff = self._sniff_display.y()
+                self._render_scheduler.mark(self.stream_plot_data, "sniff", self.sniff)
             
 
-            if stream['lick1'] is not None or (self._last_stream_index - self._last_lick1_index < self.STREAM_SIZE):
-                [self.lick1] = self._process_lick1s(stream, ('lick1',), [self.lick1])
-                
-            if stream['lick2'] is not None or (self._last_stream_index - self._last_lick2_index < self.STREAM_SIZE):
-                [self.lick2] = self._process_lick2s(stream, ('lick2',), [self.lick2])
-
-            if stream['mri'] is not None or (self._last_stream_index - self._last_mri_index < self.STREAM_SIZE):
-                [self.mri] = self._process_mris(stream, ('mri',), [self.mri])
+                # Lick and trigger state changes. Nothing to redraw while the event
+                # window is constant.
+                if self._event_channels.update(packet_sent_time, stream):
+                    for name in self._event_channels.names:
+                        self._render_scheduler.mark(self.stream_events_data, name, self._event_envelope)
 
             self._last_stream_index = packet_sent_time
 
             # If we haven't received results by MAX_TRIAL_DURATION, pause and unpause as there was probably some problem with comm.
-            if (self.trial_number > 1) and ((time.clock() - self._results_time) > self.MAX_TRIAL_DURATION) and self.pause_label == "Pause":
+            # Without a monitor (e.g. replaying a session, see voyeur.replay) there is nothing to pause.
+            if (self.trial_number > 1) and ((time.clock() - self._results_time) > self.MAX_TRIAL_DURATION) and \
+                    self.pause_label == "Pause" and self.monitor is not None:
                 print "=============== Pausing to restart Trial =============="
                 self._unsynced_packets += 1
                 self._results_time = time.clock()
@@ -1563,231 +1529,7 @@ class Passive_odor_presentation(Protocol):
                     self.pause_label = 'Unpause'
                     self._pause_button_fired()
                     # Unpause in 1 second
-                    Timer.singleShot(1000, self._pause_button_fired)
-        return
-
-
-
-    def _process_lick1s(self, stream, lick1signals, lick1arrays):
-
-        packet_sent_time = stream['packet_sent_time']
-
-        # TODO: find max shift first, apply it to all lick1s
-        maxtimestamp = int(packet_sent_time)
-        for i in range(len(lick1arrays)):
-            lick1signal = lick1signals[i]
-
-            if lick1signal in stream.keys():
-                streamsignal = stream[lick1signal]
-                if streamsignal is not None and streamsignal[-1] > maxtimestamp:
-                        maxtimestamp = streamsignal[-1]
-                        print "**************************************************************"
-                        print "WARNING! lick1 timestamp exceeds timestamp of received packet: "
-                        print "Packet sent timestamp: ", packet_sent_time, "lick1 timestamp: ", streamsignal[-1]
-                        print "**************************************************************"
-        maxshift = int(packet_sent_time - self._last_stream_index)
-        if maxshift > self.STREAM_SIZE:
-            maxshift = self.STREAM_SIZE - 1
-
-        for i in range(len(lick1arrays)):
-
-            lick1signal = lick1signals[i]
-            lick1array = lick1arrays[i]
-
-            if lick1signal in stream.keys():
-                if stream[lick1signal] is None:
-                    lick1array = hstack((lick1array[-self.STREAM_SIZE + maxshift:], [lick1array[-1]] * maxshift))
-                else:
-                    last_state = lick1array[-1]
-                    last_lick1_tick = self._last_stream_index
-                    for lick1 in stream[lick1signal]:
-                        shift = int(lick1 - last_lick1_tick)
-                        if shift <= 0:
-                            if shift < self.STREAM_SIZE * -1:
-                                shift = -self.STREAM_SIZE + 1
-                            if isnan(last_state):
-                                lick1array[shift - 1:] = [i + 1] * (-shift + 1)
-                            else:
-                                lick1array[shift - 1:] = [nan] * (-shift + 1)
-                        # Lick1 timestamp exceeds packet sent time. Just change the signal state but don't shift
-                        elif lick1 > packet_sent_time:
-                            if isnan(last_state):
-                                lick1array[-1] = i + 1
-                            else:
-                                lick1array[-1] = nan
-                        else:
-                            if shift > self.STREAM_SIZE:
-                                shift = self.STREAM_SIZE - 1
-                            lick1array = hstack((lick1array[-self.STREAM_SIZE + shift:], [lick1array[-1]] * shift))
-                            if isnan(last_state):
-                                lick1array = hstack((lick1array[-self.STREAM_SIZE + 1:], [i + 1]))
-                            else:
-                                lick1array = hstack((lick1array[-self.STREAM_SIZE + 1:], [nan]))
-                            last_lick1_tick = lick1
-                        last_state = lick1array[-1]
-                        # Last timestamp of lick1 signal change
-                        self._last_lick1_index = lick1
-                    lastshift = int(packet_sent_time - last_lick1_tick)
-                    if lastshift >= self.STREAM_SIZE:
-                        lastshift = self.STREAM_SIZE
-                        lick1array = [lick1array[-1]] * lastshift
-                    elif lastshift > 0 and len(lick1array) > 0:
-                        lick1array = hstack((lick1array[-self.STREAM_SIZE + lastshift:], [lick1array[-1]] * lastshift))
-                if len(lick1array) > 0:
-                    self.stream_events_data.set_data(lick1signal, lick1array)
-                    lick1arrays[i] = lick1array
-
-        return lick1arrays
-
-    def _process_lick2s(self, stream, lick2signals, lick2arrays):
-
-        packet_sent_time = stream['packet_sent_time']
-
-        # TODO: find max shift first, apply it to all lick2s
-        maxtimestamp = int(packet_sent_time)
-        for i in range(len(lick2arrays)):
-            lick2signal = lick2signals[i]
-
-            if lick2signal in stream.keys():
-                streamsignal = stream[lick2signal]
-                if streamsignal is not None and streamsignal[-1] > maxtimestamp:
-                    maxtimestamp = streamsignal[-1]
-                    print "**************************************************************"
-                    print "WARNING! lick2 timestamp exceeds timestamp of received packet: "
-                    print "Packet sent timestamp: ", packet_sent_time, "lick2 timestamp: ", streamsignal[-1]
-                    print "**************************************************************"
-        maxshift = int(packet_sent_time - self._last_stream_index)
-        if maxshift > self.STREAM_SIZE:
-            maxshift = self.STREAM_SIZE - 1
-
-        for i in range(len(lick2arrays)):
-
-            lick2signal = lick2signals[i]
-            lick2array = lick2arrays[i]
-
-            if lick2signal in stream.keys():
-                if stream[lick2signal] is None:
-                    lick2array = hstack((lick2array[-self.STREAM_SIZE + maxshift:], [lick2array[-1]] * maxshift))
-                else:
-                    last_state = lick2array[-1]
-                    last_lick2_tick = self._last_stream_index
-                    for lick2 in stream[lick2signal]:
-                        shift = int(lick2 - last_lick2_tick)
-                        if shift <= 0:
-                            if shift < self.STREAM_SIZE * -1:
-                                shift = -self.STREAM_SIZE + 1
-                            if isnan(last_state):
-                                lick2array[shift - 1:] = [i + 1] * (-shift + 1)
-                            else:
-                                lick2array[shift - 1:] = [nan] * (-shift + 1)
-                        # Lick2 timestamp exceeds packet sent time. Just change the signal state but don't shift
-                        elif lick2 > packet_sent_time:
-                            if isnan(last_state):
-                                lick2array[-1] = i + 1
-                            else:
-                                lick2array[-1] = nan
-                        else:
-                            if shift > self.STREAM_SIZE:
-                                shift = self.STREAM_SIZE - 1
-                            lick2array = hstack((lick2array[-self.STREAM_SIZE + shift:], [lick2array[-1]] * shift))
-                            if isnan(last_state):
-                                lick2array = hstack((lick2array[-self.STREAM_SIZE + 1:], [i + 1]))
-                            else:
-                                lick2array = hstack((lick2array[-self.STREAM_SIZE + 1:], [nan]))
-                            last_lick2_tick = lick2
-                        last_state = lick2array[-1]
-                        # Last timestamp of lick2 signal change
-                        self._last_lick2_index = lick2
-                    lastshift = int(packet_sent_time - last_lick2_tick)
-                    if lastshift >= self.STREAM_SIZE:
-                        lastshift = self.STREAM_SIZE
-                        lick2array = [lick2array[-1]] * lastshift
-                    elif lastshift > 0 and len(lick2array) > 0:
-                        lick2array = hstack((lick2array[-self.STREAM_SIZE + lastshift:], [lick2array[-1]] * lastshift))
-                if len(lick2array) > 0:
-                    self.stream_events_data.set_data(lick2signal, lick2array)
-                    lick2arrays[i] = lick2array
-
-        return lick2arrays
-
-    def _process_mris(self, stream, mrisignals, mriarrays):
-
-
-        packet_sent_time = stream['packet_sent_time']
-
-        maxtimestamp = int(packet_sent_time)
-        for i in range(len(mriarrays)):
-            mrisignal = mrisignals[i]
-
-            if mrisignal in stream.keys():
-                streamsignal = stream[mrisignal]
-                if streamsignal is not None and streamsignal[-1] > maxtimestamp:
-                        maxtimestamp = streamsignal[-1]
-                        print "**************************************************************"
-                        print "WARNING! MRI timestamp exceeds timestamp of received packet: "
-                        print "Packet sent timestamp: ", packet_sent_time, "MRI timestamp: ", streamsignal[-1]
-                        print "**************************************************************"
-        maxshift = int(packet_sent_time - self._last_stream_index)
-        if maxshift > self.STREAM_SIZE:
-            maxshift = self.STREAM_SIZE - 1
-
-        for i in range(len(mriarrays)):
-            mrisignal = mrisignals[i]
-            mriarray = mriarrays[i]
-
-            if mrisignal in stream.keys():
-                if stream[mrisignal] is None:
-                    mriarray = hstack((mriarray[-self.STREAM_SIZE + maxshift:], [mriarray[-1]] * maxshift))
-                else:
-                    last_state = mriarray[-1]
-                    last_mri_tick = self._last_stream_index
-                    for mri in stream[mrisignal]:
-                        shift = int(mri - last_mri_tick)
-                        if shift <= 0:
-                            return
-                        else:
-                            if shift > self.STREAM_SIZE:
-                                shift = self.STREAM_SIZE - 1
-                            mriarray = hstack((mriarray[-self.STREAM_SIZE + shift:], [mriarray[-1]] * shift))
-                            if (last_state==-2):
-                                mriarray = hstack((mriarray[-self.STREAM_SIZE + 1:], [i + 1]))
-                            else:
-                                mriarray = hstack((mriarray[-self.STREAM_SIZE + 1:], [-2]))
-                            last_mri_tick = mri
-                        # last timestamp of lick signal change
-                        self._last_mri_index = mri
-                    lastshift = int(packet_sent_time - last_mri_tick)
-                    if lastshift >= self.STREAM_SIZE:
-                        lastshift = self.STREAM_SIZE
-                        mriarray = [mriarray[-1]] * lastshift
-                    elif lastshift > 0 and len(mriarray) > 0:
-                        mriarray = hstack((mriarray[-self.STREAM_SIZE + lastshift:], [mriarray[-1]] * lastshift))
-                if len(mriarray) > 0:
-                    self.stream_events_data.set_data(mrisignal, mriarray*10)
-                    mriarrays[i] = mriarray
-
-        return mriarrays
-
-    def _shiftlicks(self, shift):
-
-        if shift > self.STREAM_SIZE:
-            shift = self.STREAM_SIZE - 1
-
-        streamdef = self.stream_definition()
-        if 'lick1' in streamdef.keys():
-            self.lick1 = hstack((self.lick1[-self.STREAM_SIZE + shift:], self.lick1[-1] * shift))
-            self.stream_lick_data.set_data('lick1', self.lick1)
-        return
-
-    def _shiftmris(self, shift):
-
-        if shift > self.STREAM_SIZE:
-            shift = self.STREAM_SIZE - 1
-
-        streamdef = self.stream_definition()
-        if 'mri' in streamdef.keys():
-            self.mri = hstack((self.mri[-self.STREAM_SIZE + shift:], self.mri[-1] * shift))
-            self.stream_mri_data.set_data('mri', self.mri)
+                    QTimer.singleShot(1000, self._pause_button_fired)
         return
 
     def start_of_trial(self):
@@ -1828,9 +1570,67 @@ class Passive_odor_presentation(Protocol):
                 if self.odorvalve != 0:
                     self.olfactometer.olfas[i].valves.set_odor_valve(self.odorvalve, 0)
     
+    def _stimulus_block(self, trial_number, rng):
+        """ Returns the block of stimuli starting at trial trial_number, \
+        ordered using the random.Random instance rng. """
+
+        # Generate an initial block of trials if needed.
+        if trial_number <= self.INITIAL_TRIALS:
+            block_size = self.INITIAL_TRIALS
+            stimulus_block = []
+            if self.INITIAL_TRIALS_TYPE == 0:
+                stimulus_block = [self.STIMULI["Go"][0]] * block_size
+            elif self.INITIAL_TRIALS_TYPE == 1:
+                stimulus_block = [self.STIMULI["NoGo"][0]] * block_size
+            elif self.INITIAL_TRIALS_TYPE == 2: # nogo then go
+                stimulus_block = [self.STIMULI["NoGo"][0]] * (block_size / 2)
+                stimulus_block.extend([self.STIMULI["Go"][0]] * (block_size / 2))
+            elif self.INITIAL_TRIALS_TYPE == 3: # go then nogo
+                stimulus_block = [self.STIMULI["Go"][0]]* (block_size/2)
+                stimulus_block.extend([self.STIMULI["NoGo"][0]]* (block_size/2))
+            return stimulus_block
+
+        return generate_block(self.STIMULI,
+                              quotas=self.BLOCK_QUOTAS,
+                              block_size=self.block_size,
+                              max_run=self.MAX_BLOCK_RUN,
+                              rng=rng)
+
+    def _free_water(self, trial_number, rng):
+        """ Whether trial trial_number gives free water in a precomputed \
+        session schedule. """
+
+        random_free_water_index = rng.randint(1, 10)
+        if self.LICKING_TRAINING <= 0:
+            return False
+        return trial_number <= self.initial_free_water_trials or \
+            self.LICKING_TRAINING * 10 >= random_free_water_index
+
+    def _inter_trial_interval(self, false_alarm=False):
+        """ Inter trial interval following the trial that just ended. """
+
+        if self._schedule is not None:
+            planned = self._schedule.trial(self.trial_number)
+            if false_alarm:
+                return planned['iti_false_alarm']
+            return planned['iti']
+        if false_alarm:
+            return randint(self.iti_bounds_false_alarm[0], self.iti_bounds_false_alarm[1])
+        return randint(self.iti_bounds[0], self.iti_bounds[1])
+
+    def session_tables(self):
+        """ The session plan and its overrides, when precomputed, written as
+        they grow. """
+
+        if self._schedule is None:
+            return {}
+        return {"SessionSchedule": self._schedule.plan,
+                "ScheduleOverrides": self._schedule.overrides_array()}
+
     def generate_next_stimulus_block(self):
-        """ Generate a block of randomly shuffled stimuli from the stimulus \
-        set stored in self.stimuli.
+        """ Generate a block of randomly ordered stimuli from the stimulus \
+        set stored in self.STIMULI, with at most MAX_BLOCK_RUN trials of a \
+        category in a row.
         
         Modify this method to implement the behaviour you want for how a block
         of stimuli is chosen.
@@ -1844,54 +1644,7 @@ class Passive_odor_presentation(Protocol):
             print "Warning! Current stimulus block was not empty! Generating \
                     new block..."
         
-        # Generate an initial block of trials if needed.
-        if self.trial_number < self.INITIAL_TRIALS:
-            block_size = self.INITIAL_TRIALS
-            if self.INITIAL_TRIALS_TYPE == 0:
-                self.stimulus_block = [self.STIMULI["Go"][0]] * block_size
-            elif self.INITIAL_TRIALS_TYPE == 1:
-                self.stimulus_block = [self.STIMULI["NoGo"][0]] * block_size
-            elif self.INITIAL_TRIALS_TYPE == 2: # nogo then go
-                self.stimulus_block = [self.STIMULI["NoGo"][0]] * (block_size / 2)
-                self.stimulus_block.extend([self.STIMULI["Go"][0]] * (block_size / 2))
-            elif self.INITIAL_TRIALS_TYPE == 3: # go then nogo
-                self.stimulus_block = [self.STIMULI["Go"][0]]* (block_size/2)
-                self.stimulus_block.extend([self.STIMULI["NoGo"][0]]* (block_size/2))
-            return
-
-
-        # Randomize seed from system clock.
-        seed()
-        if not len(self.STIMULI):
-            raise ValueError("Stimulus set is empty! Cannot generate a block.")
-        # Grab all stimuli arrays from our stimuli sets.
-        list_all_stimuli_arrays = self.STIMULI.values()
-        # Flatten the list so that we have a 1 dimensional array of items
-        self.stimulus_block = list(chain.from_iterable(list_all_stimuli_arrays))
-                
-        if self.block_size/len(self.stimulus_block) > 1:
-            copies = self.block_size/len(self.stimulus_block)
-            self.stimulus_block *= copies
-            if len(self.stimulus_block) < self.block_size:
-                print "WARNING! Block size is not a multiple of stimulus set:"\
-                    "\nBlock size: %d\t Stimulus set size: %d \tConstructed " \
-                    " Stimulus block size: %d" \
-                    %(self.block_size, len(self.STIMULI.values()),
-                      len(self.stimulus_block))
-            
-        # Shuffle the set.
-        attempts = 0
-        while attempts < 20:
-            try:
-                shuffle(self.stimulus_block, random)
-                if all(len(list(group)) < 4 for _, group in groupby(self.stimulus_block)):
-                    break
-            except:
-                attempts += 1
-                if attempts == 19:
-                    print "Failed to generate new stimulus block"
-                    break
-
+        self.stimulus_block = self._stimulus_block(self.next_trial_number, self._block_random)
 
         print "\nGenerated new stimulus block:"
         for i in range(len(self.stimulus_block)):
@@ -1925,6 +1678,31 @@ class Passive_odor_presentation(Protocol):
         # if self.trial_number == 1:
         #     self.calculate_next_trial_parameters()
 
+    def restore_trial(self, parameters):
+        """ Makes the current trial the one recorded with parameters, its row
+        of the Trials table, when a session is replayed (see voyeur.replay).
+
+        The stimulus, odor, flows and free water then match the recorded
+        trial, so the recorded response is scored against the stimulus that
+        was presented.
+        """
+
+        category = str(parameters['trial_category'])
+        odorvalve = int(parameters['odorvalve'])
+        stimuli = self.STIMULI.get(category, [])
+        matching = [stimulus for stimulus in stimuli if odorvalve in stimulus.odorvalves] or stimuli
+        if matching:
+            self.current_stimulus = matching[0]
+        self.trial_number = int(parameters['trialNumber'])
+        self.trial_type = category
+        self.odorvalve = odorvalve
+        self.odorant = str(parameters['odorant'])
+        self.air_flow = float(parameters['air_flow'])
+        self.nitrogen_flow = float(parameters['nitrogen_flow'])
+        self.go_free_water = bool(parameters['go_free_water'])
+        self.nogo_free_water = bool(parameters['nogo_free_water'])
+        self.free_water = self.go_free_water or self.nogo_free_water
+
     def calculate_next_trial_parameters(self):
         """ Calculate parameters for the trial that will follow the currently \
         scheduled trial.
@@ -1950,7 +1728,7 @@ class Passive_odor_presentation(Protocol):
 
         # When mouse is showing strong side preference (ex.only licking on one side of water),
         # break current block of trials and generate a few trials for the underperformed side to motive mouse to lick
-        if len(self.responses) > 1:
+        if len(self.responses):
             lastelement = self.responses[-1]
             if lastelement == 1 or lastelement == 3 or lastelement == 5:
                 self.go_side_odor_test.append(lastelement)
@@ -1968,7 +1746,12 @@ class Passive_odor_presentation(Protocol):
 
         
         # Grab next stimulus.
-        if self.enable_blocks:
+        if self._schedule is not None:
+            planned = self._schedule.trial(self.next_trial_number)
+            self.next_stimulus = planned['stimulus']
+            self.next_free_water = planned['free_water']
+
+        elif self.enable_blocks:
             if self.LICKING_TRAINING > 0:
                 self.random_free_water_index = randint(1, 10)
                 if self.next_trial_number <= self.initial_free_water_trials:
@@ -2018,6 +1801,10 @@ class Passive_odor_presentation(Protocol):
             else:
                 self.next_nogo_free_water = False
 
+        # Free water given to break a side preference overrides the plan.
+        if self._schedule is not None and self.next_free_water != planned['free_water']:
+            self._schedule.override(self.next_trial_number, free_water=self.next_free_water)
+
     def trial_iti_milliseconds(self):
         if self.next_trial_start:
             return self.next_trial_start
@@ -2037,7 +1824,9 @@ class Passive_odor_presentation(Protocol):
 # Main - creates a database, sends parameters to controller, stores resulting data, and generates display
 #
 
-if __name__ == '__main__':
+def create_protocol(**kwtraits):
+    """ Returns the protocol with the default parameters below. kwtraits, such as
+    monitor, are set on the protocol. """
 
     # arduino parameter defaults
 
@@ -2065,26 +1854,32 @@ if __name__ == '__main__':
     water_duration2 = 150
 
     # protocol
-    protocol = Passive_odor_presentation(trial_number,
-                                         mouse,
-                                         session,
-                                         stamp,
-                                         inter_trial_interval,
-                                         trial_type_id,
-                                         max_rewards,
-                                         final_valve_duration,
-                                         response_window,
-                                         timeout_window,
-                                         odorant_trigger_phase,
-                                         lick_grace_period,
-                                         tr,
-                                         licking_training,
-                                         initial_free_water_trials,
-                                         go_free_water,
-                                         nogo_free_water,
-                                         water_duration1,
-                                         water_duration2
-                                         )
+    return Passive_odor_presentation(trial_number,
+                                     mouse,
+                                     session,
+                                     stamp,
+                                     inter_trial_interval,
+                                     trial_type_id,
+                                     max_rewards,
+                                     final_valve_duration,
+                                     response_window,
+                                     timeout_window,
+                                     odorant_trigger_phase,
+                                     lick_grace_period,
+                                     tr,
+                                     licking_training,
+                                     initial_free_water_trials,
+                                     go_free_water,
+                                     nogo_free_water,
+                                     water_duration1,
+                                     water_duration2,
+                                     **kwtraits
+                                     )
+
+
+if __name__ == '__main__':
+
+    protocol = create_protocol()
 
     # Testing code when no hardware attached.
     # GUI
@@ -0,0 +1,144 @@
+'''
+Created on 2026_10_16
+
+Defines the GrowableArray class, an append only numpy array, the
+SlidingWindowRate class, the fraction of successes over the last trials, and
+the PerformanceTracker class which keeps both for every trial category of a
+session for the performance plots.
+'''
+
+# Major library imports
+from numpy import empty, zeros, float64, int8
+
+
+class GrowableArray(object):
+    """ Append only array whose storage doubles when full.
+
+    Appending costs amortized O(1), where numpy.append copies the whole array
+    every time. data is a view of the values appended so far, ready to hand to
+    an ArrayPlotData.
+    """
+
+    def __init__(self, dtype=float64, capacity=64):
+        self._data = empty(max(int(capacity), 1), dtype=dtype)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    @property
+    def data(self):
+        """ View of the values appended so far. """
+        return self._data[:self._count]
+
+    def append(self, value):
+        """ Appends one value. """
+        if self._count == len(self._data):
+            data = empty(2 * len(self._data), dtype=self._data.dtype)
+            data[:self._count] = self._data
+            self._data = data
+        self._data[self._count] = value
+        self._count += 1
+
+    def clear(self):
+        """ Removes all values, keeping the storage. """
+        self._count = 0
+
+
+class SlidingWindowRate(object):
+    """ Fraction of successes over the last window trials.
+
+    Outcomes are kept in a fixed capacity ring with a running count of the
+    successes, so adding a trial and reading the rate are O(1).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._outcomes = zeros(window, dtype=int8)
+        self._pos = 0
+        self.count = 0
+        self.successes = 0
+
+    def add(self, success):
+        """ Adds the outcome of one trial, dropping the oldest one if the
+        window is full. """
+        success = 1 if success else 0
+        if self.count == self.window:
+            self.successes -= self._outcomes[self._pos]
+        else:
+            self.count += 1
+        self._outcomes[self._pos] = success
+        self.successes += success
+        self._pos = (self._pos + 1) % self.window
+
+    @property
+    def rate(self):
+        """ Fraction of successes in the window, 0 if it is empty. """
+        if not self.count:
+            return 0.0
+        return float(self.successes) / self.count
+
+    def clear(self):
+        self._outcomes.fill(0)
+        self._pos = 0
+        self.count = 0
+        self.successes = 0
+
+
+class PerformanceTracker(object):
+    """ Session performance of each trial category (Left/Right, Go/NoGo,
+    odorants...).
+
+    For every trial, add records whether it was correct. The tracker keeps the
+    session totals and a sliding window rate of each category, and the history
+    of the percent correct of every category after each trial for plotting
+    against trials.
+    """
+
+    def __init__(self, categories, window=400):
+        self.categories = list(categories)
+        self.window = window
+        self.windows = dict((category, SlidingWindowRate(window)) for category in self.categories)
+        # Session totals of correct and incorrect trials of each category.
+        self.hits = dict.fromkeys(self.categories, 0)
+        self.misses = dict.fromkeys(self.categories, 0)
+        # Trial numbers and percent correct of each category after each trial.
+        self.trials = GrowableArray()
+        self._lines = dict((category, GrowableArray()) for category in self.categories)
+
+    def add(self, category, correct, trial_number):
+        """ Records the outcome of trial trial_number of category. """
+        self.windows[category].add(correct)
+        if correct:
+            self.hits[category] += 1
+        else:
+            self.misses[category] += 1
+        self.trials.append(trial_number)
+        for name in self.categories:
+            self._lines[name].append(self.windows[name].rate * 100)
+
+    def line(self, category):
+        """ Percent correct of category over the sliding window, after each
+        trial. """
+        return self._lines[category].data
+
+    def percent_correct(self, category):
+        """ Percent correct of category over the whole session. """
+        total = self.hits[category] + self.misses[category]
+        if not total:
+            return 0.0
+        return 100.0 * self.hits[category] / total
+
+    def reset(self):
+        """ Forgets all trials. """
+        for category in self.categories:
+            self.windows[category].clear()
+            self.hits[category] = 0
+            self.misses[category] = 0
+            self._lines[category].clear()
+        self.trials.clear()
+
+# EOF
@@ -7,7 +7,7 @@ Defines the RangeSelectionsOverlay class which is an extension of the chaco Rang
 '''
 
 # Major library imports
-from numpy import arange, array, nonzero
+from numpy import asarray, column_stack, nonzero
 
 # Enthought library imports
 from chaco.api import arg_find_runs
@@ -27,45 +27,41 @@ class RangeSelectionsOverlay(RangeSelectionOverlay):
     #------------------------------------------------------------------------
     
     def _get_selection_screencoords(self):
-        """ Returns a tuple of (x1, x2) screen space coordinates of the start
-        and end selection points.  
-        
-        If there is no current selection, then returns None.
+        """ Returns a list of (x1, x2) screen space coordinates of the start
+        and end of each selected region.
+
+        The selection metadata is either a flat sequence of start, end pairs or
+        an (N, 2) array of intervals. All intervals are mapped to screen space
+        with a single map_screen call.
+
+        If there is no current selection, then returns [].
         """
         ds = getattr(self.plot, self.axis)
         selection = ds.metadata[self.metadata_name]
-        
-        if selection is None or len(selection) == 1:
+
+        if selection is None or len(selection) == 0:
             return []
-        # if not an even number of points, trim the last point
-        elif len(selection)%2 != 0:
-            del selection[-1]
-        
-        # "selections" metadata is a tuple of selection pairs
-        if self.metadata_name == "selections":
-            coords = []
-            for index in range(len(selection)/2):
-                interval = (selection[index*2],selection[index*2+1])
-                coords.append(self.mapper.map_screen(array(interval)))
-            return coords
-            
+        selection = asarray(selection)
+
+        # treat the metadata as a mask on dataspace
+        if (selection.ndim == 1 and self.metadata_name != "selections"
+                and len(ds._data) == len(selection)):
+            selected = nonzero(selection)[0]
+            runs = arg_find_runs(selected)
+            if not len(runs):
+                return []
+            runs = asarray(runs)
+            intervals = column_stack((ds._data[selected[runs[:, 0]]],
+                                      ds._data[selected[runs[:, 1] - 1]]))
+        # selection is pairs of selected regions in dataspace. If not an
+        # even number of points, ignore the last point.
         else:
-            selection_points = len(selection)
-            coords = []
-            # treat the metadata as a mask on dataspace
-            if len(ds._data) == selection_points:
-                selected = nonzero(selection)[0]
-                runs = arg_find_runs(selected)                
-                for run in runs:
-                    start = ds._data[selected[run[0]]]
-                    end = ds._data[selected[run[1]-1]]
-                    coords.append(self.mapper.map_screen(array((start, end))))
-                
-            # selection is tuples of selected regions in dataspace
-            else:
-                for index in range(len(selection)/2):
-                    interval = (selection[index*2],selection[index*2+1])
-                    coords.append(self.mapper.map_screen(array(interval)))
-            return coords
+            points = selection.ravel()
+            intervals = points[:len(points) // 2 * 2].reshape(-1, 2)
+
+        if not len(intervals):
+            return []
+        coords = self.mapper.map_screen(intervals.ravel()).reshape(-1, 2)
+        return list(coords)
 
 # EOF
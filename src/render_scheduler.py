@@ -0,0 +1,93 @@
+'''
+Created on 2026_10_16
+
+Defines the RenderScheduler class which limits how often the streaming plots
+are redrawn.
+'''
+
+# Python library imports
+from collections import deque
+from timeit import default_timer
+
+# Voyeur imports
+from voyeur.qtcompat import QTimer
+
+
+class RenderScheduler(object):
+    """ Coalesces plot data updates and applies them at a fixed frame rate.
+
+    Instead of calling set_data on an ArrayPlotData for every stream packet,
+    which makes Chaco redraw the plot each time, callers mark the data as
+    dirty with its newest value. Every 1/rate seconds the scheduler sets the
+    newest value of each dirty dataset once, so all the packets received in
+    between cost a single redraw.
+
+    The value can also be a function of the dataset name, called only when the
+    frame is drawn, for data that is costly to prepare. The time spent
+    updating the plots in each frame is kept for the last history frames (see
+    frame_stats), and recorded as the 'plot' stage of instrumentation, a
+    voyeur.instrumentation.Instrumentation, if one is set.
+    """
+
+    def __init__(self, rate=30.0, history=300):
+        self.rate = rate
+        # {(plot data, name): newest value}
+        self._dirty = {}
+        self._timer = None
+        # Update time in seconds of the most recent frames.
+        self.frame_times = deque(maxlen=history)
+        self.frames = 0
+        # Number of mark calls, and how many of them were superseded before
+        # they were drawn.
+        self.marks = 0
+        self.coalesced = 0
+        self.instrumentation = None
+
+    def start(self):
+        """ Starts redrawing at the configured rate. """
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.timeout.connect(self.render)
+            self._timer.start(int(1000.0 / self.rate))
+
+    def stop(self):
+        """ Stops redrawing, applying any pending update first. """
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        self.render()
+
+    def mark(self, plot_data, name, value):
+        """ Marks dataset name of plot_data as dirty with its newest value, or
+        with a function of name returning it. """
+        key = (plot_data, name)
+        if key in self._dirty:
+            self.coalesced += 1
+        self._dirty[key] = value
+        self.marks += 1
+
+    def render(self):
+        """ Applies the pending updates. Called by the timer. """
+        if not self._dirty:
+            return
+        start = default_timer()
+        dirty = self._dirty
+        self._dirty = {}
+        for (plot_data, name), value in dirty.iteritems():
+            if callable(value):
+                value = value(name)
+            plot_data.set_data(name, value)
+        elapsed = default_timer() - start
+        self.frame_times.append(elapsed)
+        self.frames += 1
+        if self.instrumentation is not None:
+            self.instrumentation.record('plot', elapsed)
+
+    def frame_stats(self):
+        """ Returns (frames, mean ms, max ms) of the update time of the recent frames. """
+        if not self.frame_times:
+            return self.frames, 0.0, 0.0
+        times = list(self.frame_times)
+        return self.frames, 1000.0 * sum(times) / len(times), 1000.0 * max(times)
+
+# EOF
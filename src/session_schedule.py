@@ -0,0 +1,124 @@
+'''
+Created on 2026_10_16
+
+Defines the SessionSchedule class, a seeded plan of every trial of a session
+(stimulus, free water, inter trial intervals) computed ahead of time.
+'''
+
+# Python library imports
+from random import Random
+
+# Major library imports
+from numpy import dtype
+
+# Local imports
+from src.performance import GrowableArray
+
+# One row of the plan.
+PLAN_DTYPE = dtype([('trial_number', 'i4'),
+                    ('stimulus_index', 'i4'),
+                    ('trial_type', 'S32'),
+                    ('odorvalve', 'i4'),
+                    ('air_flow', 'f4'),
+                    ('nitrogen_flow', 'f4'),
+                    ('free_water', 'b1'),
+                    ('iti', 'i4'),
+                    ('iti_false_alarm', 'i4')])
+
+# One override of the plan.
+OVERRIDE_DTYPE = dtype([('trial_number', 'i4'),
+                        ('field', 'S32'),
+                        ('value', 'f8')])
+
+
+class SessionSchedule(object):
+    """ Plan of the trials of a session, generated from a seed.
+
+    The plan is computed ahead of the session in blocks of trials by two
+    functions of the protocol: next_block(trial_number, rng) returns the
+    stimuli of the block starting at trial_number, and free_water(trial_number,
+    rng) whether that trial gives free water. Both draw only from rng, so the
+    same seed always gives the same plan. The inter trial interval following a
+    correct and a false alarm trial are drawn for every trial, and the one
+    matching the response is used.
+
+    Looking up a trial is O(1). Decisions taken during the session, such as
+    free water given to break a side preference, are recorded as overrides of
+    the plan instead of changing it. The plan is extended if the session runs
+    past it. Both the plan and the overrides only grow, so that the rows added
+    since they were last stored can be appended to the session file.
+    """
+
+    def __init__(self, next_block, free_water, iti_bounds, iti_bounds_false_alarm, seed=None, trials=1000):
+        if seed is None:
+            seed = Random().randint(0, 2 ** 31 - 1)
+        self.seed = seed
+        self.random = Random(seed)
+        self.next_block = next_block
+        self.free_water = free_water
+        self.iti_bounds = iti_bounds
+        self.iti_bounds_false_alarm = iti_bounds_false_alarm
+        # Distinct stimuli of the plan. Rows refer to them by index.
+        self.stimuli = []
+        self._stimulus_index = {}
+        self._block = []
+        self._plan = GrowableArray(dtype=PLAN_DTYPE, capacity=trials)
+        # {trial number: {field: value}} of the overrides of the plan.
+        self.overrides = {}
+        self._override_rows = GrowableArray(dtype=OVERRIDE_DTYPE, capacity=64)
+        self.extend(trials)
+
+    def __len__(self):
+        return len(self._plan)
+
+    @property
+    def plan(self):
+        """ Structured array of the planned trials, one row per trial. """
+        return self._plan.data
+
+    def extend(self, trials):
+        """ Plans trials more trials. """
+        for i in range(trials):
+            number = len(self._plan) + 1
+            if not self._block:
+                self._block = list(self.next_block(number, self.random))
+            stimulus = self._block.pop(0)
+            if stimulus not in self._stimulus_index:
+                self._stimulus_index[stimulus] = len(self.stimuli)
+                self.stimuli.append(stimulus)
+            row = (number,
+                   self._stimulus_index[stimulus],
+                   stimulus.trial_type,
+                   stimulus.odorvalves[0],
+                   stimulus.flows[0][0],
+                   stimulus.flows[0][1],
+                   self.free_water(number, self.random),
+                   self.random.randint(self.iti_bounds[0], self.iti_bounds[1]),
+                   self.random.randint(self.iti_bounds_false_alarm[0], self.iti_bounds_false_alarm[1]))
+            self._plan.append(row)
+
+    def trial(self, trial_number):
+        """ Dictionary of the planned parameters of trial trial_number, with
+        the overrides applied. """
+        while trial_number > len(self._plan):
+            print "Session schedule exhausted. Extending it by", max(len(self._plan), 1), "trials."
+            self.extend(max(len(self._plan), 1))
+        row = self._plan[trial_number - 1]
+        parameters = dict(zip(row.dtype.names, row.tolist()))
+        parameters['stimulus'] = self.stimuli[parameters['stimulus_index']]
+        parameters.update(self.overrides.get(trial_number, {}))
+        return parameters
+
+    def override(self, trial_number, **fields):
+        """ Overrides planned parameters of trial trial_number. """
+        self.overrides.setdefault(trial_number, {}).update(fields)
+        for field, value in sorted(fields.items()):
+            self._override_rows.append((trial_number, field, float(value)))
+
+    def overrides_array(self):
+        """ The overrides in the order they were made, as a structured array
+        of (trial_number, field, value) rows, for storage. A field overridden
+        twice has two rows, the last one applies. """
+        return self._override_rows.data
+
+# EOF
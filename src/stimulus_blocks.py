@@ -0,0 +1,119 @@
+'''
+Created on 2026_10_16
+
+Defines generate_block, which builds a block of trials from a stimulus set
+meeting run length and balance constraints directly instead of shuffling until
+a good order turns up.
+'''
+
+# Python library imports
+from random import Random
+
+
+def block_quotas(stimuli, block_size):
+    """ Default number of trials of each category in a block of block_size
+    trials: the whole stimulus set repeated as many times as it fits, at least
+    once. """
+    total = sum(len(items) for items in stimuli.values())
+    if not total:
+        raise ValueError("Stimulus set is empty! Cannot generate a block.")
+    copies = max(block_size // total, 1)
+    return dict((category, len(items) * copies) for category, items in stimuli.items() if len(items))
+
+
+def block_is_feasible(counts, max_run, last=None, run=0):
+    """ Whether the trials of counts, a dictionary of {category: count}, can
+    follow a run of run trials of category last without any category running
+    for more than max_run trials in a row. """
+    total = sum(counts.values())
+    return all(_category_fits(counts, total, category, max_run, last, run) for category in counts)
+
+
+def generate_block(stimuli, quotas=None, block_size=None, max_run=3, rng=None):
+    """ Returns a block of trials, a list of stimuli, in random order.
+
+    stimuli is a dictionary of {category: list of stimuli}, e.g. the STIMULI
+    dictionary of the protocols. quotas is a dictionary of {category: number of
+    trials} in the block; by default the whole stimulus set is repeated to fill
+    block_size trials (see block_quotas). Within a category the stimuli are
+    used equally often. No category is presented more than max_run trials in a
+    row. rng is the random.Random instance used, seeded for reproducible
+    blocks.
+
+    The block is built one trial at a time: each trial is drawn among the
+    categories that can still be placed without making the constraints
+    impossible to meet for the rest of the block, with probability proportional
+    to their remaining trials. Nothing is ever redrawn, so the cost is linear
+    in the block size. Raises ValueError if no order meets the constraints.
+    """
+    if rng is None:
+        rng = Random()
+    if quotas is None:
+        if block_size is None:
+            block_size = sum(len(items) for items in stimuli.values())
+        quotas = block_quotas(stimuli, block_size)
+    counts = dict((category, count) for category, count in quotas.items() if count > 0)
+    if not counts:
+        raise ValueError("Stimulus set is empty! Cannot generate a block.")
+    if not block_is_feasible(counts, max_run):
+        raise ValueError("No block of %s has runs of at most %d trials." % (counts, max_run))
+
+    # Stimuli of each category in the order they will be presented.
+    pending = {}
+    for category, count in counts.items():
+        items = stimuli[category]
+        if not len(items):
+            raise ValueError("No stimuli in category %s." % category)
+        order = list(items) * (count // len(items)) + rng.sample(items, count % len(items))
+        rng.shuffle(order)
+        pending[category] = order
+
+    block = []
+    last = None
+    run = 0
+    total = sum(counts.values())
+    while total:
+        # Besides the candidate itself, only the largest other category can
+        # make the rest of the block infeasible.
+        largest = sorted(counts, key=counts.get, reverse=True)[:2]
+        candidates = []
+        weights = 0
+        for category, count in counts.items():
+            if not count:
+                continue
+            new_run = run + 1 if category == last else 1
+            if new_run > max_run:
+                continue
+            counts[category] -= 1
+            feasible = all(_category_fits(counts, total - 1, other, max_run, category, new_run)
+                           for other in [category] + largest)
+            counts[category] += 1
+            if feasible:
+                candidates.append(category)
+                weights += count
+        if not candidates:
+            raise ValueError("No block of %s has runs of at most %d trials." % (quotas, max_run))
+        draw = rng.random() * weights
+        for category in candidates:
+            draw -= counts[category]
+            if draw < 0:
+                break
+        counts[category] -= 1
+        total -= 1
+        run = run + 1 if category == last else 1
+        last = category
+        block.append(pending[category].pop())
+    return block
+
+
+def _category_fits(counts, total, category, max_run, last, run):
+    """ Whether the trials of category can still be placed among the total
+    trials of counts, following a run of run trials of category last. """
+    # Each category can start one run at the beginning and one after each
+    # trial of another category. Its first run continues the current run.
+    capacity = max_run * (total - counts[category] + 1)
+    if category == last:
+        capacity -= run
+    return counts[category] <= capacity
+
+# EOF
@@ -0,0 +1,314 @@
+'''
+Created on 2026_10_16
+
+Defines the SignalRingBuffer class, a fixed size display buffer for streaming
+signals, the EventChannelRasterizer class which draws binary event channels
+(licks, trigger lines) into one, the MinMaxDecimator class which reduces a
+streaming signal to one min/max envelope column per screen pixel, and the
+IntervalMask class holding the time intervals (trials) overlaid on the plots.
+'''
+
+# Major library imports
+from numpy import empty, asarray, array, arange, concatenate, searchsorted,\
+    where, zeros, clip, repeat, fmin, fmax, vstack, nan, float64, int64
+
+
+class SignalRingBuffer(object):
+    """ Fixed size ring buffer holding the last samples of a streaming signal.
+
+    The samples are stored twice, in a mirrored array of double length, so that
+    the last size samples, oldest first, are always a contiguous slice of it.
+    data returns that slice as a view without copying, ready to hand to an
+    ArrayPlotData. Appending a packet costs time proportional to the packet,
+    not to the size of the buffer.
+
+    With channels set, the buffer holds that many signals sampled together and
+    data is a (channels, size) view.
+    """
+
+    def __init__(self, size, fill_value=nan, dtype=float64, channels=None):
+        self.size = size
+        self.channels = channels
+        if channels is None:
+            self._data = empty(2 * size, dtype=dtype)
+        else:
+            self._data = empty((channels, 2 * size), dtype=dtype)
+        self._data.fill(fill_value)
+        # Index of the oldest sample in the first copy.
+        self._pos = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def data(self):
+        """ View of the buffer contents, oldest sample first. """
+        return self._data[..., self._pos:self._pos + self.size]
+
+    @property
+    def last(self):
+        """ The most recent sample (of each channel). """
+        return self._data[..., self._pos + self.size - 1]
+
+    def append(self, values):
+        """ Appends an array of samples. Only the last size samples are kept. """
+        values = asarray(values)
+        count = values.shape[-1]
+        if count > self.size:
+            values = values[..., -self.size:]
+            count = self.size
+        self._write(values, count)
+
+    def pad(self, count, value=None):
+        """ Appends count copies of value, by default the most recent sample. """
+        count = min(int(count), self.size)
+        if count <= 0:
+            return
+        if value is None:
+            value = self.last
+        if self.channels is not None:
+            value = asarray(value).reshape(-1, 1)
+        self._write(value, count)
+
+    def overwrite(self, values):
+        """ Replaces the most recent samples with values. """
+        values = asarray(values)
+        count = values.shape[-1]
+        self._pos = (self._pos - count) % self.size
+        self._write(values, count)
+
+    def fill(self, value):
+        """ Sets every sample to value. """
+        self._data.fill(value)
+
+    def _write(self, values, count):
+        """ Writes count samples (an array or a scalar) after the most recent one. """
+        size = self.size
+        data = self._data
+        start = self._pos
+        end = start + count
+        data[..., start:end] = values
+        # Mirror the written samples into the other copy.
+        low_end = min(end, size)
+        data[..., start + size:low_end + size] = data[..., start:low_end]
+        if end > size:
+            data[..., :end - size] = data[..., size:end]
+        self._pos = end % size
+
+
+class EventChannelRasterizer(object):
+    """ Draws binary event channels, such as lick ports and trigger lines, on
+    the 1 ms sample grid of the streaming plots.
+
+    The controller reports each channel as the timestamps at which its state
+    changed. update takes the timestamps of one packet for all channels and the
+    packet time, and updates a shared SignalRingBuffer of all channels at once.
+    The state of every sample is the parity of the state changes up to it,
+    found with one searchsorted over all channels. Each channel is drawn with
+    its on value while on and its off value while off, and stays at the initial
+    fill value until its first state change.
+    """
+
+    def __init__(self, names, size, on_values, off_values, fill_value=nan):
+        self.names = list(names)
+        self.size = size
+        self.buffer = SignalRingBuffer(size, fill_value, channels=len(self.names))
+        self._on_values = array(on_values, dtype=float64).reshape(-1, 1)
+        self._off_values = array(off_values, dtype=float64).reshape(-1, 1)
+        # Current state (0 off, 1 on) of each channel.
+        self.states = zeros(len(self.names), dtype=int64)
+        # Time of the most recent sample and of the most recent state change.
+        self.last_time = 0
+        self.last_change = None
+
+    def channel(self, name):
+        """ View of the samples of a channel, oldest first. """
+        return self.buffer.data[self.names.index(name)]
+
+    def update(self, packet_time, timestamps):
+        """ Advances the channels to packet_time, applying the state changes in
+        timestamps, a dictionary of {channel name: array of times or None}.
+
+        Changes later than the packet time are applied to its last sample.
+        Changes before the previous packet time redraw the samples since then.
+        Returns False if no channel can have changed on screen.
+        """
+        size = self.size
+        count = len(self.names)
+        shift = int(min(max(packet_time - self.last_time, 0), size))
+        self.buffer.pad(shift)
+        if packet_time > self.last_time:
+            self.last_time = packet_time
+        window_start = self.last_time - size + 1
+
+        # State change positions in the window, offset by size for each channel
+        # so that all channels can be searched at once.
+        keys = []
+        for index, name in enumerate(self.names):
+            times = timestamps.get(name)
+            if times is None or not len(times):
+                continue
+            positions = clip(asarray(times, dtype=int64) - window_start, 0, size - 1)
+            positions.sort()
+            keys.append(positions + index * size)
+            if self.last_change is None or times[-1] > self.last_change:
+                self.last_change = int(times[-1])
+        if not keys:
+            return self.last_change is not None and self.last_time - self.last_change < size
+        keys = concatenate(keys)
+
+        first = int((keys % size).min())
+        samples = arange(first, size)
+        offsets = arange(count) * size
+        changes = searchsorted(keys, (offsets.reshape(-1, 1) + samples).ravel(), 'right').reshape(count, -1)
+        changes -= searchsorted(keys, offsets, 'left').reshape(-1, 1)
+        states = (self.states.reshape(-1, 1) + changes) & 1
+        values = where(states, self._on_values, self._off_values)
+        self.buffer.overwrite(where(changes > 0, values, self.buffer.data[:, first:]))
+        self.states = (self.states + changes[:, -1]) & 1
+        return True
+
+
+class MinMaxDecimator(object):
+    """ Keeps the min/max envelope of the last columns * samples_per_column
+    samples of a streaming signal, one column per screen pixel.
+
+    Appending a packet updates the column being filled and adds the columns it
+    completes, so the cost is proportional to the packet. The envelope is
+    plotted as a line through the minimum and maximum of each column in turn,
+    which costs 2 * columns points whatever the window length. The display
+    scrolls by whole columns; x_of maps sample times onto the same quantized
+    axis so that overlays stay aligned with the plotted data.
+    """
+
+    def __init__(self, columns, samples_per_column, fill_value=nan):
+        self.columns = columns
+        self.samples_per_column = samples_per_column
+        # Rows are the minimum and maximum of each column. The last column is
+        # the one being filled.
+        self._envelope = SignalRingBuffer(columns, fill_value, channels=2)
+        self._filled = samples_per_column
+        self._last_value = fill_value
+        # Number of columns started so far. The plots scroll by one column
+        # each time it increases.
+        self.columns_started = 0
+        if samples_per_column > 1:
+            self._y = empty(2 * columns)
+            self._y.fill(fill_value)
+
+    def axis(self, seconds_per_sample=0.001):
+        """ The abscissa values of the plotted envelope, in seconds. """
+        x = arange(1, self.columns + 1) * (self.samples_per_column * seconds_per_sample)
+        if self.samples_per_column == 1:
+            return x
+        return repeat(x, 2)
+
+    def y(self):
+        """ The ordinate values of the plotted envelope. """
+        envelope = self._envelope.data
+        if self.samples_per_column == 1:
+            return envelope[1]
+        self._y[0::2] = envelope[0]
+        self._y[1::2] = envelope[1]
+        return self._y
+
+    def x_of(self, times, newest_time, seconds_per_sample=0.001):
+        """ Abscissa values of the sample times given the time of the newest
+        sample, on the axis returned by axis. """
+        column_start = newest_time - self._filled + 1
+        return (self.columns * self.samples_per_column + asarray(times) - column_start) * seconds_per_sample
+
+    def append(self, values):
+        """ Appends an array of samples. """
+        values = asarray(values, dtype=float64)
+        if not len(values):
+            return
+        self._last_value = values[-1]
+        spc = self.samples_per_column
+        # Finish the column being filled.
+        if self._filled < spc:
+            head = values[:spc - self._filled]
+            values = values[len(head):]
+            if len(head):
+                last = self._envelope.last
+                self._envelope.overwrite([[fmin(last[0], fmin.reduce(head))], [fmax(last[1], fmax.reduce(head))]])
+                self._filled += len(head)
+        if not len(values):
+            return
+        # Whole columns, then the start of a new one. Columns that would scroll
+        # off screen right away are skipped.
+        full = len(values) // spc
+        remainder = len(values) - full * spc
+        if full > self.columns:
+            skipped = full - self.columns
+            values = values[skipped * spc:]
+            self.columns_started += skipped
+            full = self.columns
+        columns = []
+        if full:
+            block = values[:full * spc].reshape(full, spc)
+            columns.append(array([fmin.reduce(block, axis=1), fmax.reduce(block, axis=1)]))
+        if remainder:
+            tail = values[full * spc:]
+            columns.append(array([[fmin.reduce(tail)], [fmax.reduce(tail)]]))
+        self._envelope.append(concatenate(columns, axis=1))
+        self.columns_started += full + (1 if remainder else 0)
+        self._filled = remainder if remainder else spc
+
+    def pad(self, count, value=None):
+        """ Appends count copies of value, by default the most recent sample. """
+        count = int(count)
+        if count <= 0:
+            return
+        # Only the samples that can still be on screen matter. Skip whole
+        # columns so that the column boundaries do not move.
+        limit = (self.columns + 1) * self.samples_per_column
+        if count > limit:
+            skipped = (count - limit) // self.samples_per_column + 1
+            count -= skipped * self.samples_per_column
+            self.columns_started += skipped
+        if value is None:
+            value = self._last_value
+        values = empty(count)
+        values.fill(value)
+        self.append(values)
+
+
+class IntervalMask(object):
+    """ Time intervals, such as trials, in stream sample times (controller ms).
+
+    The intervals are kept as an (N, 2) array of start and end times, so
+    nothing needs to change when the plots scroll. Intervals that have left
+    the window are culled, and the rest are clipped and mapped to the plot
+    axis in single vectorized operations.
+    """
+
+    def __init__(self):
+        self.intervals = empty((0, 2), dtype=int64)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, start, end):
+        """ Adds the interval [start, end]. """
+        self.intervals = vstack((self.intervals, [[start, end]]))
+
+    def cull(self, window_start):
+        """ Drops the intervals that end before window_start. """
+        keep = self.intervals[:, 1] >= window_start
+        if not keep.all():
+            self.intervals = self.intervals[keep]
+
+
+def decimate_minmax(values, samples_per_column):
+    """ Interleaved min/max envelope of values (a whole number of columns
+    long), ignoring nans, as plotted by MinMaxDecimator. """
+    if samples_per_column == 1:
+        return values
+    block = asarray(values).reshape(-1, samples_per_column)
+    y = empty(2 * len(block))
+    y[0::2] = fmin.reduce(block, axis=1)
+    y[1::2] = fmax.reduce(block, axis=1)
+    return y
+
+# EOF
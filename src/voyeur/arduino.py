@@ -4,29 +4,82 @@ import struct
 import db
 import platform
 import socket
-from Queue import Queue
-from PyQt4.QtCore import QThread
-from numpy import array, int32, float32, append, ndarray, int16
+import select
+import threading
+from collections import deque
+from Queue import Queue, Empty
+from timeit import default_timer
+from voyeur.qtcompat import QThread
+from numpy import array, int32, float32, append, ndarray, int16, frombuffer, dtype
 from serial import Serial, SerialException
 from configobj import ConfigObj
 import voyeur.exceptions as ex
 
+# Clock used for serial read deadlines. time.monotonic is only available from python 3.3
+monotonic = getattr(time, 'monotonic', default_timer)
+
+
+# Priority lanes of SerialCallThread. Lower values are served first.
+COMMAND_PRIORITY = 0  # trial control, events and user commands. Never blocks the caller
+STREAM_PRIORITY = 1  # stream polling. Bounded, the caller waits for room
+
 
 class SerialCallThread(QThread):
         '''
         This thread serializes communication across a single serial port.
 
-        Calls are serialized and performed on a separate thread.
+        Calls are serialized and performed on a separate thread. Each call waits in the lane of its
+        priority, and the next call is always taken from the highest priority lane that has one, so
+        control commands preempt the stream polling. The stream lane holds at most max_queue_size calls
+        and enqueue waits for room, which paces the acquisition thread. The command lane is unbounded
+        and enqueue_command returns at once, so the UI thread never waits on the serial port.
         '''
 
         def __init__(self, monitor=None, max_queue_size = 1, QObject_parent=None):
             QThread.__init__(self, QObject_parent)
             self.monitor = monitor
-            self.output_queue = Queue(maxsize=max_queue_size)
+            self.max_queue_size = max_queue_size
+            self._lanes = {COMMAND_PRIORITY: deque(), STREAM_PRIORITY: deque()}
+            self._lock = threading.Condition()
+            # {priority: LaneStats}
+            self.stats = dict((priority, LaneStats()) for priority in self._lanes)
 
         def enqueue(self, fn, *args, **kwargs):
+            '''Queues a stream call, waiting while the stream lane is full'''
             #print "Enqueuing: ", fn
-            self.output_queue.put((fn, args, kwargs), block=True)
+            self._put(STREAM_PRIORITY, (fn, args, kwargs))
+
+        def enqueue_command(self, fn, *args, **kwargs):
+            '''Queues a control call ahead of all stream calls. Never blocks'''
+            self._put(COMMAND_PRIORITY, (fn, args, kwargs))
+
+        def empty(self):
+            with self._lock:
+                return not any(self._lanes.values())
+
+        def _put(self, priority, call):
+            lane = self._lanes[priority]
+            with self._lock:
+                if priority == STREAM_PRIORITY:
+                    while len(lane) >= self.max_queue_size:
+                        self._lock.wait()
+                lane.append((monotonic(), call))
+                self.stats[priority].queued(len(lane))
+                self._lock.notify_all()
+
+        def _get(self, timeout):
+            '''Removes and returns the next call, or None if none arrives within timeout seconds'''
+            with self._lock:
+                if not any(self._lanes.values()):
+                    self._lock.wait(timeout)
+                for priority in sorted(self._lanes):
+                    lane = self._lanes[priority]
+                    if lane:
+                        queued_time, call = lane.popleft()
+                        self.stats[priority].served(monotonic() - queued_time)
+                        self._lock.notify_all()
+                        return call
+            return None
 
         def run(self):
             try:
@@ -35,17 +88,38 @@ class SerialCallThread(QThread):
             except ImportError:
                 pass # Windows
 
-            while self.monitor.running or not self.output_queue.empty():
-                """print "Serializer running: ", time.clock()
-                print "max size: ", self.output_queue.maxsize
-                print "items: ", self.output_queue.qsize()
-                print "Getting item from queue: ", time.clock()"""
-
-                (output_fn, args, kwargs) = self.output_queue.get(block=True, timeout=0.5) # block 0.5 seconds
-                #print "Got item in queue: ", time.clock()
-                #print "queue function starting: ", time.clock()
+            while self.monitor.running or not self.empty():
+                call = self._get(timeout=0.5) # block 0.5 seconds
+                if call is None:
+                    # Nothing to send, e.g. while the controller is pushing the stream on its own.
+                    continue
+                output_fn, args, kwargs = call
                 output_fn(*args, **kwargs)
-                #print "queue function return: ", time.clock()
+
+
+class LaneStats(object):
+    '''Queue depth and wait time statistics of one SerialCallThread lane'''
+
+    def __init__(self):
+        self.calls = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def queued(self, depth):
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def served(self, wait):
+        self.calls += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+
+    def summary(self):
+        '''(calls, maximum depth, mean wait ms, maximum wait ms)'''
+        mean_wait = 1000.0 * self.total_wait / self.calls if self.calls else 0.0
+        return self.calls, self.max_depth, mean_wait, 1000.0 * self.max_wait
 
 
 class SerialPort(object):
@@ -59,10 +133,25 @@ class SerialPort(object):
     # Keep a counter of packets that arrive later than NOLOSSTRANSMISSIONRATE, indicating buffer overflown in arduino_controller
     overflownpackets = 0
 
-    def __init__(self, configFile, board = 'board1', port='port1', send_trial_number = False):
+    # Seconds to wait for the binary part of a stream packet before the packet is considered lost
+    STREAM_READ_TIMEOUT = 0.65
+
+    # Decoder compiled from the last stream definition seen by request_stream
+    _decoder = None
+    # Packer compiled from the last controller parameters seen by start_trial
+    _packer = None
+    # Reader thread used while the controller is pushing the stream (see start_streaming)
+    _reader = None
+    # voyeur.instrumentation.Instrumentation recording the request, receive and decode latencies, if any
+    instrumentation = None
+
+    def __init__(self, configFile, board = 'board1', port='port1', send_trial_number = False, path=None):
         """Takes the string name of the serial port
         (e.g. "/dev/tty.usbserial","COM1") and a baud rate (bps) and
         connects to that port at that speed.
+
+        path overrides the serial port configured for this host, e.g. to connect to the pseudo-terminal
+        of a voyeur.emulator.ArduinoEmulator.
         """
         # Flag for denoting wether to send trial number to arduino_controller. This depends on protocol and if the trial number is used
         # or further forwarded from arduino_controller to an acquisition device
@@ -71,7 +160,10 @@ class SerialPort(object):
         serial = self.config['serial']
         baudrate = serial['baudrate']
         self.board = self.config['platform'][board]
-        serialport  = serial[socket.gethostname()][port]
+        if path is None:
+            serialport  = serial[socket.gethostname()][port]
+        else:
+            serialport = path
         if os.path.exists(serialport) or platform.win32_ver()[0] != '':
             self.serial = Serial(serialport, baudrate, timeout=1)
         else:
@@ -79,6 +171,9 @@ class SerialPort(object):
 
     def read_line(self):
         """Reads the serial buffer"""
+        if self._reader is not None:
+            # While streaming in push mode the reader thread owns the port and queues the replies.
+            return self._reader.read_line(self.serial.timeout)
         line = None
         try:
             line = self.serial.readline()
@@ -87,57 +182,122 @@ class SerialPort(object):
             print(e)
         return line
 
-    def read_byte_streams(self, num_bytes,tries=8):
-        count = 0
-        #print num_bytes
-        while self.serial.inWaiting() != num_bytes and count < tries: #wait until number of bytes in recieve buffer is equal to expected number of bytes.
-            # Reading the serial stream is part of the separate serial acquisition thread and will not break or make the UI lag
-            if tries <= 8:
-                time.sleep(0.01+.01*count**2)# blocks for 1 second, with exponentially increasing checks.(10ms,20ms,50ms,100ms...)
-            else:    # If tries was higher than 8, wait the minimum set time of 10ms
-                time.sleep(0.01)
-            count += 1
-            
-        if self.serial.inWaiting() == num_bytes: # when buffer is ready, read and return.
-            bytestream = self.serial.read(num_bytes)
-            if len(bytestream) == num_bytes:
-                return bytestream
-        # TODO: Take partially transmitted data but warn of data loss?? Implement a retry protocol?
-        else: # if buffer never fills to expected value, do not read the packet, instead flush the incoming serial of partial packet and return.
-            #print "serial buffer has ", self.serial.inWaiting(), "bytes"
-            self.serial.flushInput()
-            print 'ERROR in serial stream acquisition: not enough bytes transmitted by arduino'
-            return None
+    def read_byte_streams(self, num_bytes, timeout=None):
+        """
+        Blocks until num_bytes are received or the read deadline passes.
 
+        Returns as soon as all bytes have arrived. Bytes transmitted beyond num_bytes are left in the
+        receive buffer for the next frame. If the deadline passes first, the partial packet is discarded,
+        the input is flushed to resynchronize with the controller and None is returned.
+
+        Only the bytes already received are read, so the port timeout is never changed: setting it
+        reconfigures the port, which would cost system calls on every packet.
+        """
+        if timeout is None:
+            timeout = self.STREAM_READ_TIMEOUT
+        deadline = monotonic() + timeout
+        bytestream = ''
+        while len(bytestream) < num_bytes:
+            waiting = self.serial.inWaiting()
+            if waiting:
+                bytestream += self.serial.read(min(waiting, num_bytes - len(bytestream)))
+                continue
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            self._wait_readable(remaining)
+
+        if len(bytestream) == num_bytes:
+            return bytestream
+        # TODO: Take partially transmitted data but warn of data loss?? Implement a retry protocol?
+        #print "serial buffer has ", self.serial.inWaiting(), "bytes"
+        self.serial.flushInput()
+        print 'ERROR in serial stream acquisition: not enough bytes transmitted by arduino'
+        return None
+
+    def _wait_readable(self, timeout):
+        """Waits at most timeout seconds for received bytes"""
+        if os.name == 'posix':
+            select.select([self.serial.fileno()], [], [], timeout)
+        else:
+            # Windows cannot select on a serial port handle
+            time.sleep(min(timeout, 0.001))
 
     def write(self, data):
         """Writes *data* string to serial"""
         self.serial.write(data)
 
+    def record_latency(self, stage, seconds):
+        """Records the duration of a pipeline stage, if instrumented"""
+        if self.instrumentation is not None:
+            self.instrumentation.record(stage, seconds)
+
     def request_stream(self, stream_def, tries=10):
         """Reads stream"""
         #print "Stream request to serial: ", time.clock()
         for i in range(tries):
             #print "try: ", i
+            start = default_timer()
             self.write(chr(87))
             packets = self.read_line()
+            self.record_latency('request', default_timer() - start)
             
-            # Collect statistics about the transmission rate and lost packets
-            streamtime = time.clock()
-            rate = streamtime - self.lastStreamTime
-            #print "Stream received: ", rate
-            # Skip the first measurement as that depends on when the user starts the streaming and
-            #  the first transmission will for sure overflow the buffer
-            if self.lastStreamTime > 0:
-                if rate > self.maxRate:
-                    self.maxRate = rate
-                if rate > self.NOLOSSTRANSMISSIONRATE:
-                    self.overflownpackets += 1
-            self.lastStreamTime = streamtime
+            self.record_stream_time()
             #print "Stream returned: ", packets, " time: ", time.clock()
             #print packets
             return parse_serial(packets, stream_def, self)
 
+    def record_stream_time(self):
+        """Collect statistics about the transmission rate and lost packets"""
+        streamtime = time.clock()
+        rate = streamtime - self.lastStreamTime
+        #print "Stream received: ", rate
+        # Skip the first measurement as that depends on when the user starts the streaming and
+        #  the first transmission will for sure overflow the buffer
+        if self.lastStreamTime > 0:
+            if rate > self.maxRate:
+                self.maxRate = rate
+            if rate > self.NOLOSSTRANSMISSIONRATE:
+                self.overflownpackets += 1
+        self.lastStreamTime = streamtime
+
+    def start_streaming(self, stream_def, packet_buffer, on_packets=None, on_end_of_trial=None, on_error=None):
+        """
+        Switches the controller to push mode.
+
+        The controller then sends stream packets continuously. A StreamReaderThread decodes them into
+        packet_buffer and calls on_packets when the buffer goes from empty to non empty. on_end_of_trial
+        is called when the controller signals the end of a trial, and on_error(exception) if the port fails
+        and the reader stops. Returns True if the controller acknowledged.
+        """
+        if self._reader is not None:
+            return True
+        self.write(chr(92))
+        line = self.read_line()
+        if not (line and line[:1] == '2'):
+            return False
+        self._reader = StreamReaderThread(self, stream_def, packet_buffer, on_packets, on_end_of_trial, on_error)
+        self._reader.running = True
+        self._reader.start()
+        return True
+
+    def stop_streaming(self):
+        """Switches the controller back to request mode and stops the reader thread"""
+        if self._reader is None:
+            return True
+        self.write(chr(93))
+        line = self.read_line()
+        reader = self._reader
+        reader.stop()
+        self._reader = None
+        return bool(line) and line[:1] == '2'
+
+    def stream_decoder(self, stream_def):
+        """Returns a StreamDecoder for stream_def, compiling it only when the definition changes"""
+        if self._decoder is None or self._decoder.stream_definition != stream_def:
+            self._decoder = StreamDecoder(stream_def)
+        return self._decoder
+
     def request_event(self, event_def, tries=10):
         """Reads event data"""
         for i in range(tries):
@@ -146,21 +306,23 @@ class SerialPort(object):
             #print packets
             return parse_serial(packets, event_def, self)
 
+    def parameter_packer(self, parameters):
+        """
+        Returns a ParameterPacker for the controller parameters (or their definition), compiling it only
+        when the parameter names change
+        """
+        if self._packer is None or self._packer.keys != set(parameters):
+            # trial number is needed for some protocols which send the trial parameter to arduino_controller
+            # arduino_controller can make use of this or send it via serial to an acquisition device.
+            self._packer = ParameterPacker(parameters, self.send_trial_number)
+        return self._packer
+
     def start_trial(self, parameters, tries=10):
         """Sends start command"""
-        params = convert_format(parameters)
-         # trial number is needed for some protocols which send the trial parameter to arduino_controller
-         # arduino_controller can make use of this or send it via serial to an acquisition device.
-        if not self.send_trial_number:
-            params.pop("trialNumber")
-        values = params.values()
-        values.sort()
+        frame = self.parameter_packer(parameters).pack(parameters)
         #print "Starting trial..."
         for i in range(tries):
-            self.write(chr(90))
-            for index, format, value in values:
-                #print value
-                self.write(pack_integer(format, value))
+            self.write(frame)
             line = self.read_line()
             #print line
             if line and int(line[:1]) == 2:
@@ -224,6 +386,228 @@ class SerialPort(object):
         """Close the serial connection"""
         self.serial.close()
 
+class StreamReaderThread(QThread):
+        '''
+        This thread reads the stream packets pushed continuously by the controller.
+
+        Stream packets are decoded into a PacketRingBuffer. All other lines are replies to commands and are
+        queued for SerialPort.read_line, except the end of trial code (5) which calls on_end_of_trial.
+        If the port fails the thread stops and calls on_error with the exception.
+        '''
+
+        def __init__(self, serial_port, stream_def, packet_buffer, on_packets=None, on_end_of_trial=None,
+                     on_error=None, QObject_parent=None):
+            QThread.__init__(self, QObject_parent)
+            self.serial_port = serial_port
+            self.stream_def = stream_def
+            self.packet_buffer = packet_buffer
+            self.on_packets = on_packets
+            self.on_end_of_trial = on_end_of_trial
+            self.on_error = on_error
+            self.replies = Queue()
+            self.running = False
+
+        def read_line(self, timeout=None):
+            """Returns the next reply line, or an empty string if none arrives within timeout seconds"""
+            try:
+                return self.replies.get(block=True, timeout=timeout)
+            except Empty:
+                return ''
+
+        def stop(self):
+            """Stops reading and waits for the thread to finish"""
+            self.running = False
+            self.wait()
+
+        def run(self):
+            try:
+                from Foundation import NSAutoreleasePool
+                pool = NSAutoreleasePool.alloc().init()
+            except ImportError:
+                pass # Windows
+
+            parser = StreamFrameParser()
+            decoder = self.serial_port.stream_decoder(self.stream_def)
+            port = self.serial_port.serial
+            while self.running:
+                try:
+                    # Blocks for at most the port timeout when nothing is waiting.
+                    data = port.read(max(1, port.inWaiting()))
+                except SerialException as e:
+                    print('pySerial exception in stream reader')
+                    print(e)
+                    self.running = False
+                    if self.on_error is not None:
+                        self.on_error(e)
+                    break
+                for frame in parser.feed(data):
+                    if frame[0] == 'stream':
+                        self.serial_port.record_stream_time()
+                        start = default_timer()
+                        packet = decoder.decode(frame[2], frame[1])
+                        self.serial_port.record_latency('decode', default_timer() - start)
+                        if self.packet_buffer.put(packet) and self.on_packets is not None:
+                            self.on_packets()
+                    elif frame[1].startswith('5,'):
+                        if self.on_end_of_trial is not None:
+                            self.on_end_of_trial()
+                    else:
+                        self.replies.put(frame[1])
+
+
+class StreamFrameParser(object):
+    """
+    Incremental parser splitting the bytes received from the controller into frames.
+
+    Text lines are returned as ('line', line). A stream packet header line is followed by a binary payload
+    of the size given in the header; the packet is returned as ('stream', bytes_per_stream, payload) once
+    the whole payload has been received.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        # Byte counts of the stream packet whose payload is being received
+        self._pending = None
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of frames completed by them"""
+        self._buffer += data
+        frames = []
+        while True:
+            if self._pending is not None:
+                size = sum(self._pending)
+                if len(self._buffer) < size:
+                    break
+                frames.append(('stream', self._pending, self._buffer[:size]))
+                self._buffer = self._buffer[size:]
+                self._pending = None
+                continue
+            end = self._buffer.find('\n')
+            if end < 0:
+                break
+            line = self._buffer[:end + 1]
+            self._buffer = self._buffer[end + 1:]
+            bytes_per_stream = parse_stream_header(line)
+            if bytes_per_stream is None:
+                frames.append(('line', line))
+            else:
+                self._pending = bytes_per_stream
+        return frames
+
+
+def parse_stream_header(line):
+    """
+    Returns the list of byte counts of a stream packet header line (6,num_streams,bytes1,bytes2,...),
+    or None if line is not a stream header. Replies that use handshake 6 are terminated by '*'.
+    """
+    if not line.startswith('6,') or '*' in line:
+        return None
+    payload = line.split(',')
+    num_streams = int(payload[1])
+    return [int(num_bytes) for num_bytes in payload[2:2 + num_streams]]
+
+
+# Little-endian numpy equivalents of the arduino types used in stream definitions
+ARDUINO_DTYPES = {
+    'int': dtype('<i2'),
+    'unsigned int': dtype('<u2'),
+    'long': dtype('<i4'),
+    'unsigned long': dtype('<u4'),
+}
+
+
+class StreamDecoder(object):
+    """
+    Decoder for the binary payload of a stream packet (handshake 6).
+
+    The stream definition {name => (index, arduinoType, db.Type)} is compiled once into an index ordered
+    list of fields with their wire and destination dtypes. Decoding a packet then only computes the byte
+    offsets from the packet header and views each slice of the payload with numpy.frombuffer.
+    """
+
+    def __init__(self, stream_definition):
+        self.stream_definition = stream_definition
+        self.fields = []
+        for key, (index, arduinoType, kind) in sorted(stream_definition.items(), key=lambda item: item[1][0]):
+            wire_dtype = ARDUINO_DTYPES[arduinoType]
+            if type(kind) == ndarray:
+                # Variable length stream stored as an array of the db array type
+                self.fields.append((key, index, wire_dtype, kind.dtype, False))
+            elif type(kind) == type(db.Int):
+                # Scalar stream, returned as a python int when a single value is sent
+                self.fields.append((key, index, wire_dtype, None, True))
+            else:
+                self.fields.append((key, index, wire_dtype, None, False))
+
+    def decode(self, bytestream, bytes_per_stream):
+        """
+        Decode bytestream into a dictionary of {name => value}.
+
+        bytes_per_stream is the list of byte counts from the packet header, in stream index order.
+        Streams with no bytes, or all streams if bytestream is None, decode to None.
+        """
+        data = {}
+        if bytestream is None:
+            for key, index, wire_dtype, target_dtype, scalar in self.fields:
+                data[key] = None
+            return data
+
+        offsets = [0]
+        for num_bytes in bytes_per_stream:
+            offsets.append(offsets[-1] + num_bytes)
+
+        for key, index, wire_dtype, target_dtype, scalar in self.fields:
+            start = offsets[index - 1]
+            end = offsets[index]
+            if start == end: # expecting empty stream, so set output to None.
+                data[key] = None
+                continue
+            values = frombuffer(bytestream, dtype=wire_dtype, count=(end - start) // wire_dtype.itemsize,
+                                offset=start)
+            if target_dtype is not None:
+                data[key] = values.astype(target_dtype)
+            elif scalar and len(values) == 1:
+                data[key] = int(values[0])
+            else:
+                data[key] = values.astype(wire_dtype.newbyteorder('='))
+        return data
+
+
+# struct format codes of the db types sent as controller parameters
+PARAMETER_CODES = {type(db.Int): 'i',  # signed 32 bit int (arduino long)
+                   type(db.Int16): 'h',
+                   type(db.Float): 'f',
+                   type(db.String32): 's',
+                   type(db.StringN): 's',
+                   type(db.Time): 'd'}
+
+
+class ParameterPacker(object):
+    """
+    Packer for the start trial frame: the start command (90) followed by the controller parameters.
+
+    The controller parameters {name => (index, db.Type)} are laid out once, in index order, into a single
+    little-endian struct.Struct. Parameters {name => (index, db.Type, value)} of a trial are then packed
+    into the whole frame with one call, sent with a single write.
+    """
+
+    def __init__(self, parameters, send_trial_number=True):
+        self.keys = set(parameters)
+        fields = sorted((spec[0], key, spec[1]) for key, spec in parameters.items()
+                        if send_trial_number or key != "trialNumber")
+        codes = []
+        for index, key, kind in fields:
+            if type(kind) not in PARAMETER_CODES:
+                raise ValueError("No serial format for controller parameter " + key)
+            codes.append(PARAMETER_CODES[type(kind)])
+        self.names = [key for index, key, kind in fields]
+        self.struct = struct.Struct('<' + ''.join(codes))
+
+    def pack(self, parameters):
+        """Returns the start trial frame for parameters"""
+        return chr(90) + self.struct.pack(*[parameters[name][2] for name in self.names])
+
+
 def parse_serial(packets, protocol_def, serial_obj):
     """Parse serial read"""
     #print "packet: ", packets
@@ -263,66 +647,15 @@ def parse_serial(packets, protocol_def, serial_obj):
                         bytes_per_stream.append(int(payload[1+stream_number]))
                     bytes_to_read = sum(bytes_per_stream)
                     #print "Reading ", bytes_to_read, " bytes"
+                    start = default_timer()
                     bytestream = serial_obj.read_byte_streams(bytes_to_read)
-                    
+                    received = default_timer()
+                    serial_obj.record_latency('receive', received - start)
+
                     if bytestream == None: # failure, no streams recieved,
-                        for key, (index, arduinoType, kind) in protocol_def.items():
-                            data[key] = None
                         print 'Lost packet: no data received'
-                    
-                    byte_index_start = 0
-                    
-                    for key, (index, arduinoType, kind) in protocol_def.items():
-                        #data[key] =  convert_type(kind, payload[index])
-                        if bytes_per_stream[index-1] == 0: # expecting empty stream, so set output to None.
-                            data[key] = None
-                            continue
-                        
-                        byte_index_start = sum(bytes_per_stream[:(index-1)])
-                        byte_index_end = sum(bytes_per_stream[:(index)])
-                        stream_bytes = bytestream[byte_index_start:byte_index_end]
-                        unpacked_stream =[]
-                        
-                        ## unpack the bytes into integers based on the type specified in the stream_definition.
-                        if arduinoType == 'int': # h for short integers
-                            num_vals = len(stream_bytes)/2
-                            t = "<%ih" % (num_vals) # little-endian,number of integers,signed int
-                            vals = struct.unpack(t,stream_bytes)
-                            unpacked_stream = array(vals,dtype = int16)
-                                
-                        elif arduinoType == 'unsigned int': #H 
-                            num_vals = len(stream_bytes)/2
-                            t = "<%iH" % (num_vals) # little-endian(<),number of integers,unsigned int (H)
-                            vals = struct.unpack(t,stream_bytes)
-                            unpacked_stream = list(vals)
-                            
-                        elif arduinoType == 'long': # i
-                            num_vals = len(stream_bytes)/4
-                            t = "<%ii" % (num_vals) # little-endian(<),number of integers,unsigned int (i)
-                            vals = struct.unpack(t,stream_bytes)
-                            unpacked_stream = list(vals)
-                                
-                        elif arduinoType == 'unsigned long': #I
-                            num_vals = len(stream_bytes)/4
-                            t = "<%iI" % (num_vals) # little-endian(<),number of integers,unsigned int (H)
-                            vals = struct.unpack(t,stream_bytes)   
-                            unpacked_stream = list(vals)                            
-                        
-                        if type(kind) != type(db.Int): 
-                            if type(kind) == ndarray:
-                                if kind.dtype == int16:
-                                    unpacked_stream = append(db.Int16Array, unpacked_stream)
-                                elif kind.dtype == float32:
-                                    unpacked_stream = [float(i) for i in unpacked_stream]
-                                    unpacked_stream = append(db.FloatArray, unpacked_stream)
-                                elif kind.dtype == int32:
-                                    unpacked_stream = append(db.IntArray, unpacked_stream)
-                                
-                        
-                        elif len(unpacked_stream) == 1:
-                            unpacked_stream = int(unpacked_stream[0])
-                                
-                        data[key] = unpacked_stream;         
+                    data = serial_obj.stream_decoder(protocol_def).decode(bytestream, bytes_per_stream)
+                    serial_obj.record_latency('decode', default_timer() - received)
         if eot:
             exp = ex.EndOfTrialException('End of trial')
             exp.last_read = data
@@ -330,25 +663,6 @@ def parse_serial(packets, protocol_def, serial_obj):
     return data
 
 
-def convert_format(parameters):
-    """Converts dictionary database type format to serial transmission format"""
-    values = parameters.copy()
-    for key, (index, format, value) in values.items():
-        if type(format) == type(db.Int):
-            values[key] = (index, 'i', value)  # signed 32 bit int (arduino long)
-        elif type(format) == type(db.Int16):
-            values[key] = (index, 'h', value)
-        elif type(format) == type(db.Float):
-            values[key] = (index, 'f', value)
-        elif type(format) == type(db.String32):
-            values[key] = (index, 's', value)
-        elif type(format) == type(db.StringN):
-            values[key] = (index, 's', value)
-        elif type(format) == type(db.Time):
-            values[key] = (index, 'd', value)
-    return values
-
-
 def convert_type(kind, value):
     """Converts string to python type"""
     if type(kind) == type(db.Int):
@@ -379,15 +693,6 @@ def convert_type(kind, value):
     return value
 
 
-def pack_integer(format, value):
-    """Packs integer as a binary string
-       I = python 4 byte unsigned integer to an arduino unsigned long
-       h = python 2 byte short to an arduino integer
-    """
-
-    return struct.pack(format, value)
-
-
 def strip_tuple(dict):
     """Ensures the tuple in the dictionary does not have third value"""
     values = dict.values()
@@ -0,0 +1,98 @@
+import threading
+
+
+# Policies applied by PacketRingBuffer.put when the buffer is full
+DROP_OLDEST = 'drop_oldest'  # overwrite the oldest packet, the producer never waits
+DROP_NEWEST = 'drop_newest'  # discard the packet being put, the producer never waits
+BLOCK = 'block'  # wait up to the put timeout for the consumer, then discard the packet being put
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class PacketRingBuffer(object):
+    """
+    Fixed capacity ring buffer of stream packets shared between an acquisition thread and the UI thread.
+
+    Slots are preallocated at construction. The producer puts packets one at a time and the consumer
+    drains them in batches. What happens when the buffer is full is set by policy (see POLICIES); with
+    the default DROP_OLDEST a stalled consumer never blocks the serial thread.
+    """
+
+    def __init__(self, capacity=4096, policy=DROP_OLDEST, timeout=0.1):
+        if policy not in POLICIES:
+            raise ValueError("Unknown buffer policy: " + str(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.timeout = timeout
+        self._slots = [None] * capacity
+        self._head = 0  # index of the oldest packet
+        self._count = 0
+        lock = threading.Lock()
+        self._not_empty = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+        # Number of packets overwritten before they were drained
+        self.overflows = 0
+        # Number of packets discarded when put into a full buffer
+        self.dropped = 0
+        # Largest number of packets waiting at once
+        self.high_water = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, packet):
+        """
+        Adds packet to the buffer.
+
+        Returns True if the buffer was empty before the put, i.e. the consumer needs to be notified.
+        """
+        with self._not_empty:
+            if self._count == self.capacity and self.policy == BLOCK:
+                self._not_full.wait(self.timeout)
+            was_empty = self._count == 0
+            if self._count == self.capacity:
+                if self.policy == DROP_OLDEST:
+                    self._slots[self._head] = packet
+                    self._head = (self._head + 1) % self.capacity
+                    self.overflows += 1
+                else:
+                    self.dropped += 1
+                    return False
+            else:
+                self._slots[(self._head + self._count) % self.capacity] = packet
+                self._count += 1
+                if self._count > self.high_water:
+                    self.high_water = self._count
+            self._not_empty.notify()
+        return was_empty
+
+    def drain(self, max_packets=None):
+        """Removes and returns up to max_packets (default all) packets, oldest first"""
+        with self._not_empty:
+            count = self._count
+            if max_packets is not None and max_packets < count:
+                count = max_packets
+            packets = []
+            for i in range(count):
+                index = (self._head + i) % self.capacity
+                packets.append(self._slots[index])
+                self._slots[index] = None
+            self._head = (self._head + count) % self.capacity
+            self._count -= count
+            if count:
+                self._not_full.notify()
+        return packets
+
+    def wait(self, timeout=None):
+        """Blocks until at least one packet is available or timeout seconds pass. Returns True if not empty"""
+        with self._not_empty:
+            if self._count == 0:
+                self._not_empty.wait(timeout)
+            return self._count > 0
+
+    def clear(self):
+        """Discards all buffered packets"""
+        with self._not_empty:
+            self._slots = [None] * self.capacity
+            self._head = 0
+            self._count = 0
+            self._not_full.notify()
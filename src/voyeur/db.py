@@ -1,7 +1,10 @@
 import time
 import os.path
+import threading
 import tables
-from numpy import array, ndarray, int32, float32, int16
+from Queue import Queue, Empty
+from timeit import default_timer
+from numpy import array, ndarray, int32, float32, int16, concatenate
 from datetime import datetime
 
 # Column types
@@ -26,13 +29,125 @@ Int16Array = array([], dtype = int16)
 ExperimentGroup = tables.group
 ProtocolGroup = tables.group
 
+# On-disk layouts, stored in the "layout" attribute of the root group. Files without the attribute use the trial layout.
+TRIAL_LAYOUT = 'trial'  # a TrialNNNN group with one VLArray per stream channel and an Events table per trial
+SESSION_LAYOUT = 'session'  # one EArray per stream channel and one Events table for the whole session
+
 """Persistent Format And Database Operations"""
 
 
+class StorageSettings(object):
+    """
+    Compression and chunking of the datasets created by a Persistor.
+
+    complib, complevel and shuffle are the defaults for every dataset. datasets maps a dataset name
+    ('Trials', 'Events', 'TrialIndex' or a stream channel such as 'sniff') to a dict overriding any of
+    complib, complevel, shuffle, rate, expectedrows and chunkshape for that dataset. rate is the
+    declared number of rows written per second: samples per second for a session layout channel,
+    packets per second for Events. Expected rows are sized from the rate and session_seconds, and
+    chunks hold chunk_seconds worth of rows. Datasets without a rate keep the given defaults.
+
+    Example::
+        StorageSettings(complib='blosc', complevel=5, session_seconds=2 * 3600,
+                        datasets={'sniff': {'rate': 1000}, 'Events': {'rate': 100}})
+    """
+
+    def __init__(self, complib='zlib', complevel=0, shuffle=True, session_seconds=3600, chunk_seconds=10.0,
+                 datasets=None):
+        self.complib = complib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.session_seconds = session_seconds
+        self.chunk_seconds = chunk_seconds
+        self.datasets = datasets or {}
+
+    @classmethod
+    def from_config(cls, section):
+        """
+        Creates settings from the [storage] section of the rig config file, e.g.
+
+        [storage]
+            complib = blosc
+            complevel = 5
+            session_seconds = 7200
+            [[sniff]]
+                rate = 1000
+        """
+        kwargs = {}
+        datasets = {}
+        for key, value in section.items():
+            if isinstance(value, dict):
+                datasets[key] = dict((name, _parse_setting(name, v)) for name, v in value.items())
+            else:
+                kwargs[key] = _parse_setting(key, value)
+        return cls(datasets=datasets, **kwargs)
+
+    def setting(self, name, key, default=None):
+        """Value of key for dataset name, falling back to default"""
+        return self.datasets.get(name, {}).get(key, default)
+
+    def rate(self, name):
+        """Declared rows per second of dataset name, or None"""
+        return self.setting(name, 'rate')
+
+    def filters(self, name):
+        """tables.Filters for dataset name"""
+        return tables.Filters(complevel=self.setting(name, 'complevel', self.complevel),
+                              complib=self.setting(name, 'complib', self.complib),
+                              shuffle=self.setting(name, 'shuffle', self.shuffle))
+
+    def expectedrows(self, name, default):
+        """Expected number of rows of dataset name over a whole session"""
+        expectedrows = self.setting(name, 'expectedrows')
+        if expectedrows is not None:
+            return expectedrows
+        rate = self.rate(name)
+        if rate:
+            return int(rate * self.session_seconds)
+        return default
+
+    def chunkshape(self, name, default, rate=None):
+        """
+        Rows per chunk of dataset name. rate overrides the declared rate, e.g. the packet rate for
+        the VLArrays of the trial layout, whose rows are packets.
+        """
+        chunkshape = self.setting(name, 'chunkshape')
+        if chunkshape is not None:
+            return chunkshape
+        if rate is None:
+            rate = self.rate(name)
+        if rate:
+            return max(1, int(rate * self.chunk_seconds))
+        return default
+
+
+def _parse_setting(key, value):
+    """Converts a string value read from the rig config file"""
+    if not isinstance(value, basestring):
+        return value
+    if key == 'complib':
+        return value
+    if key == 'shuffle':
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if key in ('rate', 'session_seconds', 'chunk_seconds'):
+        return float(value)
+    return int(value)
+
+
 class Persistor(object):
     """Database helper class"""
     
     h5file = None
+    # Flush the file after every stream packet and event. PersistorWriter turns this off and flushes
+    # according to its own policy.
+    auto_flush = True
+
+    def __init__(self, storage=None):
+        # Compression and chunking of new datasets
+        self.storage = storage or StorageSettings()
+        # Parameters of the current trial. Its Trials row is written once, by insert_event.
+        self._trial_row = None
+        self._trials_table = None
 
     def create_database(self, filename, metadata):
         """
@@ -71,7 +186,8 @@ class Persistor(object):
                                     'Trials',
                                     trial_columns_definition,
                                     description,
-                                    expectedrows = 500)
+                                    filters = self.storage.filters('Trials'),
+                                    expectedrows = self.storage.expectedrows('Trials', 500))
  
             self.h5file.flush()
             
@@ -84,6 +200,7 @@ class Persistor(object):
                     description):
         """Add a trial"""
         
+        self._write_trial_row()
         trial_group = self.h5file.create_group(session_group,
                                                 "Trial" + str(trial_number).zfill(4),
                                                 description)
@@ -105,40 +222,56 @@ class Persistor(object):
                                     'Events',
                                     stream_def,
                                     "Stream Data",
-                                    chunkshape = 256)
+                                    filters = self.storage.filters('Events'),
+                                    chunkshape = self.storage.chunkshape('Events', 256))
                                     
         #print protocol_parameters
         #print strip_tuple_from_dict(controller_parameters)
         trial_parameters = dict(protocol_parameters.items() 
                                 + strip_tuple_from_dict(controller_parameters).items())
         #print trial_parameters
-        parameters = session_group.Trials.row
         trial_group._v_attrs.trialIndex = len(session_group.Trials)
-        #print parameters
-        for key, value in trial_parameters.items():
-            #print key, value
-            parameters[key] = value
-        parameters.append()
-        session_group.Trials.flush()
-        self.h5file.flush()
+        self._buffer_trial_row(trial_parameters, session_group)
+        if self.auto_flush:
+            self.h5file.flush()
         return trial_group
         
     def insert_event(self, event, trial_group):
-        """Inserts event values"""
-        rowindex = trial_group.Trials.nrows-1
-        row = trial_group.Trials[rowindex]
+        """
+        Inserts event values.
 
-        for key, value in event.iteritems():
-            row[key] = value
+        The Trials row of the current trial is written here, once, with the trial parameters and the
+        event values. An event arriving after the row was written only updates its event columns.
+        """
+        if self._trial_row is not None:
+            self._write_trial_row(event)
+        else:
+            rowindex = trial_group.Trials.nrows-1
+            for key, value in event.iteritems():
+                trial_group.Trials.modify_column(start=rowindex, stop=rowindex+1, column=[value], colname=key)
+            trial_group.Trials.flush()
 
-        row = array(row,ndmin=1)
-        trial_group.Trials.modify_rows(start=rowindex, stop=rowindex+1, rows=row)
-        trial_group.Trials.flush()
-        """for index in range(trial_group.Trials.nrows):
-            print trial_group.Trials[index]"""
-            
+        if self.auto_flush:
+            self.h5file.flush()
 
-        self.h5file.flush()        
+    def _buffer_trial_row(self, trial_parameters, session_group):
+        """Keeps the parameters of a new trial until its event arrives"""
+        self._trial_row = trial_parameters
+        self._trials_table = session_group.Trials
+
+    def _write_trial_row(self, event=None):
+        """Appends the Trials row of the current trial, if not written yet"""
+        if self._trial_row is None:
+            return
+        values = dict(self._trial_row)
+        if event:
+            values.update(event)
+        row = self._trials_table.row
+        for key, value in values.iteritems():
+            row[key] = value
+        row.append()
+        self._trials_table.flush()
+        self._trial_row = None
 
     def insert_stream(self, stream, trial_group):
         """Inserts stream data values"""
@@ -153,20 +286,56 @@ class Persistor(object):
                 #row = trial_group.Events.row
                 row[key] = value
         row.append()
-        trial_group.Events.flush()
-        self.h5file.flush()
+        if self.auto_flush:
+            trial_group.Events.flush()
+            self.h5file.flush()
+
+    def flush(self):
+        """Writes all buffered rows and arrays to disk"""
+        if self.h5file is not None and self.h5file.isopen:
+            self.h5file.flush()
 
     def store_array(self, name, description, array, group):
         """Stores a homogenous array in a group"""
         self.h5file.create_array(group, name, array, description)
 
+    def store_table(self, name, description, array, group):
+        """Stores a numpy structured array as a table in a group"""
+        self.h5file.create_table(group, name, obj=array, title=description,
+                                 filters=self.storage.filters(name))
+
+    def append_table(self, name, description, array, group):
+        """Appends the rows of a numpy structured array to a table of a group, created if missing"""
+        if name in group:
+            table = group._f_get_child(name)
+            table.append(array)
+        else:
+            table = self.h5file.create_table(group, name, obj=array, title=description,
+                                             filters=self.storage.filters(name))
+        table.flush()
+
+    def store_session_arrays(self, arrays, group):
+        """Stores a dictionary of {name: array} in a group, structured arrays as tables"""
+        for name, array in arrays.iteritems():
+            if array.dtype.names:
+                self.store_table(name, '', array, group)
+            else:
+                self.store_array(name, '', array, group)
+        self.h5file.flush()
+
+    def store_group_arrays(self, name, description, arrays, group):
+        """Stores a dictionary of {name: array} in a new subgroup name of a group"""
+        subgroup = self.h5file.create_group(group, name, description)
+        self.store_session_arrays(arrays, subgroup)
+
     def create_VLIntArray(self, name, array, group):
         """Stores a homogenous variable length integer array in a group"""
         self.h5file.create_vlarray(group,
                                     name,
                                     tables.Int32Atom(),
                                     "ragged array of ints",
-                                    chunkshape = 512)
+                                    filters = self.storage.filters(name),
+                                    chunkshape = self.storage.chunkshape(name, 512, self.storage.rate('Events')))
 
     def create_VLFloatArray(self, name, array, group):
         """Stores a homogenous variable length float array in a group"""
@@ -174,7 +343,8 @@ class Persistor(object):
                                     name,
                                     tables.Float32Atom(),
                                     "ragged array of floats",
-                                    chunkshape = 512)
+                                    filters = self.storage.filters(name),
+                                    chunkshape = self.storage.chunkshape(name, 512, self.storage.rate('Events')))
 
     def create_VLInt16Array(self, name, array, group):
         """Stores a homogenous variable length float array in a group"""
@@ -182,7 +352,8 @@ class Persistor(object):
                                     name,
                                     tables.Int16Atom(),
                                     "ragged array of floats",
-                                    chunkshape = 512)
+                                    filters = self.storage.filters(name),
+                                    chunkshape = self.storage.chunkshape(name, 512, self.storage.rate('Events')))
                                                                     
     def open_database(self, name, mode):
         """Open HDF5 database"""
@@ -192,6 +363,8 @@ class Persistor(object):
             self.h5file = tables.open_file(name + ".h5", mode = mode)
                     
     def close_database(self):
+        # A trial that ended without an event still gets its Trials row
+        self._write_trial_row()
         self.h5file.close()
 
     def timestamp(self):
@@ -223,6 +396,343 @@ class Persistor(object):
         return self.h5file.filename
 
 
+class _PendingCall(object):
+    """Result of a call made through PersistorWriter.call"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PersistorWriter(threading.Thread):
+    """
+    Performs all database operations of a Persistor on a dedicated thread.
+
+    PyTables is not thread safe, so once the writer is running every Persistor call has to go
+    through it. Calls are queued in order on a bounded queue: submit returns immediately, call waits
+    for the result. Stream packets are written without flushing; the file is flushed once
+    flush_packets packets or flush_bytes bytes have been written since the last flush, or
+    flush_interval seconds have passed, whichever comes first. Events are flushed as soon as they
+    are written.
+
+    Trials are added with add_trial, which does not wait either: the writer keeps the group of the
+    last trial added and writes the stream packets queued after it there.
+    """
+
+    def __init__(self, persistor, max_queue_size=1000, flush_packets=200, flush_bytes=1 << 20, flush_interval=1.0):
+        threading.Thread.__init__(self, name='PersistorWriter')
+        self.daemon = True
+        self.set_persistor(persistor)
+        self.queue = Queue(maxsize=max_queue_size)
+        self.flush_packets = flush_packets
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._pending_packets = 0
+        self._pending_bytes = 0
+        self._last_flush = default_timer()
+        # Group of the last trial added by add_trial. Only used on the writer thread
+        self.trial_group = None
+        # Statistics
+        self.packets_written = 0
+        self.flushes = 0
+        self.errors = 0
+        # voyeur.instrumentation.Instrumentation recording the time to write each batch of packets, if any
+        self.instrumentation = None
+
+    def set_persistor(self, persistor):
+        """Performs the database operations with persistor from now on. Only while no database is open"""
+        self.persistor = persistor
+        self.persistor.auto_flush = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) for the writer thread. Blocks only while the queue is full"""
+        self.queue.put((fn, args, kwargs, None), block=True)
+
+    def call(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the writer thread after everything queued before it and returns the result"""
+        pending = _PendingCall()
+        self.queue.put((fn, args, kwargs, pending), block=True)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def add_trial(self, *args, **kwargs):
+        """Queues Persistor.add_trial. The stream packets queued after it are written to the new trial"""
+        self.submit(self._add_trial, *args, **kwargs)
+
+    def insert_streams(self, streams, trial_group=None):
+        """Queues a batch of stream packets for trial_group, by default the group of the last trial added"""
+        self.submit(self._write_streams, streams, trial_group)
+
+    def insert_event(self, event, trial_group):
+        """Queues an event. The file is flushed right after the event is written"""
+        self.submit(self.persistor.insert_event, event, trial_group)
+        self.submit(self.flush)
+
+    def drain(self):
+        """Waits until everything queued so far is written and flushed to disk"""
+        self.call(self.flush)
+
+    def stop(self):
+        """Drains the queue and ends the thread"""
+        if self.is_alive():
+            self.queue.put(None, block=True)
+            self.join()
+
+    def flush(self):
+        """Flushes the database file. Runs on the writer thread"""
+        self.persistor.flush()
+        self._pending_packets = 0
+        self._pending_bytes = 0
+        self._last_flush = default_timer()
+        self.flushes += 1
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(block=True, timeout=self.flush_interval)
+            except Empty:
+                if self._pending_packets:
+                    self.flush()
+                continue
+            if item is None:
+                if self._pending_packets:
+                    self.flush()
+                self.queue.task_done()
+                break
+            fn, args, kwargs, pending = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if pending is None:
+                    self.errors += 1
+                    print "Database write failed: ", fn.__name__, e
+                else:
+                    pending.error = e
+            else:
+                if pending is not None:
+                    pending.result = result
+            if pending is not None:
+                pending.done.set()
+            self.queue.task_done()
+            if self._pending_packets and (self._pending_packets >= self.flush_packets
+                                          or self._pending_bytes >= self.flush_bytes
+                                          or default_timer() - self._last_flush >= self.flush_interval):
+                self.flush()
+
+    def _add_trial(self, *args, **kwargs):
+        """Adds a trial and keeps its group. Runs on the writer thread"""
+        # Packets of a trial that could not be added must not end up in the previous trial
+        self.trial_group = None
+        self.trial_group = self.persistor.add_trial(*args, **kwargs)
+
+    def _write_streams(self, streams, trial_group):
+        """Writes a batch of stream packets. Runs on the writer thread"""
+        if trial_group is None:
+            trial_group = self.trial_group
+            if trial_group is None:
+                raise ValueError("No trial group to write the stream packets to")
+        start = default_timer()
+        for stream in streams:
+            self.persistor.insert_stream(stream, trial_group)
+            self._pending_packets += 1
+            self._pending_bytes += stream_nbytes(stream)
+        self.packets_written += len(streams)
+        if self.instrumentation is not None:
+            self.instrumentation.record('persistence', default_timer() - start)
+
+
+def stream_nbytes(stream):
+    """Approximate number of bytes a stream packet adds to the database"""
+    nbytes = 0
+    for value in stream.itervalues():
+        if type(value) == ndarray:
+            nbytes += value.nbytes
+        elif value is not None:
+            nbytes += 4
+    return nbytes
+
+
+class SessionPersistor(Persistor):
+    """
+    Persistor writing the session contiguous layout.
+
+    Instead of a TrialNNNN group per trial, the session has:
+
+    /Streams/<channel>  one EArray per array stream channel, holding every sample of the session
+    /Events             one row per stream packet with the scalar stream values, the trial number and,
+                        for every channel, the <channel>_offset of the packet's first sample
+    /TrialIndex         one row per trial with its row in Trials and the first Events row and
+                        <channel>_start sample of the trial
+
+    A whole session of one channel is then a single contiguous read. Use read_trial_stream and
+    read_session_stream to read either layout.
+    """
+
+    # Expected number of rows of the session wide arrays and tables without a declared rate
+    expected_session_rows = 1000000
+
+    _channels = None
+    _trial_number = 0
+
+    def create_database(self, filename, metadata):
+        self._channels = None
+        session_group = Persistor.create_database(self, filename, metadata)
+        session_group._f_setattr('layout', SESSION_LAYOUT)
+        return session_group
+
+    def add_trial(self,
+                    trial_number,
+                    protocol_parameters,
+                    controller_parameters,
+                    stream_definition,
+                    session_group,
+                    description):
+        """Add a trial. Returns the session group, which holds the stream data of every trial"""
+
+        self._write_trial_row()
+        if self._channels is None:
+            self._create_streams(stream_definition, session_group)
+        self._trial_number = trial_number
+
+        index = session_group.TrialIndex.row
+        index['trial_number'] = trial_number
+        index['trial_index'] = len(session_group.Trials)
+        index['events_start'] = session_group.Events.nrows
+        for name in self._channels:
+            index[name + '_start'] = session_group.Streams._f_get_child(name).nrows
+        index.append()
+        session_group.TrialIndex.flush()
+
+        trial_parameters = dict(protocol_parameters.items()
+                                + strip_tuple_from_dict(controller_parameters).items())
+        self._buffer_trial_row(trial_parameters, session_group)
+        if self.auto_flush:
+            self.h5file.flush()
+        return session_group
+
+    def insert_stream(self, stream, trial_group):
+        """Inserts stream data values"""
+        row = trial_group.Events.row
+        row['trial'] = self._trial_number
+        for name in self._channels:
+            row[name + '_offset'] = trial_group.Streams._f_get_child(name).nrows
+        for key, value in stream.iteritems():
+            if type(value) == ndarray:
+                trial_group.Streams._f_get_child(key).append(value)
+            elif value is not None:
+                row[key] = value
+        row.append()
+        if self.auto_flush:
+            trial_group.Events.flush()
+            self.h5file.flush()
+
+    def _create_streams(self, stream_definition, session_group):
+        """Creates the session wide stream arrays, Events and TrialIndex tables"""
+        stream_def = strip_tuple_from_dict(stream_definition) or {}
+        self._channels = []
+        events_def = {'trial': Int}
+        index_def = {'trial_number': Int,
+                     'trial_index': Int,
+                     'events_start': tables.Int64Col()}
+        streams_group = self.h5file.create_group(session_group, 'Streams', "Stream Data")
+        for name, kind in stream_def.items():
+            if type(kind) == ndarray:
+                chunkshape = self.storage.chunkshape(name, None)
+                self.h5file.create_earray(streams_group,
+                                          name,
+                                          tables.Atom.from_dtype(kind.dtype),
+                                          (0,),
+                                          name,
+                                          filters=self.storage.filters(name),
+                                          expectedrows=self.storage.expectedrows(name, self.expected_session_rows),
+                                          chunkshape=(chunkshape,) if chunkshape else None)
+                self._channels.append(name)
+                events_def[name + '_offset'] = tables.Int64Col()
+                index_def[name + '_start'] = tables.Int64Col()
+            else:
+                events_def[name] = kind
+        self.h5file.create_table(session_group,
+                                 'Events',
+                                 events_def,
+                                 "Stream Data",
+                                 filters=self.storage.filters('Events'),
+                                 expectedrows=self.storage.expectedrows('Events', self.expected_session_rows),
+                                 chunkshape=self.storage.chunkshape('Events', None))
+        self.h5file.create_table(session_group,
+                                 'TrialIndex',
+                                 index_def,
+                                 "First Events row and stream sample of each trial",
+                                 filters=self.storage.filters('TrialIndex'))
+
+
+def database_layout(h5file):
+    """Layout of an open database file, TRIAL_LAYOUT or SESSION_LAYOUT"""
+    return getattr(h5file.root._v_attrs, 'layout', TRIAL_LAYOUT)
+
+
+def trial_numbers(h5file):
+    """Numbers of the trials stored in an open database file, in order"""
+    if database_layout(h5file) == SESSION_LAYOUT:
+        return list(h5file.root.TrialIndex.col('trial_number'))
+    return sorted(int(name[5:]) for name in h5file.root._v_groups if name.startswith('Trial'))
+
+
+def read_trial_events(h5file, trial_number):
+    """Events rows (one per stream packet) of a trial as a structured array"""
+    root = h5file.root
+    if database_layout(h5file) == SESSION_LAYOUT:
+        start, stop = _trial_range(h5file, trial_number, 'events_start', root.Events.nrows)
+        return root.Events.read(start, stop)
+    return root._f_get_child("Trial" + str(trial_number).zfill(4)).Events.read()
+
+
+def read_trial_stream(h5file, trial_number, name):
+    """All samples of stream channel name recorded during a trial, as one array"""
+    root = h5file.root
+    if database_layout(h5file) == SESSION_LAYOUT:
+        channel = root.Streams._f_get_child(name)
+        start, stop = _trial_range(h5file, trial_number, name + '_start', channel.nrows)
+        return channel.read(start, stop)
+    vlarray = root._f_get_child("Trial" + str(trial_number).zfill(4))._f_get_child(name)
+    return _concatenate_rows(vlarray)
+
+
+def read_session_stream(h5file, name):
+    """All samples of stream channel name recorded during the session, as one array"""
+    root = h5file.root
+    if database_layout(h5file) == SESSION_LAYOUT:
+        return root.Streams._f_get_child(name).read()
+    vlarrays = [root._f_get_child("Trial" + str(number).zfill(4))._f_get_child(name)
+                for number in trial_numbers(h5file)]
+    if not vlarrays:
+        return array([])
+    return concatenate([_concatenate_rows(vlarray) for vlarray in vlarrays])
+
+
+def _trial_range(h5file, trial_number, column, total):
+    """(start, stop) of a trial in a session wide array, from the TrialIndex column holding trial starts"""
+    index = h5file.root.TrialIndex
+    numbers = index.col('trial_number')
+    rows = (numbers == trial_number).nonzero()[0]
+    if not len(rows):
+        raise KeyError("No trial " + str(trial_number))
+    row = rows[-1]
+    starts = index.col(column)
+    stop = starts[row + 1] if row + 1 < len(starts) else total
+    return int(starts[row]), int(stop)
+
+
+def _concatenate_rows(vlarray):
+    """Concatenates the rows (stream packets) of a VLArray"""
+    rows = vlarray.read()
+    if not rows:
+        return array([], dtype=vlarray.atom.dtype)
+    return concatenate(rows)
+
+
 def strip_tuple_from_dict(dict):
     """ Calls the correct tuple stripper"""
     if dict:
@@ -0,0 +1,346 @@
+'''
+Pseudo-terminal stand-in for the behaviour controller (arduino_controller).
+
+ArduinoEmulator opens a pty pair and answers the Voyeur serial protocol on the master side, so that a
+SerialPort opened on the slave side (SerialPort(..., path=emulator.port_name)) behaves as if a rig was
+connected. It produces synthetic sniff, lick and MRI trigger streams and can run faster than real time
+and drop packets on purpose, to load-test Monitor, Persistor and the protocols on a headless machine.
+
+Only available on platforms with pty support (Linux, OS X).
+
+Example:
+    python -m voyeur.emulator --speed 10 --packet-loss 0.01
+'''
+
+import os
+import pty
+import tty
+import time
+import select
+import struct
+import random
+import threading
+from timeit import default_timer
+from numpy import arange, sin, pi
+from numpy.random import RandomState
+
+monotonic = getattr(time, 'monotonic', default_timer)
+
+# Command codes sent by voyeur.arduino.SerialPort
+USER_COMMAND = 86
+STREAM = 87
+EVENT = 88
+END = 89
+START = 90
+PROTOCOL_NAME = 91
+START_PUSH = 92
+STOP_PUSH = 93
+
+
+class ArduinoEmulator(object):
+    """
+    Emulates a behaviour controller running the Passive_odor_presentation sketch.
+
+    Parameters:
+        protocol_name   : name returned for the protocol name request (91)
+        sniff_rate      : sniff samples per second of emulated time
+        lick_rate       : mean licks per second on each lick channel
+        mri_rate        : MRI trigger pulses per second
+        speed           : emulated milliseconds per wall-clock millisecond (10 = ten times real time)
+        trial_duration  : emulated milliseconds from parameter reception to end of trial
+        num_parameters  : number of 4 byte parameters read after a start trial command (90)
+        packet_loss     : probability that a stream packet starts a loss burst
+        loss_burst      : number of consecutive packets lost in each burst
+        loss_mode       : 'gap' drops the packet data from the stream, 'truncate' sends the header
+                          with only half of the payload
+        push_interval   : emulated milliseconds between packets in push mode (92)
+        responses       : response codes chosen at random at the end of each trial
+        seed            : seed for the random number generator, for reproducible runs
+    """
+
+    def __init__(self,
+                 protocol_name='Passive_exposure_2AFC',
+                 sniff_rate=1000,
+                 lick_rate=2.0,
+                 mri_rate=1.0,
+                 speed=1.0,
+                 trial_duration=5000,
+                 num_parameters=12,
+                 packet_loss=0.0,
+                 loss_burst=1,
+                 loss_mode='gap',
+                 push_interval=10,
+                 responses=(1, 2, 3, 4, 5, 6),
+                 seed=None):
+        self.protocol_name = protocol_name
+        self.sniff_rate = sniff_rate
+        self.lick_rate = lick_rate
+        self.mri_rate = mri_rate
+        self.speed = speed
+        self.trial_duration = trial_duration
+        self.num_parameters = num_parameters
+        self.packet_loss = packet_loss
+        self.loss_burst = loss_burst
+        self.loss_mode = loss_mode
+        self.push_interval = push_interval
+        self.responses = responses
+        self.random = random.Random(seed)
+        self._noise = RandomState(seed)
+
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+
+        # Statistics
+        self.packets_sent = 0
+        self.packets_lost = 0
+        self.commands = []
+
+        self._thread = None
+        self.running = False
+        self._reset()
+
+    def _reset(self):
+        self._start_time = monotonic()
+        self._last_sent_ms = 0
+        self._last_push_ms = 0
+        self._push = False
+        self._lost_remaining = 0
+        self._licks = [[], []]
+        self._next_lick = [self._next_interval(self.lick_rate), self._next_interval(self.lick_rate)]
+        self._mri = []
+        self._next_mri = self._next_interval(self.mri_rate, regular=True)
+        self._trial_running = False
+        self._trial_done = False
+        self._send_last_packet = False
+        self._event = (0, 0, 0, 0, 0, 0)
+        self._parameters_received_time = 0
+
+    #--------------------------------------------------------------------------
+    # Life cycle
+    #--------------------------------------------------------------------------
+
+    def start(self):
+        """Starts answering on the pseudo-terminal in a background thread"""
+        self.running = True
+        self._thread = threading.Thread(target=self.run, name='ArduinoEmulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port_name
+
+    def stop(self):
+        """Stops the background thread and closes the pseudo-terminal"""
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def run(self):
+        while self.running:
+            timeout = 0.1
+            if self._push:
+                timeout = max(0.0, (self._last_push_ms + self.push_interval - self.now()) / (1000.0 * self.speed))
+            readable, _, _ = select.select([self.master_fd], [], [], timeout)
+            if readable:
+                # One command code at a time: commands 86 and 90 read their own arguments.
+                self.handle_command(ord(os.read(self.master_fd, 1)))
+            if self._push and self.now() - self._last_push_ms >= self.push_interval:
+                self._last_push_ms = self.now()
+                self.send_stream_packet()
+
+    def now(self):
+        """Emulated controller time in milliseconds (totalms)"""
+        return int((monotonic() - self._start_time) * 1000 * self.speed)
+
+    #--------------------------------------------------------------------------
+    # Serial protocol
+    #--------------------------------------------------------------------------
+
+    def handle_command(self, code):
+        if code == USER_COMMAND:
+            self.commands.append(self._read_until('\r'))
+            self._write_line('2,*')
+        elif code == STREAM:
+            self.send_stream_packet()
+        elif code == EVENT:
+            self._write_line('4,' + ','.join(str(value) for value in self._event) + ',*')
+        elif code == END:
+            self._trial_running = False
+            self._write_line('3,*')
+        elif code == START:
+            self._read_exact(4 * self.num_parameters)
+            self._write_line('2,*')
+            self._parameters_received_time = self.now()
+            self._trial_running = True
+            self._trial_done = False
+            self._send_last_packet = False
+        elif code == PROTOCOL_NAME:
+            self._write_line('6,' + self.protocol_name + ',*')
+        elif code == START_PUSH:
+            self._push = True
+            self._last_push_ms = self.now()
+            self._write_line('2,*')
+        elif code == STOP_PUSH:
+            self._push = False
+            self._write_line('2,*')
+
+    def send_stream_packet(self):
+        """Sends a stream packet, or the end of trial code, the same way case 87 of the sketch does"""
+        # One time for the whole packet: every event up to packet_sent_time is in it
+        now = self.now()
+        self._update_trial(now)
+        if self._trial_done and self._send_last_packet:
+            self._write_line('5,*')
+            self._trial_done = False
+            self._send_last_packet = False
+            return
+        elif self._trial_done:
+            self._send_last_packet = True
+
+        sniff = self._sniff_samples(self._last_sent_ms, now)
+        lick1 = self._take_events(self._licks[0], now)
+        lick2 = self._take_events(self._licks[1], now)
+        mri = self._take_events(self._mri, now)
+        self._last_sent_ms = now
+
+        lost = False
+        if self._lost_remaining == 0 and self.packet_loss and self.random.random() < self.packet_loss:
+            self._lost_remaining = self.loss_burst
+        if self._lost_remaining > 0:
+            self._lost_remaining -= 1
+            self.packets_lost += 1
+            lost = True
+            if self.loss_mode == 'gap':
+                return
+        payload = struct.pack('<IH', now, len(sniff)) \
+            + sniff.tostring() \
+            + struct.pack('<%dI' % len(lick1), *lick1) \
+            + struct.pack('<%dI' % len(lick2), *lick2) \
+            + struct.pack('<%dI' % len(mri), *mri)
+        header = '6,6,4,2,%d,%d,%d,%d' % (2 * len(sniff), 4 * len(lick1), 4 * len(lick2), 4 * len(mri))
+        if lost:
+            payload = payload[:len(payload) // 2]
+        self._write_line(header)
+        self._write(payload)
+        self.packets_sent += 1
+
+    #--------------------------------------------------------------------------
+    # Synthetic signals
+    #--------------------------------------------------------------------------
+
+    def _update_trial(self, now):
+        self._generate_events(now)
+        if self._trial_running and now - self._parameters_received_time >= self.trial_duration:
+            trial_start = self._parameters_received_time + self.trial_duration // 4
+            final_valve_onset = trial_start + 10
+            response = self.random.choice(self.responses)
+            first_lick = final_valve_onset + self.random.randint(100, 1000) if response < 5 else 0
+            self._event = (self._parameters_received_time, trial_start, now, final_valve_onset, response,
+                           first_lick)
+            self._trial_running = False
+            self._trial_done = True
+
+    def _next_interval(self, rate, regular=False):
+        if not rate:
+            return None
+        if regular:
+            return int(1000.0 / rate)
+        return int(self.random.expovariate(rate) * 1000) + 1
+
+    def _generate_events(self, now):
+        """Schedules the lick (onset/offset pairs) and MRI trigger timestamps up to now"""
+        for channel in range(2):
+            while self._next_lick[channel] is not None and self._next_lick[channel] <= now:
+                onset = self._next_lick[channel]
+                offset = onset + self.random.randint(20, 80)
+                self._licks[channel].extend((onset, offset))
+                self._next_lick[channel] = offset + self._next_interval(self.lick_rate)
+        while self._next_mri is not None and self._next_mri <= now:
+            self._mri.append(self._next_mri)
+            self._next_mri += self._next_interval(self.mri_rate, regular=True)
+
+    def _take_events(self, events, now):
+        """Removes and returns the timestamps up to now. A lick onset is held back until its offset is sent"""
+        count = 0
+        while count < len(events) and events[count] <= now:
+            count += 1
+        if events is not self._mri and count % 2:
+            count -= 1
+        taken = events[:count]
+        del events[:count]
+        return taken
+
+    def _sniff_samples(self, start_ms, end_ms):
+        """Synthetic breathing signal sampled at sniff_rate between two emulated times, as int16"""
+        num_samples = max(0, int((end_ms - start_ms) * self.sniff_rate / 1000.0))
+        t = (start_ms + arange(1, num_samples + 1) * 1000.0 / self.sniff_rate) / 1000.0
+        noise = self._noise.normal(0, 10, num_samples)
+        return (300 * sin(2 * pi * 3 * t) + noise).astype('<i2')
+
+    #--------------------------------------------------------------------------
+    # pty I/O
+    #--------------------------------------------------------------------------
+
+    def _write(self, data):
+        while data:
+            written = os.write(self.master_fd, data)
+            data = data[written:]
+
+    def _write_line(self, line):
+        self._write(line + '\r\n')
+
+    def _read_exact(self, num_bytes, timeout=0.05):
+        data = ''
+        deadline = monotonic() + timeout
+        while len(data) < num_bytes and monotonic() < deadline:
+            readable, _, _ = select.select([self.master_fd], [], [], max(0.0, deadline - monotonic()))
+            if readable:
+                data += os.read(self.master_fd, num_bytes - len(data))
+        return data
+
+    def _read_until(self, terminator, timeout=0.05):
+        data = ''
+        deadline = monotonic() + timeout
+        while not data.endswith(terminator) and monotonic() < deadline:
+            readable, _, _ = select.select([self.master_fd], [], [], max(0.0, deadline - monotonic()))
+            if readable:
+                data += os.read(self.master_fd, 1)
+        return data.rstrip(terminator)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Emulate a Voyeur behaviour controller on a pseudo-terminal.')
+    parser.add_argument('--protocol-name', default='Passive_exposure_2AFC')
+    parser.add_argument('--sniff-rate', type=int, default=1000, help='sniff samples per second')
+    parser.add_argument('--lick-rate', type=float, default=2.0, help='licks per second per lick channel')
+    parser.add_argument('--mri-rate', type=float, default=1.0, help='MRI trigger pulses per second')
+    parser.add_argument('--speed', type=float, default=1.0, help='emulated time per wall-clock time')
+    parser.add_argument('--trial-duration', type=int, default=5000, help='trial duration in ms')
+    parser.add_argument('--packet-loss', type=float, default=0.0, help='probability of a loss burst')
+    parser.add_argument('--loss-burst', type=int, default=1, help='packets lost in each burst')
+    parser.add_argument('--loss-mode', choices=('gap', 'truncate'), default='gap')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    emulator = ArduinoEmulator(protocol_name=args.protocol_name,
+                               sniff_rate=args.sniff_rate,
+                               lick_rate=args.lick_rate,
+                               mri_rate=args.mri_rate,
+                               speed=args.speed,
+                               trial_duration=args.trial_duration,
+                               packet_loss=args.packet_loss,
+                               loss_burst=args.loss_burst,
+                               loss_mode=args.loss_mode,
+                               seed=args.seed)
+    print "Emulated controller listening on", emulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    print "Packets sent: ", emulator.packets_sent, " Packets lost: ", emulator.packets_lost
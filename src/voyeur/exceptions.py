@@ -48,4 +48,26 @@ class NonOperationException(VoyeurException):
     """
 
     def __init__(self, msg="Non-operation, serial communication working, no data sent"):
-        self.msg = msg
\ No newline at end of file
+        self.msg = msg
+
+class TimeoutException(VoyeurException):
+    """Exception raised when the controller does not reply to a request in time.
+
+    Attributes:
+        timeout -- seconds waited
+        msg     -- explanation of the error
+    """
+
+    def __init__(self, timeout, msg="No reply from the controller"):
+        self.timeout = timeout
+        self.msg = msg
+
+class CancelledException(VoyeurException):
+    """Exception raised when a pending request is cancelled.
+
+    Attributes:
+        msg -- explanation of the error
+    """
+
+    def __init__(self, msg="Request cancelled"):
+        self.msg = msg
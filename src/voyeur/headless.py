@@ -0,0 +1,119 @@
+'''
+Runs a protocol without a display.
+
+The session config file has a [session] section with the settings of the rig (as a rig of voyeur.supervisor)
+and when to stop:
+
+    [session]
+        protocol = src.passive_odor_presentation.create_protocol
+        rig_config = src/voyeur_rig_config.conf
+        board = board1
+        port = port1
+        serial_path = /dev/ttyACM0      # optional, overrides port
+        data_directory = /VoyeurData/overnight/
+        trials = 500                    # optional, stop after this many trials
+        duration = 36000                # optional, stop after this many seconds
+
+The protocol is created headless: no plots are built and no GUI toolkit is loaded. Monitor runs on plain
+threads and the MainLoop of voyeur.qtcompat. Acquisition starts right away and stops at the trial or time
+limit, or on Ctrl-C; the database file is closed in every case.
+
+Headless mode has to be chosen before voyeur is imported (see voyeur.qtcompat):
+    VOYEUR_HEADLESS=1 python -m voyeur.headless session.conf
+'''
+
+import sys
+import time
+from timeit import default_timer
+from configobj import ConfigObj
+
+from voyeur.qtcompat import HEADLESS, QTimer, main_loop
+from voyeur.supervisor import RigSpec, load_factory
+
+monotonic = getattr(time, 'monotonic', default_timer)
+
+
+class HeadlessSession(object):
+    """
+    A headless protocol and its Monitor for the rig spec (a voyeur.supervisor.RigSpec).
+
+    run starts acquisition and serves the MainLoop until trials trials have been run or duration seconds
+    have passed (0 for no limit), or until stop is called.
+    """
+
+    # Milliseconds between checks of the limits
+    CHECK_INTERVAL = 1000
+
+    def __init__(self, spec, trials=0, duration=0):
+        if not HEADLESS:
+            raise RuntimeError("Headless mode is off. Set VOYEUR_HEADLESS=1 before voyeur is imported.")
+        from voyeur.monitor import Monitor
+        self.spec = spec
+        self.trials = trials
+        self.duration = duration
+        self.loop = main_loop()
+        self.monitor = Monitor(**spec.monitor_options())
+        self.protocol = load_factory(spec.protocol)(monitor=self.monitor, headless=True)
+        self.started = None
+        self._timer = None
+
+    def start(self):
+        """Starts acquisition, as the start button of the protocol does"""
+        if not self.monitor.running:
+            self.started = monotonic()
+            self.protocol._start_button_fired()
+
+    def stop(self):
+        """Stops acquisition and makes run return"""
+        if self.monitor.running:
+            self.protocol._start_button_fired()
+        self.loop.quit()
+
+    def run(self):
+        QTimer.singleShot(0, self.start)
+        self._timer = QTimer()
+        self._timer.timeout.connect(self._check_limits)
+        self._timer.start(self.CHECK_INTERVAL)
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            print "Interrupted"
+        finally:
+            self._timer.stop()
+            if self.monitor.running:
+                self.protocol._start_button_fired()
+
+    def _check_limits(self):
+        if self.started is None:
+            return
+        if self.trials and self.protocol.trial_number > self.trials:
+            print "Ran", self.trials, "trials"
+            self.stop()
+        elif self.duration and monotonic() - self.started >= self.duration:
+            print "Ran for", self.duration, "seconds"
+            self.stop()
+
+
+def run_session(config_file):
+    """Runs the session of the [session] section of config_file"""
+    section = ConfigObj(config_file).get('session')
+    if section is None:
+        raise ValueError("No [session] section in " + config_file)
+    spec = RigSpec.from_section('session', section, config_file)
+    trials = section.as_int('trials') if 'trials' in section else 0
+    duration = section.as_float('duration') if 'duration' in section else 0
+    session = HeadlessSession(spec, trials=trials, duration=duration)
+    session.run()
+    return session
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a protocol without a display.')
+    parser.add_argument('config_file', help='session config file')
+    args = parser.parse_args()
+
+    if not HEADLESS:
+        sys.exit("Headless mode is off. Run with VOYEUR_HEADLESS=1.")
+    run_session(args.config_file)
@@ -0,0 +1,209 @@
+'''
+Latency histograms of the stages of the acquisition pipeline.
+
+Every stage a stream packet goes through records its duration in a LatencyHistogram:
+
+    request     : stream request written until the reply header is read (request mode)
+    receive     : reply header read until the whole binary payload is received
+    decode      : payload decoded into a stream dictionary
+    handoff     : packets waiting in the stream buffer until the UI thread drains them
+    persistence : batch of packets written to the database
+    protocol    : batch of packets processed by the protocol
+    plot        : streaming plots updated by a frame
+
+LatencyHistogram follows HDR histograms: values are counted in buckets of constant relative precision over
+a wide range, so recording is a few integer operations, memory is fixed, and percentiles keep their
+precision from microseconds to minutes. Instrumentation keeps a histogram of each stage for the session and
+one for the current trial. The trial histograms are summarized and restarted by snapshot_trial, and the
+summaries are stored in a Latency table of the database. The session histogram buckets are stored in a
+LatencyHistograms group at the end of the session. dump prints the session histograms on demand, e.g. from
+a SIGUSR1 handler (see Monitor.dump_instrumentation).
+'''
+
+import sys
+import signal
+import threading
+from numpy import zeros, int64, cumsum, searchsorted, flatnonzero, array
+
+# Pipeline stages, in the order a packet goes through them
+STAGES = ('request', 'receive', 'decode', 'handoff', 'persistence', 'protocol', 'plot')
+
+# Row of the Latency table: the summary of one stage over one trial. Times in microseconds.
+LATENCY_DTYPE = [('trial_number', 'i4'),
+                 ('stage', 'S16'),
+                 ('count', 'i8'),
+                 ('mean_us', 'f8'),
+                 ('p50_us', 'i8'),
+                 ('p90_us', 'i8'),
+                 ('p99_us', 'i8'),
+                 ('max_us', 'i8')]
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of durations, in microseconds, from 0 to highest with significant_digits decimal digits of
+    precision (HDR histogram bucketing).
+
+    Values below sub_bucket_count are counted exactly. Above, each power of two range is split into
+    sub_bucket_count / 2 buckets, so the bucket width is always less than 1 / 10 ** significant_digits
+    of the value. Larger values are counted in the last bucket.
+    """
+
+    def __init__(self, highest=60000000, significant_digits=2):
+        self.highest = highest
+        self.significant_digits = significant_digits
+        self.sub_bucket_bits = (2 * 10 ** significant_digits - 1).bit_length()
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self._half = self.sub_bucket_count >> 1
+        self.counts = zeros(self._index(highest) + 1, dtype=int64)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        """Bucket of value"""
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def _value(self, index):
+        """Highest value counted in bucket index"""
+        if index < self.sub_bucket_count:
+            return index
+        shift, offset = divmod(index - self.sub_bucket_count, self._half)
+        shift += 1
+        return ((offset + self._half + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Records a duration in seconds"""
+        self.record_us(int(seconds * 1000000))
+
+    def record_us(self, value):
+        """Records a duration in microseconds"""
+        if value < 0:
+            value = 0
+        self.counts[min(self._index(value), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, percent):
+        """Duration in microseconds below which percent % of the recorded durations are"""
+        if not self.count:
+            return 0
+        rank = max(int(round(percent / 100.0 * self.count)), 1)
+        index = int(searchsorted(cumsum(self.counts), rank))
+        return min(self._value(index), self.max)
+
+    def mean(self):
+        """Mean duration in microseconds"""
+        return float(self.total) / self.count if self.count else 0.0
+
+    def merge(self, other):
+        """Adds the counts of other, a histogram with the same settings"""
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+
+    def reset(self):
+        self.counts.fill(0)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def buckets(self):
+        """(highest value, count) of the non empty buckets, as an (N, 2) array"""
+        indices = flatnonzero(self.counts)
+        return array([(self._value(int(index)), self.counts[index]) for index in indices], dtype=int64).reshape(-1, 2)
+
+    def summary(self):
+        """(count, mean, 50th, 90th and 99th percentiles, max), in microseconds"""
+        return (self.count, self.mean(), self.percentile(50), self.percentile(90), self.percentile(99),
+                self.max)
+
+
+class Instrumentation(object):
+    """
+    A LatencyHistogram of each pipeline stage for the session, and one for the current trial.
+
+    record may be called from any thread. Each stage is recorded by a single thread (serial, database or
+    UI thread), and a trial snapshot swaps in new trial histograms, so no lock is taken.
+    """
+
+    def __init__(self, stages=STAGES, highest=60000000, significant_digits=2):
+        self.stages = tuple(stages)
+        self._settings = (highest, significant_digits)
+        self.session = dict((stage, LatencyHistogram(*self._settings)) for stage in self.stages)
+        self.trial = dict((stage, LatencyHistogram(*self._settings)) for stage in self.stages)
+        self.enabled = True
+
+    def record(self, stage, seconds):
+        """Records that stage took seconds"""
+        if self.enabled:
+            self.trial[stage].record(seconds)
+
+    def snapshot_trial(self, trial_number):
+        """
+        Ends the trial: its histograms are added to the session ones and replaced by empty ones.
+        Returns the summaries of the trial, one LATENCY_DTYPE row per stage with data.
+        """
+        trial = self.trial
+        self.trial = dict((stage, LatencyHistogram(*self._settings)) for stage in self.stages)
+        rows = []
+        for stage in self.stages:
+            histogram = trial[stage]
+            if not histogram.count:
+                continue
+            self.session[stage].merge(histogram)
+            rows.append((trial_number, stage) + histogram.summary())
+        return array(rows, dtype=LATENCY_DTYPE)
+
+    def session_histogram(self, stage):
+        """Histogram of stage over the session, including the current trial"""
+        histogram = LatencyHistogram(*self._settings)
+        histogram.merge(self.session[stage])
+        histogram.merge(self.trial[stage])
+        return histogram
+
+    def session_histograms(self):
+        """{stage: (N, 2) array of (highest value in us, count)} of the session, for storage"""
+        histograms = dict((stage, self.session_histogram(stage)) for stage in self.stages)
+        return dict((stage, histogram.buckets()) for stage, histogram in histograms.items() if histogram.count)
+
+    def reset(self):
+        for histograms in (self.session, self.trial):
+            for histogram in histograms.values():
+                histogram.reset()
+
+    def dump(self, out=None):
+        """Prints a summary of every stage over the session, including the current trial"""
+        out = out or sys.stdout
+        out.write("%-12s %10s %10s %10s %10s %10s %10s\n" % ('stage (ms)', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+        for stage in self.stages:
+            count, mean, p50, p90, p99, maximum = self.session_histogram(stage).summary()
+            out.write("%-12s %10d %10.3f %10.3f %10.3f %10.3f %10.3f\n"
+                      % (stage, count, mean / 1000.0, p50 / 1000.0, p90 / 1000.0, p99 / 1000.0, maximum / 1000.0))
+        out.flush()
+
+
+def install_dump_signal(instrumentation, signum=getattr(signal, 'SIGUSR1', None)):
+    """
+    Makes signal signum (SIGUSR1 by default) print the session summary of instrumentation, e.g. with
+    kill -USR1 <pid>. Returns False where that is not possible: on Windows, or off the main thread.
+    """
+    if signum is None or threading.current_thread().name != 'MainThread':
+        return False
+    try:
+        signal.signal(signum, lambda signum, frame: instrumentation.dump())
+    except ValueError:
+        return False
+    return True
@@ -1,10 +1,17 @@
 import os, time
 import getpass
+from timeit import default_timer
+from configobj import ConfigObj
 from traits.etsconfig.etsconfig import ETSConfig
-ETSConfig.toolkit = 'qt4'
+from voyeur.qtcompat import HEADLESS, QThread, QTimer
+# Headless, traits must not load a GUI toolkit
+ETSConfig.toolkit = 'null' if HEADLESS else 'qt4'
 
-from voyeur.db import Persistor
-from voyeur.arduino import SerialPort, SerialCallThread
+from voyeur.db import (Persistor, SessionPersistor, PersistorWriter, StorageSettings,
+                       TRIAL_LAYOUT, SESSION_LAYOUT)
+from voyeur.arduino import SerialPort, SerialCallThread, monotonic
+from voyeur.buffers import PacketRingBuffer, DROP_OLDEST, DROP_NEWEST, BLOCK
+from voyeur.instrumentation import Instrumentation, install_dump_signal
 from voyeur.exceptions import (
     EndOfTrialException,
     SerialException,
@@ -12,8 +19,6 @@ from voyeur.exceptions import (
     NonOperationException
     )
     
-from PyQt4.QtCore import QThread, QTimer
-from PyQt4.Qt import  QApplication
 from traits.api import (
     HasTraits,
     Instance,
@@ -22,10 +27,16 @@ from traits.api import (
     Int,
     Float,
     File,
+    Enum,
     Event,
+    Dict,
     on_trait_change
     )
 
+# Rig config file of a Monitor created without config_file
+# DEFAULT_CONFIG_FILE = os.environ.get("voyeur_config")
+DEFAULT_CONFIG_FILE = os.path.join('/Users/Gottfried_Lab/PycharmProjects/PyOlfa/src/voyeur_rig_config.conf')
+
 
 class AcquisitionThread(QThread):
 
@@ -53,8 +64,15 @@ class AcquisitionThread(QThread):
             pass # Windows
 
         # acquisition loop
+        next_request = monotonic()
         while self.monitor.running:
             #print "Stream thread tryin to enqueue", time.clock()
+            # Pace the requests so that the controller has data to send. Sleeping keeps this thread idle
+            # while the UI thread works through the stream buffer.
+            wait = next_request - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_request = monotonic() + self.monitor.stream_poll_interval
             self.serial_queue.enqueue(self.acquire_stream)
 
 
@@ -62,7 +80,10 @@ class Monitor(HasTraits):
     """Central manager for CPU-side of Voyeur system"""
 
     # Client
-    persistor = Instance(object, factory=Persistor)
+    persistor = Instance(object)
+    persistor_writer = Instance(PersistorWriter)
+    # On-disk layout of new database files (see voyeur.db). Can be changed between sessions.
+    database_layout = Enum(TRIAL_LAYOUT, SESSION_LAYOUT)
     serial1 = Instance(object)
     serial_queue1 = Instance(object)
     protocol = Instance(object)
@@ -72,6 +93,14 @@ class Monitor(HasTraits):
     protocol_number = Int(1)
     animal_id = Int(1)
     rig = Int(1)
+    # Rig config file, and the board and serial port of this rig in it. serial_path, if set, overrides
+    # the serial port configured for this host (see voyeur.arduino.SerialPort).
+    config_file = File(DEFAULT_CONFIG_FILE)
+    board = Str('board1')
+    port = Str('port1')
+    serial_path = Str('')
+    # Directory of the database files
+    data_directory = Str('/VoyeurData/')
     experiment_notes = Str("")
     voyeur_version = Float(1.0)
     usercode_version = Float(1.0)
@@ -87,40 +116,83 @@ class Monitor(HasTraits):
     paused = Bool(False)
     eot = Event() # queue for dispatch on ui thread
     push_event = Event() # dispatch immediately on ui thread
-    push_streaming = Event() # dispatch immediately on ui thread
+    stream_ready = Event() # dispatch immediately on ui thread
+    stream_error = Event() # queue for dispatch on ui thread
     current_session_group = Instance(object)
-    current_trial_group = Instance(object)
+    # Number of the trial being run, as given to the database by start_new_trial
+    current_trial_number = Int(0)
+    # {name: rows} of each protocol session table already queued for the database
+    _session_table_rows = Dict
     current_trial_parameters = Instance(object)
     acquisition_thread = Instance(AcquisitionThread)
     _iti_timer = Instance(QTimer)
     processed = 0
     acquired = 0
-    _acquiringlock = False
-    _eventlock = False
+
+    # Stream packets are handed from the acquisition side to the UI thread through stream_buffer.
+    # stream_buffer_policy decides what happens when the UI falls behind and the buffer is full
+    # (see voyeur.buffers). 'block' waits at most stream_buffer_timeout seconds on the serial thread.
+    stream_buffer = Instance(PacketRingBuffer)
+    stream_buffer_size = Int(4096)
+    stream_buffer_policy = Enum(DROP_OLDEST, DROP_NEWEST, BLOCK)
+    stream_buffer_timeout = Float(0.1)
+    # Minimum seconds between stream requests in request mode
+    stream_poll_interval = Float(0.005)
+    # Push mode: the controller streams packets continuously instead of answering one stream request at a time.
+    continuous_streaming = Bool(False)
+    # Database writes happen on persistor_writer. The file is flushed after this many stream packets,
+    # bytes or seconds, whichever comes first (see voyeur.db.PersistorWriter).
+    persistor_queue_size = Int(1000)
+    flush_packets = Int(200)
+    flush_bytes = Int(1 << 20)
+    flush_interval = Float(1.0)
+    # Latency histograms of the acquisition pipeline stages (see voyeur.instrumentation). Their summary
+    # is stored per trial in the Latency table of the session group, their session buckets in the
+    # LatencyHistograms group, and printed by dump_instrumentation (also on SIGUSR1) and at the end of
+    # acquisition.
+    instrument_latency = Bool(True)
+    instrumentation = Instance(Instrumentation)
+    # Time the oldest packet waiting in stream_buffer was handed over
+    _stream_ready_time = None
 
     def __init__(self, send_trial_number = False, *args, **kwargs):
         HasTraits.__init__(self, *args, **kwargs)
         
         # events -- dispatched on UI thread
         self.on_trait_event(self._handle_push_event, 'push_event', dispatch='fast_ui')
-        self.on_trait_event(self._handle_push_streaming, 'push_streaming', dispatch='fast_ui')
+        self.on_trait_event(self._handle_stream_ready, 'stream_ready', dispatch='fast_ui')
         self.on_trait_change(self._handle_eot, 'eot', dispatch='ui')
+        self.on_trait_change(self._handle_stream_error, 'stream_error', dispatch='ui')
 
         # database
-        self.persistor = Persistor()
+        self.persistor = self._create_persistor()
+        self.persistor_writer = PersistorWriter(self.persistor,
+                                                max_queue_size=self.persistor_queue_size,
+                                                flush_packets=self.flush_packets,
+                                                flush_bytes=self.flush_bytes,
+                                                flush_interval=self.flush_interval)
+        self.persistor_writer.start()
+
+        # instrumentation
+        self.instrumentation = Instrumentation()
+        self.instrumentation.enabled = self.instrument_latency
+        self.persistor_writer.instrumentation = self.instrumentation
+        install_dump_signal(self.instrumentation)
 
         # config
-        # self.configFile = os.environ.get("voyeur_config")
-        self.configFile = os.path.join('/Users/Gottfried_Lab/PycharmProjects/PyOlfa/src/voyeur_rig_config.conf')
+        self.configFile = self.config_file
 
         # serial
         self.serial_queue1 = SerialCallThread(monitor=self, max_queue_size=1)        
         try:
             if self.serial1 is None:
-                self.serial1 = SerialPort(self.configFile, board='board1', port='port1', send_trial_number = send_trial_number)
+                self.serial1 = SerialPort(self.configFile, board=self.board, port=self.port,
+                                          send_trial_number=send_trial_number, path=self.serial_path or None)
         except SerialException as e:
-            print('Serial Port 1 Error')
+            print('Serial Port Error (%s, %s)' % (self.board, self.port))
             print('Serial exception. Message: ', e.msg, ' Path: ', e.path)
+        if self.serial1 is not None:
+            self.serial1.instrumentation = self.instrumentation
 
         self.protocol_name = self.serial1.request_protocol_name()
         ### Define monitor metadata. This metadata is consistent between all protocols.
@@ -136,14 +208,42 @@ class Monitor(HasTraits):
         initial_metadata = dict(self.metadata.items() + self.protocol.metadata.items())  # combine protocol and monitor metadata
         if self.serial1 != None:
             #self.serial_queue1.enqueue(self.persistor.close_database)
-            self.current_session_group = self.persistor.create_database(self.database_file, initial_metadata)
+            self.persistor.storage = self._storage_settings()
+            self.current_session_group = self.persistor_writer.call(self.persistor.create_database,
+                                                                    self.database_file,
+                                                                    initial_metadata)
+
+            self.persistor_writer.call(self.persistor.create_trials,
+                                       self.protocol.protocol_parameters_definition(),
+                                       self.protocol.controller_parameters_definition(),
+                                       self.protocol.event_definition(),
+                                       self.current_session_group,
+                                       '')
+            self._session_table_rows = {}
+            self._write_session_tables()
+
+    def _write_session_tables(self):
+        """Queues the rows added to the protocol session tables since they were last written"""
+        if self.current_session_group is None:
+            return
+        written = False
+        for name, rows in self.protocol.session_tables().items():
+            count = self._session_table_rows.get(name, 0)
+            if len(rows) > count:
+                self.persistor_writer.submit(self.persistor.append_table, name, '', rows[count:],
+                                             self.current_session_group)
+                self._session_table_rows[name] = len(rows)
+                written = True
+        if written:
+            self.persistor_writer.submit(self.persistor_writer.flush)
+
+    def _storage_settings(self):
+        """Compression and chunking settings from the protocol, or else from the rig config file"""
+        settings = self.protocol.storage_settings()
+        if settings is None:
+            settings = StorageSettings.from_config(ConfigObj(self.configFile).get('storage', {}))
+        return settings
 
-            self.persistor.create_trials(self.protocol.protocol_parameters_definition(),
-                                            self.protocol.controller_parameters_definition(),
-                                            self.protocol.event_definition(),
-                                            self.current_session_group,
-                                            '')
-        
     def _protocol_changed(self, name, old, new):
         """
         Update protocol number.
@@ -168,6 +268,9 @@ class Monitor(HasTraits):
                                     
 
     def start_acquisition(self):
+        if self.serial1 != None:
+            # Lay out the start trial frame before the first trial
+            self.serial1.parameter_packer(self.protocol.controller_parameters_definition())
         self.running = True
         self.recording = True
         self.paused = False
@@ -184,12 +287,64 @@ class Monitor(HasTraits):
         self.paused = False
         self.setup_complete = False
         if self.serial1 != None:
-            self._eventlock = True
-            self.serial_queue1.enqueue(self.serial1.end_trial)
-            self._eventlock = False
+            if self.continuous_streaming:
+                self.serial_queue1.enqueue_command(self._end_streaming)
+            else:
+                self.serial_queue1.enqueue_command(self.serial1.end_trial)
             #self.serial_queue1.enqueue(self.persistor.close_database)
             #self.serial_queue1.enqueue(self.serial1.close)
-        self.persistor.close_database()
+        # Everything still queued for the database is written before the file is closed
+        self._write_session_tables()
+        self.persistor_writer.drain()
+        self.persistor_writer.call(self.persistor.store_session_arrays,
+                                   self.protocol.session_arrays(),
+                                   self.current_session_group)
+        histograms = self.instrumentation.session_histograms()
+        if histograms:
+            self.persistor_writer.call(self.persistor.store_group_arrays,
+                                       'LatencyHistograms',
+                                       'Session latency buckets of each pipeline stage: (highest us, count)',
+                                       histograms,
+                                       self.current_session_group)
+        self.persistor_writer.call(self.persistor.close_database)
+        print "Stream packets written to database: ", self.persistor_writer.packets_written
+        print "Database flushes: ", self.persistor_writer.flushes
+        if self.serial1 != None:
+            for priority, stats in sorted(self.serial_queue1.stats.items()):
+                print "Serial lane %d: %d calls, max depth %d, mean wait %.1f ms, max wait %.1f ms" \
+                      % ((priority,) + stats.summary())
+        if self.stream_buffer is not None:
+            print "Stream packets overwritten before processing: ", self.stream_buffer.overflows
+            print "Stream packets dropped on a full buffer: ", self.stream_buffer.dropped
+            print "Maximum stream packets waiting: ", self.stream_buffer.high_water
+        if self.instrument_latency:
+            self.dump_instrumentation()
+
+    def _create_persistor(self):
+        """Returns a new persistor writing database files of database_layout"""
+        if self.database_layout == SESSION_LAYOUT:
+            return SessionPersistor()
+        return Persistor()
+
+    def _database_layout_changed(self, old, new):
+        if self.persistor_writer is None:
+            # Set by the constructor: the persistor is created with the layout
+            return
+        if self.running:
+            print "The database layout cannot change during a session. Still using:", old
+            self.trait_setq(database_layout=old)
+            return
+        self.persistor = self._create_persistor()
+        self.persistor_writer.call(self.persistor_writer.set_persistor, self.persistor)
+
+    def dump_instrumentation(self):
+        """Prints the latency of each pipeline stage over the session"""
+        print "Pipeline latency (ms):"
+        self.instrumentation.dump()
+
+    def _instrument_latency_changed(self, new):
+        if self.instrumentation is not None:
+            self.instrumentation.enabled = new
 
     def pause_acquisition(self, graceful = False):
         """Pauses acquisition"""
@@ -201,9 +356,7 @@ class Monitor(HasTraits):
         
         if graceful:
             if self.serial1 != None:
-                self._eventlock = True
-                self.serial_queue1.enqueue(self.serial1.end_trial)
-                self._eventlock = False
+                self.serial_queue1.enqueue_command(self.serial1.end_trial)
         if self.running:
             self.recording = False
                 
@@ -221,9 +374,7 @@ class Monitor(HasTraits):
         if not self.serial_queue1.isRunning():
             self.serial_queue1.start()
         if self.serial1 != None:
-            self._eventlock = True
-            self.serial_queue1.enqueue(self.serial1.user_def_command, command)
-            self._eventlock = False
+            self.serial_queue1.enqueue_command(self.serial1.user_def_command, command)
             """if not sent:
                 raise ProtocolException(self.protocol.protocol_description(),
                                          "Sending user defined command failed")"""
@@ -233,20 +384,30 @@ class Monitor(HasTraits):
         # Get parameters for next trial
         if self.running and self.recording:
             trial_parameters = self.protocol.trial_parameters()
-            # Create the trial group
-            self.current_trial_group = self.persistor.add_trial(self.protocol.trialNumber,
-                                                                trial_parameters.protocolParameters,
-                                                                trial_parameters.controllerParameters,
-                                                                self.protocol.stream_definition(),
-                                                                self.current_session_group,
-                                                                self.protocol.protocol_description())
+            # Schedule rows planned or overridden for this trial are on disk before it runs
+            self._write_session_tables()
+            # Create the trial group. Queued without waiting: the stream packets of the trial are queued
+            # after it and written to its group
+            self.current_trial_number = self.protocol.trialNumber
+            self.persistor_writer.add_trial(self.current_trial_number,
+                                            trial_parameters.protocolParameters,
+                                            trial_parameters.controllerParameters,
+                                            self.protocol.stream_definition(),
+                                            self.current_session_group,
+                                            self.protocol.protocol_description())
 
             self.protocol.start_of_trial()
             self._start_acquisition(trial_parameters.controllerParameters)
             
             if not self.serial_queue1.isRunning():
                 self.serial_queue1.start()
-                self._start_acquisition_thread()
+                self.stream_buffer = PacketRingBuffer(self.stream_buffer_size,
+                                                      self.stream_buffer_policy,
+                                                      self.stream_buffer_timeout)
+                if self.continuous_streaming:
+                    self._start_stream_reader()
+                else:
+                    self._start_acquisition_thread()
 
     def acquire_events(self):
         """Run event acquisition"""
@@ -263,8 +424,7 @@ class Monitor(HasTraits):
             stream = self.serial1.request_stream(self.protocol.stream_definition())
             #print "Stream acquired from serial: ", stream
             if stream:
-                self._acquiringlock = True
-                self.push_streaming = (stream, self.recording)
+                self._queue_stream(stream)
                 self.acquired += 1
                 #print "Total streams acquired: ", self.acquired
             else:
@@ -275,22 +435,20 @@ class Monitor(HasTraits):
         except EndOfTrialException as ex:
             stream = ex.last_read
             if stream:
-                self._acquiringlock = True
-                self.push_streaming = (stream, self.recording)
+                self._queue_stream(stream)
                 #self.acquired += 1
                 #print "Total streams acquired: ", self.acquired
             raise ex
-        while(self._acquiringlock):
-            if self.running == False or self._eventlock:
-                break
-            continue
         return
+
+    def _queue_stream(self, stream):
+        """Hands a stream packet to the UI thread. Never waits longer than the stream buffer policy allows"""
+        if self.stream_buffer.put(stream):
+            self._notify_stream_ready()
                         
     def _handle_eot(self):
         self.protocol.end_of_trial()
-        self._eventlock = True
-        self.serial_queue1.enqueue(self.acquire_events)
-        self._eventlock = False
+        self.serial_queue1.enqueue_command(self.acquire_events)
 
     def _run_iti(self, continuation):
         """Starts a timer with Protocol-supplied inter-trial interval. Timer
@@ -317,29 +475,74 @@ class Monitor(HasTraits):
         self.acquisition_thread.monitor = self
         self.acquisition_thread.start()
             
+    def _start_stream_reader(self):
+        """Switches the controller to push mode, streaming into a new stream buffer"""
+        self.serial_queue1.enqueue_command(self.serial1.start_streaming,
+                                           self.protocol.stream_definition(),
+                                           self.stream_buffer,
+                                           on_packets=self._notify_stream_ready,
+                                           on_end_of_trial=self._notify_eot,
+                                           on_error=self._notify_stream_error)
+
+    def _end_streaming(self):
+        """
+        Switches the controller back to request mode and ends the trial. Runs on the serial thread.
+
+        Streaming is stopped first so that the end of trial reply cannot interleave with stream packets.
+        """
+        self.serial1.stop_streaming()
+        self.serial1.end_trial()
+
+    def _notify_stream_ready(self):
+        """Called by the stream reader thread when packets are waiting in the stream buffer"""
+        self._stream_ready_time = default_timer()
+        self.stream_ready = True
+
+    def _notify_eot(self):
+        """Called by the stream reader thread when the controller signals the end of trial"""
+        self.eot = True
+
+    def _notify_stream_error(self, error):
+        """Called by the stream reader thread when the serial port fails and the reader stops"""
+        self.stream_error = error
+
+    def _handle_stream_error(self, error):
+        """Stops acquisition, and closes the database, when the stream reader stopped on a port failure"""
+        print "Stream reader stopped on a serial port error: ", error
+        if self.running:
+            self.stop_acquisition()
+
     def _start_acquisition(self, trial_parameters):
         """Starts acquisition. Called by AcquisitionThread.run"""
         if self.protocol != None:
-            self._eventlock = True
-            self.serial_queue1.enqueue(self.serial1.start_trial, trial_parameters)
-            self._eventlock = False
+            self.serial_queue1.enqueue_command(self.serial1.start_trial, trial_parameters)
 
     def _handle_push_event(self, event_tuple):
         event, persist = event_tuple
-        self.persistor.insert_event(event, self.current_session_group)
+        self.persistor_writer.insert_event(event, self.current_session_group)
+        latency = self.instrumentation.snapshot_trial(self.current_trial_number)
+        if self.recording and len(latency):
+            self.persistor_writer.submit(self.persistor.append_table, 'Latency', 'Pipeline stage latencies (us)',
+                                         latency, self.current_session_group)
         self.protocol.process_event_request(event)
         if not self.paused:
             self._run_iti(self.start_new_trial)
 
-    def _handle_push_streaming(self, streaming_tuple):
-        #print "processing stream....", time.clock()
-        if not self.running:
+    def _handle_stream_ready(self):
+        """Drains the stream buffer, persisting and processing the packets as one batch"""
+        stream_buffer = self.stream_buffer
+        if not self.running or stream_buffer is None:
+            return
+        ready_time = self._stream_ready_time
+        streams = stream_buffer.drain()
+        if not streams:
             return
-        stream, persist = streaming_tuple
-        if persist:
-            self.persistor.insert_stream(stream, self.current_trial_group)
-        self.protocol.process_stream_request(stream)
-        self.processed += 1
-        #print "stream processed: ", time.clock(), ". Total processed: ", self.processed
-        self._acquiringlock = False        
+        if ready_time is not None:
+            self.instrumentation.record('handoff', default_timer() - ready_time)
+        if self.recording:
+            self.persistor_writer.insert_streams(streams)
+        start = default_timer()
+        self.protocol.process_stream_batch(streams)
+        self.instrumentation.record('protocol', default_timer() - start)
+        self.processed += len(streams)
         return
@@ -150,6 +150,57 @@ class IProtocol(IPlugin):
         """
         pass
 
+    def process_stream_batch(self, streams):
+        """
+        Process a batch of stream packets drained from the acquisition buffer.
+
+        The default implementation calls process_stream_request for each packet in order. Protocols that can
+        update their state and display once per batch may override this.
+
+        Parameters:
+            streams : list of stream dictionaries, oldest first
+        """
+        for stream in streams:
+            self.process_stream_request(stream)
+
+    def restore_trial(self, parameters):
+        """
+        Sets up the trial about to start as it was recorded, when a session is replayed (see voyeur.replay).
+        Called before trial_parameters and start_of_trial.
+
+        The default does nothing, so the protocol draws its trials as in a live session. Protocols whose
+        processing depends on the trial parameters, e.g. to score responses against the stimulus, should
+        restore them.
+
+        Parameters:
+            parameters : dictionary of the recorded Trials row, protocol and controller parameters by name
+        """
+        pass
+
+    def session_arrays(self):
+        """
+        Returns a dictionary of {name: numpy array} of session wide data, such as a precomputed trial
+        schedule, stored in the session group of the database when the session ends. Structured arrays
+        are stored as tables.
+        """
+        return {}
+
+    def session_tables(self):
+        """
+        Returns a dictionary of {name: numpy structured array} of session wide tables that only grow
+        during the session, such as a precomputed trial schedule and the changes made to it. They are
+        written to the session group of the database when it is created, and the rows added since are
+        appended when each trial starts and when the session ends, so that they survive a crash.
+        """
+        return {}
+
+    def storage_settings(self):
+        """
+        Returns a :class:`voyeur.db.StorageSettings` describing compression and chunking of the datasets
+        of this protocol, or None to use the [storage] section of the rig config file.
+        """
+        return None
+
     @abc.abstractmethod
     def end_of_trial(self):
         pass
@@ -0,0 +1,220 @@
+'''
+Threads, timers and the event loop used by the acquisition, with or without Qt.
+
+With a display, QThread and QTimer are PyQt4's and events dispatched to the 'ui' thread are delivered
+by the Qt event loop. Headless, QThread is a plain python thread, and QTimer callbacks and trait
+notifications dispatched to the 'ui' thread are served by MainLoop on the thread that runs it, so
+Monitor and the protocols run unchanged and still see every event on a single thread.
+
+Headless mode is chosen when the module is first imported, and only with VOYEUR_HEADLESS=1. The protocols
+then import no GUI toolkit at all (no PyQt4, PySide, pyface, traitsui, chaco or enable).
+'''
+
+import os
+import time
+import heapq
+import threading
+from collections import deque
+from timeit import default_timer
+
+monotonic = getattr(time, 'monotonic', default_timer)
+
+
+def _headless():
+    return os.environ.get('VOYEUR_HEADLESS', '') not in ('', '0')
+
+HEADLESS = _headless()
+
+
+class _Call(object):
+    """A call scheduled on the MainLoop"""
+
+    def __init__(self, when, sequence, fn, args, kwargs):
+        self.when = when
+        self.sequence = sequence
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return (self.when, self.sequence) < (other.when, other.sequence)
+
+
+class MainLoop(object):
+    """
+    Event loop of a headless process, in place of the Qt event loop.
+
+    Calls can be posted and scheduled from any thread; they all run on the thread in run(). run also makes
+    that thread the 'ui' thread of traits, so that notifications with dispatch='ui' or 'fast_ui' fired on
+    other threads are posted to the loop.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._ready = deque()
+        self._timers = []
+        self._sequence = 0
+        self.running = False
+
+    def post(self, fn, *args, **kwargs):
+        """Calls fn(*args, **kwargs) on the loop thread as soon as possible"""
+        with self._condition:
+            self._ready.append(_Call(0, 0, fn, args, kwargs))
+            self._condition.notify()
+
+    def call_later(self, seconds, fn, *args):
+        """Calls fn(*args) on the loop thread after seconds. Returns a handle that can cancel the call"""
+        with self._condition:
+            self._sequence += 1
+            call = _Call(monotonic() + seconds, self._sequence, fn, args, {})
+            heapq.heappush(self._timers, call)
+            self._condition.notify()
+        return call
+
+    def run(self):
+        """Runs the posted and scheduled calls until quit is called"""
+        from traits.trait_notifiers import set_ui_handler
+        set_ui_handler(self.post)
+        self.running = True
+        while self.running:
+            for call in self._next_calls():
+                if not call.cancelled:
+                    call.fn(*call.args, **call.kwargs)
+
+    def quit(self):
+        """Makes run return after the call being served"""
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+
+    def _next_calls(self):
+        """Waits for calls to be ready and returns them"""
+        with self._condition:
+            while self.running:
+                now = monotonic()
+                while self._timers and self._timers[0].when <= now:
+                    self._ready.append(heapq.heappop(self._timers))
+                if self._ready:
+                    calls = list(self._ready)
+                    self._ready.clear()
+                    return calls
+                # Condition.wait wakes up often without a timeout in python 2, so always give one
+                timeout = self._timers[0].when - now if self._timers else 1.0
+                self._condition.wait(timeout)
+            return []
+
+
+_main_loop = None
+
+
+def main_loop():
+    """The MainLoop of the process"""
+    global _main_loop
+    if _main_loop is None:
+        _main_loop = MainLoop()
+    return _main_loop
+
+
+class Signal(object):
+    """Minimal stand-in for a Qt signal"""
+
+    def __init__(self):
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def disconnect(self, slot=None):
+        if slot is None:
+            del self._slots[:]
+        elif slot in self._slots:
+            self._slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in list(self._slots):
+            slot(*args)
+
+
+class HeadlessThread(object):
+    """QThread subset used by voyeur, on a python thread"""
+
+    def __init__(self, parent=None):
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=type(self).__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, msecs=None):
+        """Waits for run to return, at most msecs milliseconds. Returns True if it has"""
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(None if msecs is None else msecs / 1000.0)
+        return not self.isRunning()
+
+    def run(self):
+        pass
+
+
+class HeadlessTimer(object):
+    """QTimer subset used by voyeur, served by the MainLoop"""
+
+    def __init__(self, parent=None):
+        self.timeout = Signal()
+        self._single_shot = False
+        self._interval = 0
+        self._call = None
+
+    def setSingleShot(self, single_shot):
+        self._single_shot = single_shot
+
+    def isSingleShot(self):
+        return self._single_shot
+
+    def setInterval(self, msecs):
+        self._interval = msecs
+
+    def interval(self):
+        return self._interval
+
+    def isActive(self):
+        return self._call is not None
+
+    def start(self, msecs=None):
+        if msecs is not None:
+            self._interval = msecs
+        self.stop()
+        self._call = main_loop().call_later(self._interval / 1000.0, self._fire)
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def deleteLater(self):
+        self.stop()
+
+    def _fire(self):
+        if self._single_shot:
+            self._call = None
+        else:
+            self._call = main_loop().call_later(self._interval / 1000.0, self._fire)
+        self.timeout.emit()
+
+    @staticmethod
+    def singleShot(msecs, slot):
+        main_loop().call_later(msecs / 1000.0, slot)
+
+
+if HEADLESS:
+    QThread = HeadlessThread
+    QTimer = HeadlessTimer
+else:
+    from PyQt4.QtCore import QThread, QTimer
@@ -0,0 +1,236 @@
+import tables
+from numpy import array, arange, concatenate, searchsorted, flatnonzero, minimum
+
+from voyeur.db import SESSION_LAYOUT, database_layout, trial_numbers, _concatenate_rows
+
+"""Read access to Voyeur database files"""
+
+
+class SessionReader(object):
+    """
+    Reads a Voyeur session file in either layout (see voyeur.db).
+
+    The file is opened on first access and nothing is loaded until asked for. Trial ranges are
+    inclusive trial numbers; None means from the first or up to the last trial. With the session
+    layout a range of trials of one channel is a single contiguous read. With the trial layout the
+    per-trial arrays are read and concatenated.
+
+    Example::
+        with SessionReader('mouse1_sess1_D2014_1_1T12_0_0.h5') as session:
+            trials = session.trials()
+            sniff = session.channel('sniff', 10, 20)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._h5file = None
+        self._layout = None
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def h5file(self):
+        if self._h5file is None:
+            self._h5file = tables.open_file(self.filename, mode='r')
+        return self._h5file
+
+    @property
+    def layout(self):
+        """TRIAL_LAYOUT or SESSION_LAYOUT"""
+        if self._layout is None:
+            self._layout = database_layout(self.h5file)
+        return self._layout
+
+    def close(self):
+        if self._h5file is not None:
+            self._h5file.close()
+            self._h5file = None
+            self._index = None
+
+    def metadata(self):
+        """Session metadata stored as attributes of the root group"""
+        attrs = self.h5file.root._v_attrs
+        return dict((name, attrs[name]) for name in attrs._f_list('user'))
+
+    def trials(self, start=None, stop=None):
+        """Rows start to stop of the Trials table as a numpy structured array"""
+        return self.h5file.root.Trials.read(start, stop)
+
+    def trial_numbers(self):
+        """Numbers of the trials with stream data, in order"""
+        if self.layout == SESSION_LAYOUT:
+            return list(self._trial_index()['trial_number'])
+        return trial_numbers(self.h5file)
+
+    def events(self, first_trial=None, last_trial=None):
+        """Events rows (one per stream packet) of a range of trials as a numpy structured array"""
+        root = self.h5file.root
+        if self.layout == SESSION_LAYOUT:
+            start, stop = self._session_range('events_start', root.Events.nrows, first_trial, last_trial)
+            return root.Events.read(start, stop)
+        events = [self._trial_group(number).Events.read() for number in self._numbers(first_trial, last_trial)]
+        if not events:
+            return array([])
+        return concatenate(events)
+
+    def channel(self, name, first_trial=None, last_trial=None):
+        """All samples of stream channel name recorded during a range of trials, as one array"""
+        if self.layout == SESSION_LAYOUT:
+            channel = self.h5file.root.Streams._f_get_child(name)
+            start, stop = self._session_range(name + '_start', channel.nrows, first_trial, last_trial)
+            return channel.read(start, stop)
+        vlarrays = [self._trial_group(number)._f_get_child(name) for number in self._numbers(first_trial, last_trial)]
+        if not vlarrays:
+            return array([])
+        return concatenate([_concatenate_rows(vlarray) for vlarray in vlarrays])
+
+    def window(self, name, start_time, stop_time, time_column='packet_sent_time'):
+        """
+        Samples of stream channel name from the packets whose time_column lies in [start_time, stop_time).
+
+        Packet times are controller milliseconds and increase through the session, except in the Events
+        rows of lost packets, which hold no values. Only the Events columns are scanned before the samples
+        of the window are read.
+        """
+        root = self.h5file.root
+        if self.layout == SESSION_LAYOUT:
+            channel = root.Streams._f_get_child(name)
+            times = root.Events.col(time_column)
+            rows = flatnonzero((times >= start_time) & (times < stop_time))
+            if not len(rows):
+                return channel.read(0, 0)
+            # Lost packets in between have no samples, so the samples of the window are contiguous
+            first, last = rows[0], rows[-1] + 1
+            offsets = root.Events.read(first, last + 1 if last < len(times) else last, field=name + '_offset')
+            stop = offsets[-1] if last < len(times) else channel.nrows
+            return channel.read(offsets[0], stop)
+        packets = []
+        for number in trial_numbers(self.h5file):
+            group = self._trial_group(number)
+            events = group.Events.read()
+            times = events[time_column]
+            selected = (times >= start_time) & (times < stop_time)
+            if not selected.any():
+                continue
+            vlarray = group._f_get_child(name)
+            rows = flatnonzero(selected[self._row_positions(name, events, vlarray)])
+            if len(rows):
+                packets.extend(vlarray.read(rows[0], rows[-1] + 1))
+        if not packets:
+            return array([])
+        return concatenate(packets)
+
+    def trial_row(self, number):
+        """Trials row (parameters and event values) of trial number as a dictionary"""
+        if self.layout == SESSION_LAYOUT:
+            index = self._trial_index()
+            rows = flatnonzero(index['trial_number'] == number)
+            if not len(rows):
+                raise KeyError("No trial " + str(number))
+            row = int(index['trial_index'][rows[-1]])
+        else:
+            row = int(self._trial_group(number)._v_attrs.trialIndex)
+        trials = self.h5file.root.Trials
+        if row >= trials.nrows:
+            # The trial ended before its event was received
+            return None
+        values = trials.read(row, row + 1)[0]
+        return dict((name, values[name]) for name in values.dtype.names)
+
+    def stream_names(self):
+        """Names of the array stream channels"""
+        if self.layout == SESSION_LAYOUT:
+            return sorted(self.h5file.root.Streams._v_children)
+        numbers = trial_numbers(self.h5file)
+        if not numbers:
+            return []
+        return sorted(name for name in self._trial_group(numbers[0])._v_leaves if name != 'Events')
+
+    def packets(self, number):
+        """
+        Stream packets of trial number, as the list of stream dictionaries the protocol received.
+
+        Scalar streams come from the Events rows and array streams from the channel samples. A channel
+        that sent nothing in a packet is None, as decoded from the controller. With the trial layout, such
+        packets left no row in the channel VLArray. The rows are then matched to the packets with the
+        <channel>_samples column if there is one, or else as timestamps, each row going to the first
+        packet sent at or after its last timestamp.
+        """
+        events = self.events(number, number)
+        if not len(events):
+            return []
+        scalars = [name for name in events.dtype.names if name != 'trial' and not name.endswith('_offset')]
+        packets = [dict((name, row[name]) for name in scalars) for row in events]
+        for name in self.stream_names():
+            for packet, values in zip(packets, self._packet_samples(name, number, events)):
+                packet[name] = values
+        return packets
+
+    def _packet_samples(self, name, number, events):
+        """Samples of channel name in each packet of events, None where the packet had none"""
+        if self.layout == SESSION_LAYOUT:
+            data = self.channel(name, number, number)
+            starts = events[name + '_offset'] - events[name + '_offset'][0]
+            stops = list(starts[1:]) + [len(data)]
+            return [data[start:stop] if stop > start else None for start, stop in zip(starts, stops)]
+        vlarray = self._trial_group(number)._f_get_child(name)
+        rows = vlarray.read()
+        if len(rows) == len(events):
+            return [row if len(row) else None for row in rows]
+        samples = [None] * len(events)
+        for position, row in zip(self._row_positions(name, events, vlarray, rows), rows):
+            samples[position] = row if samples[position] is None else concatenate((samples[position], row))
+        return samples
+
+    def _row_positions(self, name, events, vlarray, rows=None):
+        """
+        Events row of each row of the trial layout VLArray of channel name.
+
+        Packets in which the channel sent nothing, and lost packets, left an Events row but no VLArray row.
+        The rows are matched with the <channel>_samples column if there is one. Otherwise each row goes to
+        the first received packet sent at or after its last timestamp; lost packets have no send time.
+        rows are the VLArray rows, if already read.
+        """
+        if vlarray.nrows == len(events):
+            return arange(len(events))
+        if name + '_samples' in events.dtype.names:
+            return flatnonzero(events[name + '_samples'])[:vlarray.nrows]
+        received = flatnonzero(events['packet_sent_time'])
+        if not len(received):
+            return arange(0)
+        if rows is None:
+            rows = vlarray.read()
+        times = events['packet_sent_time'][received]
+        last_times = [row[-1] if len(row) else 0 for row in rows]
+        return received[minimum(searchsorted(times, last_times), len(received) - 1)]
+
+    def _numbers(self, first_trial, last_trial):
+        """Trial numbers of the trial layout within an inclusive range"""
+        return [number for number in trial_numbers(self.h5file)
+                if (first_trial is None or number >= first_trial) and (last_trial is None or number <= last_trial)]
+
+    def _trial_group(self, number):
+        return self.h5file.root._f_get_child("Trial" + str(number).zfill(4))
+
+    def _trial_index(self):
+        """TrialIndex table of the session layout, read once"""
+        if self._index is None:
+            self._index = self.h5file.root.TrialIndex.read()
+        return self._index
+
+    def _session_range(self, column, total, first_trial, last_trial):
+        """(start, stop) in a session wide array of an inclusive range of trials, from a TrialIndex start column"""
+        index = self._trial_index()
+        numbers = index['trial_number']
+        starts = index[column]
+        first = 0 if first_trial is None else searchsorted(numbers, first_trial, 'left')
+        last = len(numbers) if last_trial is None else searchsorted(numbers, last_trial, 'right')
+        if first >= last:
+            return 0, 0
+        stop = starts[last] if last < len(starts) else total
+        return int(starts[first]), int(stop)
@@ -0,0 +1,193 @@
+'''
+Replays a recorded session through a protocol, without hardware.
+
+SessionReplay reads a session file of either layout with voyeur.reader.SessionReader and calls the protocol
+as Monitor does during acquisition: trial_parameters and start_of_trial when a trial starts, then
+process_stream_request for every stream packet, then end_of_trial and process_event_request with the
+recorded event. Packets are paced by their packet_sent_time, at the speed of the recording, N times faster
+or as fast as possible, to regression-test protocol changes and to profile the display and analysis paths
+with real data.
+
+Before each trial the protocol's restore_trial gets the recorded Trials row, so that the stimulus of the
+trial is the recorded one and the recorded response is scored against it.
+
+The protocol is created without a Monitor or olfactometer (ARDUINO = OLFA = 0).
+
+Example:
+    VOYEUR_HEADLESS=1 python -m voyeur.replay mouse1_sess1.h5 src.passive_odor_presentation.create_protocol --speed 0
+'''
+
+import time
+from timeit import default_timer
+
+from voyeur.qtcompat import QTimer
+from voyeur.reader import SessionReader
+
+monotonic = getattr(time, 'monotonic', default_timer)
+
+# Speed replaying as fast as possible
+MAX_SPEED = 0
+
+
+class SessionReplay(object):
+    """
+    Feeds the trials of session file filename to protocol.
+
+    speed is session time per wall-clock time: 1 replays in real time, 10 ten times faster, MAX_SPEED as
+    fast as possible. first_trial and last_trial limit the replay to an inclusive range of trials.
+
+    run replays the whole session on the calling thread and returns its statistics. start replays on the
+    event loop instead (the Qt event loop, or the MainLoop when headless), so that the plots keep redrawing.
+    """
+
+    # Seconds of protocol calls at most in one event loop tick when replaying faster than the protocol
+    TICK_BUDGET = 0.02
+
+    def __init__(self, filename, protocol, speed=1.0, first_trial=None, last_trial=None):
+        self.reader = SessionReader(filename)
+        self.protocol = protocol
+        self.speed = speed
+        self.first_trial = first_trial
+        self.last_trial = last_trial
+        self.trials_replayed = 0
+        self.packets_replayed = 0
+        # Time spent in process_stream_request, in seconds
+        self.stream_time = 0.0
+        self.max_stream_time = 0.0
+        # (session time in ms, wall-clock time) of the first packet replayed
+        self._origin = None
+        self._steps = None
+        self._pending = None
+        self._on_finished = None
+        self._started = None
+        self._finished = None
+
+    def steps(self):
+        """Generator of the protocol calls of the replay, as (session time in ms or None, fn, args)"""
+        event_names = list(self.protocol.event_definition())
+        for number in self.reader.trial_numbers():
+            if (self.first_trial is not None and number < self.first_trial) or \
+                    (self.last_trial is not None and number > self.last_trial):
+                continue
+            packets = self.reader.packets(number)
+            row = self.reader.trial_row(number)
+            event = None if row is None else dict((name, row[name]) for name in event_names if name in row)
+            when = int(packets[0]['packet_sent_time']) if packets else None
+            yield when, self._start_trial, (row,)
+            for packet in packets:
+                when = int(packet['packet_sent_time'])
+                yield when, self._stream, (packet,)
+            yield when, self._end_trial, (event,)
+
+    def run(self):
+        """Replays the session on the calling thread. Returns the statistics"""
+        self._started = monotonic()
+        try:
+            for when, fn, args in self.steps():
+                delay = self._delay(when)
+                if delay > 0:
+                    time.sleep(delay)
+                fn(*args)
+        finally:
+            self._finished = monotonic()
+            self.reader.close()
+        return self.statistics()
+
+    def start(self, on_finished=None):
+        """Replays the session on the event loop. on_finished(statistics) is called at the end"""
+        self._steps = self.steps()
+        self._on_finished = on_finished
+        self._started = monotonic()
+        QTimer.singleShot(0, self._tick)
+
+    def statistics(self):
+        """Dictionary of the trials and packets replayed, the wall-clock seconds and the stream processing time"""
+        end = self._finished if self._finished is not None else monotonic()
+        return {'trials': self.trials_replayed,
+                'packets': self.packets_replayed,
+                'seconds': end - self._started if self._started is not None else 0.0,
+                'mean_stream_ms': 1000.0 * self.stream_time / self.packets_replayed if self.packets_replayed else 0.0,
+                'max_stream_ms': 1000.0 * self.max_stream_time}
+
+    def _tick(self):
+        tick_start = monotonic()
+        while True:
+            step = self._pending or next(self._steps, None)
+            self._pending = None
+            if step is None:
+                self._finished = monotonic()
+                self.reader.close()
+                if self._on_finished is not None:
+                    self._on_finished(self.statistics())
+                return
+            delay = self._delay(step[0])
+            if delay > 0:
+                self._pending = step
+                QTimer.singleShot(max(int(delay * 1000), 1), self._tick)
+                return
+            step[1](*step[2])
+            if monotonic() - tick_start > self.TICK_BUDGET:
+                # Let the event loop redraw before going on
+                QTimer.singleShot(0, self._tick)
+                return
+
+    def _delay(self, when):
+        """Seconds to wait before the step at session time when (ms)"""
+        if not self.speed or when is None:
+            return 0
+        if self._origin is None:
+            self._origin = (when, monotonic())
+            return 0
+        return self._origin[1] + (when - self._origin[0]) / (1000.0 * self.speed) - monotonic()
+
+    def _start_trial(self, row):
+        if row is not None:
+            self.protocol.restore_trial(row)
+        self.protocol.trial_parameters()
+        self.protocol.start_of_trial()
+
+    def _stream(self, packet):
+        start = default_timer()
+        self.protocol.process_stream_request(packet)
+        elapsed = default_timer() - start
+        self.stream_time += elapsed
+        self.max_stream_time = max(self.max_stream_time, elapsed)
+        self.packets_replayed += 1
+
+    def _end_trial(self, event):
+        self.protocol.end_of_trial()
+        if event is not None:
+            self.protocol.process_event_request(event)
+        self.trials_replayed += 1
+
+
+def print_statistics(statistics):
+    print "Trials replayed: ", statistics['trials'], " Packets replayed: ", statistics['packets']
+    print "Replay time (s): ", round(statistics['seconds'], 2)
+    print "Stream processing time mean (ms): ", round(statistics['mean_stream_ms'], 3), \
+        " max (ms): ", round(statistics['max_stream_ms'], 3)
+
+
+if __name__ == '__main__':
+    import argparse
+    from voyeur.qtcompat import HEADLESS
+    from voyeur.supervisor import load_factory
+
+    parser = argparse.ArgumentParser(description='Replay a recorded session through a protocol.')
+    parser.add_argument('filename', help='session file')
+    parser.add_argument('protocol', help='dotted path of the protocol factory, e.g. '
+                                         'src.passive_odor_presentation.create_protocol')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='session time per wall-clock time, 0 for as fast as possible')
+    parser.add_argument('--first-trial', type=int, default=None)
+    parser.add_argument('--last-trial', type=int, default=None)
+    args = parser.parse_args()
+
+    protocol = load_factory(args.protocol)(ARDUINO=0, OLFA=0)
+    replay = SessionReplay(args.filename, protocol, speed=args.speed,
+                           first_trial=args.first_trial, last_trial=args.last_trial)
+    if HEADLESS:
+        print_statistics(replay.run())
+    else:
+        replay.start(on_finished=print_statistics)
+        protocol.configure_traits()
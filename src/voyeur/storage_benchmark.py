@@ -0,0 +1,129 @@
+"""
+Write throughput and file size of the database for different storage settings.
+
+Writes the same synthetic session with each setting, flushing the way PersistorWriter does, and
+reports packets written per second and the size of the resulting file. Run with
+
+    python -m voyeur.storage_benchmark --minutes 10 --layout session
+"""
+
+import os
+import tempfile
+from timeit import default_timer
+from numpy import arange, sort, float32, int32, sin, pi
+from numpy.random import RandomState
+
+from voyeur import db
+from voyeur.db import Persistor, SessionPersistor, StorageSettings, SESSION_LAYOUT
+
+# Stream definition of the passive odor presentation protocol
+STREAM_DEFINITION = {"packet_sent_time": (1, 'unsigned long', db.Int),
+                     "sniff_samples": (2, 'unsigned int', db.Int),
+                     "sniff": (3, 'int', db.FloatArray),
+                     "lick1": (4, 'unsigned long', db.IntArray),
+                     "lick2": (5, 'unsigned long', db.IntArray),
+                     "mri": (6, 'unsigned long', db.FloatArray)}
+
+# Settings compared when none are given
+DEFAULT_SETTINGS = [('none', dict(complevel=0)),
+                    ('zlib-1', dict(complib='zlib', complevel=1)),
+                    ('zlib-5', dict(complib='zlib', complevel=5)),
+                    ('blosc-5', dict(complib='blosc', complevel=5)),
+                    ('lzo-5', dict(complib='lzo', complevel=5))]
+
+
+def synthetic_packets(count, samples_per_packet=10, packet_interval_ms=10, seed=0):
+    """Generates stream packets resembling a passive odor presentation session"""
+    random = RandomState(seed)
+    time_ms = 0
+    for i in xrange(count):
+        time_ms += packet_interval_ms
+        t = (time_ms - packet_interval_ms + arange(samples_per_packet)) / 1000.
+        sniff = (300 * sin(2 * pi * 3 * t) + random.normal(0, 10, samples_per_packet)).astype(float32)
+        # lick onset and offset times
+        licks = random.poisson(0.02)
+        lick1 = (time_ms - packet_interval_ms + sort(random.randint(0, packet_interval_ms, licks * 2))).astype(int32)
+        yield {"packet_sent_time": time_ms,
+               "sniff_samples": samples_per_packet,
+               "sniff": sniff,
+               "lick1": lick1,
+               "lick2": lick1[:0],
+               "mri": sniff[:0]}
+
+
+def run_benchmark(settings=None, minutes=10, trial_seconds=10, layout=SESSION_LAYOUT, flush_packets=200,
+                  directory=None):
+    """
+    Writes a synthetic session of the given length with each (label, StorageSettings) pair in settings.
+
+    Returns a list of (label, packets per second, file size in bytes).
+    """
+    if settings is None:
+        settings = [(label, StorageSettings(**kwargs)) for label, kwargs in DEFAULT_SETTINGS]
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    packet_interval_ms = 10
+    packets_per_trial = trial_seconds * 1000 // packet_interval_ms
+    trials = max(1, minutes * 60 // trial_seconds)
+
+    results = []
+    for label, storage in settings:
+        if layout == SESSION_LAYOUT:
+            persistor = SessionPersistor(storage)
+        else:
+            persistor = Persistor(storage)
+        persistor.auto_flush = False
+        filename = os.path.join(directory, 'benchmark_' + label)
+        try:
+            start = default_timer()
+            session_group = persistor.create_database(filename, {'benchmark': label})
+            persistor.create_trials({'trialNumber': db.Int},
+                                    {'trial_duration': (1, db.Int)},
+                                    {'response': (1, db.Int)},
+                                    session_group,
+                                    '')
+            written = 0
+            packets = synthetic_packets(trials * packets_per_trial, packet_interval_ms=packet_interval_ms)
+            for trial_number in range(1, trials + 1):
+                trial_group = persistor.add_trial(trial_number,
+                                                  {'trialNumber': trial_number},
+                                                  {'trial_duration': (1, db.Int, trial_seconds * 1000)},
+                                                  STREAM_DEFINITION,
+                                                  session_group,
+                                                  '')
+                for i in range(packets_per_trial):
+                    persistor.insert_stream(next(packets), trial_group)
+                    written += 1
+                    if written % flush_packets == 0:
+                        persistor.flush()
+            persistor.close_database()
+            elapsed = default_timer() - start
+        except ValueError as e:
+            # e.g. the compression library is not available in this PyTables build
+            print label, "not available: ", e
+            if persistor.h5file is not None and persistor.h5file.isopen:
+                persistor.close_database()
+            continue
+        size = os.path.getsize(filename + ".h5")
+        results.append((label, written / elapsed, size))
+        print "%-10s %10.0f packets/s %10.1f MB" % (label, written / elapsed, size / 1e6)
+        os.remove(filename + ".h5")
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare database write throughput and file size of storage settings.')
+    parser.add_argument('--minutes', type=int, default=10, help='length of the synthetic session')
+    parser.add_argument('--trial-seconds', type=int, default=10)
+    parser.add_argument('--layout', choices=(db.TRIAL_LAYOUT, SESSION_LAYOUT), default=SESSION_LAYOUT)
+    parser.add_argument('--flush-packets', type=int, default=200, help='packets written between flushes')
+    parser.add_argument('--directory', default=None, help='where the benchmark files are written')
+    args = parser.parse_args()
+
+    run_benchmark(minutes=args.minutes,
+                  trial_seconds=args.trial_seconds,
+                  layout=args.layout,
+                  flush_packets=args.flush_packets,
+                  directory=args.directory)
@@ -0,0 +1,356 @@
+'''
+Runs several behaviour rigs from one workstation.
+
+The [rigs] section of the rig config file lists the rigs, one subsection per rig:
+
+    [rigs]
+        [[box1]]
+            protocol = src.passive_odor_presentation.create_protocol
+            board = board1
+            port = port1                    # serial port of this host in the [serial] section
+            serial_path = /dev/ttyACM0      # optional, overrides port
+            data_directory = /VoyeurData/box1/
+            autostart = False
+
+RigSupervisor starts one worker process per rig. Each worker has its own Qt event loop, Monitor (serial port,
+serial and database threads, HDF5 file) and protocol, created by calling the protocol factory with the
+monitor, so a rig that crashes or stalls does not take the others with it. Workers report their statistics
+(CPU time, serial latency, lost packets) to the supervisor, which aggregates them.
+
+With VOYEUR_HEADLESS=1, the rigs run headless (see voyeur.headless).
+
+Example:
+    python -m voyeur.supervisor src/voyeur_rig_config.conf --interval 10
+'''
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+from Queue import Empty
+from timeit import default_timer
+from configobj import ConfigObj
+
+monotonic = getattr(time, 'monotonic', default_timer)
+
+# Seconds between statistics reports of the workers
+STATS_INTERVAL = 5.0
+
+
+class RigSpec(object):
+    """
+    Settings of one rig, from its subsection of the [rigs] section of the rig config file.
+
+    Attributes:
+        name            : name of the subsection
+        protocol        : dotted path of the protocol factory, called as factory(monitor=monitor)
+        config_file     : rig config file, passed on to the Monitor
+        board, port     : board and serial port of the rig in the config file
+        serial_path     : serial device, overriding port if set
+        data_directory  : directory of the database files of the rig
+        autostart       : start acquisition as soon as the protocol is up
+    """
+
+    def __init__(self, name, protocol, config_file, board='board1', port='port1', serial_path='',
+                 data_directory='/VoyeurData/', autostart=False):
+        self.name = name
+        self.protocol = protocol
+        self.config_file = config_file
+        self.board = board
+        self.port = port
+        self.serial_path = serial_path
+        self.data_directory = data_directory
+        self.autostart = autostart
+
+    @classmethod
+    def from_config(cls, config_file):
+        """Returns the RigSpec of each rig of the [rigs] section of config_file, in file order"""
+        rigs = ConfigObj(config_file).get('rigs', {})
+        return [cls.from_section(name, rigs[name], config_file) for name in rigs.sections]
+
+    @classmethod
+    def from_section(cls, name, section, config_file):
+        """
+        Returns the RigSpec of the config section of rig name. The rig config file is config_file, unless
+        the section gives another one as rig_config.
+        """
+        if 'protocol' not in section:
+            raise ValueError("Rig " + name + " has no protocol")
+        return cls(name,
+                   section['protocol'],
+                   section.get('rig_config', config_file),
+                   board=section.get('board', 'board1'),
+                   port=section.get('port', 'port1'),
+                   serial_path=section.get('serial_path', ''),
+                   data_directory=section.get('data_directory', os.path.join('/VoyeurData', name, '')),
+                   autostart=section.as_bool('autostart') if 'autostart' in section else False)
+
+    def monitor_options(self):
+        """Keyword arguments of the Monitor of the rig"""
+        return dict(config_file=self.config_file,
+                    board=self.board,
+                    port=self.port,
+                    serial_path=self.serial_path,
+                    data_directory=self.data_directory)
+
+
+def load_factory(path):
+    """Imports the callable at dotted path (package.module.name)"""
+    module_name, name = path.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+
+def rig_statistics(monitor):
+    """
+    Statistics of the acquisition of monitor, as a dictionary:
+        cpu_time            : CPU seconds used by the process
+        packets             : stream packets acquired
+        processed           : stream packets processed by the protocol
+        written             : stream packets written to the database
+        lost                : packets lost by the controller, overwritten or dropped in the stream buffer
+        mean_latency_ms     : mean wait of the serial calls
+        max_latency_ms      : maximum wait of the serial calls
+        max_interval_ms     : longest interval between two stream packets
+    """
+    times = os.times()
+    statistics = {'cpu_time': times[0] + times[1],
+                  'packets': monitor.acquired,
+                  'processed': monitor.processed,
+                  'written': 0,
+                  'lost': 0,
+                  'mean_latency_ms': 0.0,
+                  'max_latency_ms': 0.0,
+                  'max_interval_ms': 0.0}
+    if monitor.persistor_writer is not None:
+        statistics['written'] = monitor.persistor_writer.packets_written
+    if monitor.serial1 is not None:
+        statistics['lost'] += monitor.serial1.overflownpackets
+        statistics['max_interval_ms'] = monitor.serial1.maxRate * 1000.0
+        calls = 0
+        total_wait = 0.0
+        for stats in monitor.serial_queue1.stats.values():
+            lane_calls, max_depth, mean_wait, max_wait = stats.summary()
+            calls += lane_calls
+            total_wait += lane_calls * mean_wait
+            statistics['max_latency_ms'] = max(statistics['max_latency_ms'], max_wait)
+        if calls:
+            statistics['mean_latency_ms'] = total_wait / calls
+    if monitor.stream_buffer is not None:
+        statistics['lost'] += monitor.stream_buffer.overflows + monitor.stream_buffer.dropped
+    return statistics
+
+
+def run_rig(spec, reports, commands, interval=STATS_INTERVAL):
+    """
+    Body of a worker process: runs the protocol of the rig spec until its window is closed or the
+    supervisor sends 'stop'. Reports ('stats', name, statistics) every interval seconds on the reports
+    queue, and ('exit', name, None) before returning.
+
+    Headless (see voyeur.qtcompat), the rig runs as a HeadlessSession, which starts acquisition right away.
+    """
+    # Ctrl-C reaches every process of the terminal. The supervisor handles it and stops the workers in order.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from voyeur.qtcompat import HEADLESS, QTimer
+    if HEADLESS:
+        from voyeur.headless import HeadlessSession
+        session = HeadlessSession(spec)
+        monitor = session.monitor
+        protocol = session.protocol
+        run = session.run
+        quit = session.loop.quit
+    else:
+        # Every rig gets its own QApplication, created in the worker process
+        from PyQt4.Qt import QApplication
+        from voyeur.monitor import Monitor
+        app = QApplication.instance() or QApplication(sys.argv)
+        monitor = Monitor(**spec.monitor_options())
+        protocol = load_factory(spec.protocol)(monitor=monitor)
+        run = protocol.configure_traits
+        quit = app.quit
+
+    def toggle_acquisition():
+        # Same as the start/stop button of the protocols
+        protocol._start_button_fired()
+
+    def poll():
+        reports.put(('stats', spec.name, rig_statistics(monitor)))
+        try:
+            command = commands.get_nowait()
+        except Empty:
+            return
+        if command == 'start' and not monitor.running:
+            toggle_acquisition()
+        elif command == 'stop':
+            if monitor.running:
+                toggle_acquisition()
+            quit()
+
+    timer = QTimer()
+    timer.timeout.connect(poll)
+    timer.start(int(interval * 1000))
+    if spec.autostart and not HEADLESS:
+        QTimer.singleShot(0, toggle_acquisition)
+    try:
+        run()
+    finally:
+        timer.stop()
+        if monitor.running:
+            monitor.stop_acquisition()
+        reports.put(('stats', spec.name, rig_statistics(monitor)))
+        reports.put(('exit', spec.name, None))
+
+
+class RigWorker(object):
+    """A worker process running one rig, and the last statistics it reported"""
+
+    def __init__(self, spec, reports, interval=STATS_INTERVAL):
+        self.spec = spec
+        self.commands = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=run_rig, name=spec.name,
+                                               args=(spec, reports, self.commands, interval))
+        self.statistics = None
+        self.previous = None
+        self.reported = None
+        self.cpu_percent = 0.0
+
+    def start(self):
+        self.process.start()
+
+    def send(self, command):
+        self.commands.put(command)
+
+    def update(self, statistics):
+        """Records statistics reported by the worker, and its CPU use since the previous report"""
+        now = monotonic()
+        if self.statistics is not None and now > self.reported:
+            self.cpu_percent = 100.0 * (statistics['cpu_time'] - self.statistics['cpu_time']) / (now - self.reported)
+        self.statistics = statistics
+        self.reported = now
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+
+class RigSupervisor(object):
+    """
+    Starts and watches one RigWorker per rig of the rig config file.
+
+    Call poll regularly (run does) to collect the statistics reported by the workers. aggregate returns
+    the statistics summed over the rigs.
+    """
+
+    def __init__(self, config_file, rigs=None, interval=STATS_INTERVAL):
+        self.config_file = config_file
+        specs = RigSpec.from_config(config_file)
+        if rigs:
+            specs = [spec for spec in specs if spec.name in rigs]
+        if not specs:
+            raise ValueError("No rigs to run in " + config_file)
+        self.interval = interval
+        self.reports = multiprocessing.Queue()
+        self.workers = dict((spec.name, RigWorker(spec, self.reports, interval)) for spec in specs)
+        self.running = False
+
+    def start(self):
+        for name, worker in sorted(self.workers.items()):
+            print "Starting rig", name
+            worker.start()
+        self.running = True
+
+    def send(self, command, rigs=None):
+        """Sends 'start' or 'stop' to the workers of rigs, by default to all of them"""
+        for name, worker in self.workers.items():
+            if rigs is None or name in rigs:
+                worker.send(command)
+
+    def stop(self, timeout=30.0):
+        """Asks every worker to stop its acquisition and waits at most timeout seconds for them to exit"""
+        self.send('stop')
+        deadline = monotonic() + timeout
+        for worker in self.workers.values():
+            worker.process.join(max(deadline - monotonic(), 0))
+            if worker.is_alive():
+                print "Rig", worker.spec.name, "did not stop. Terminating it."
+                worker.process.terminate()
+        self.poll()
+        self.running = False
+
+    def poll(self, timeout=0):
+        """Collects the reports waiting from the workers. Returns the number of reports"""
+        count = 0
+        while True:
+            try:
+                kind, name, statistics = self.reports.get(timeout=timeout) if not count else \
+                    self.reports.get_nowait()
+            except Empty:
+                return count
+            count += 1
+            if kind == 'stats':
+                self.workers[name].update(statistics)
+            elif kind == 'exit':
+                print "Rig", name, "exited"
+
+    def aggregate(self):
+        """Statistics summed over the rigs that have reported (see rig_statistics), with cpu_percent"""
+        total = {'rigs': 0, 'running': 0, 'cpu_percent': 0.0, 'packets': 0, 'processed': 0, 'written': 0,
+                 'lost': 0, 'mean_latency_ms': 0.0, 'max_latency_ms': 0.0, 'max_interval_ms': 0.0}
+        for worker in self.workers.values():
+            total['running'] += 1 if worker.is_alive() else 0
+            statistics = worker.statistics
+            if statistics is None:
+                continue
+            total['rigs'] += 1
+            total['cpu_percent'] += worker.cpu_percent
+            for key in ('packets', 'processed', 'written', 'lost'):
+                total[key] += statistics[key]
+            for key in ('max_latency_ms', 'max_interval_ms'):
+                total[key] = max(total[key], statistics[key])
+            total['mean_latency_ms'] += statistics['mean_latency_ms']
+        if total['rigs']:
+            total['mean_latency_ms'] /= total['rigs']
+        return total
+
+    def report(self):
+        """Prints the statistics of every rig and the aggregate"""
+        for name, worker in sorted(self.workers.items()):
+            if worker.statistics is not None:
+                print "%-12s" % name, format_statistics(worker.statistics, worker.cpu_percent)
+        total = self.aggregate()
+        print "%-12s" % "all", format_statistics(total, total['cpu_percent']), \
+            "(%d of %d rigs running)" % (total['running'], len(self.workers))
+
+    def run(self):
+        """Starts the rigs and reports their statistics every interval until they all exit or Ctrl-C"""
+        self.start()
+        next_report = monotonic() + self.interval
+        try:
+            while any(worker.is_alive() for worker in self.workers.values()):
+                self.poll(timeout=max(next_report - monotonic(), 0.1))
+                if monotonic() >= next_report:
+                    self.report()
+                    next_report = monotonic() + self.interval
+        except KeyboardInterrupt:
+            print "Stopping rigs"
+            self.stop()
+        self.poll()
+        self.report()
+
+
+def format_statistics(statistics, cpu_percent):
+    return "CPU %5.1f%%  packets %8d  written %8d  lost %6d  latency mean %6.1f ms max %7.1f ms" \
+           % (cpu_percent, statistics['packets'], statistics['written'], statistics['lost'],
+              statistics['mean_latency_ms'], statistics['max_latency_ms'])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the rigs of a rig config file, one process per rig.')
+    parser.add_argument('config_file')
+    parser.add_argument('--rig', action='append', dest='rigs', help='rig to run (default all), can be repeated')
+    parser.add_argument('--interval', type=float, default=STATS_INTERVAL, help='seconds between reports')
+    args = parser.parse_args()
+
+    RigSupervisor(args.config_file, rigs=args.rigs, interval=args.interval).run()
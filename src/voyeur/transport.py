@@ -0,0 +1,553 @@
+'''
+Single threaded, event driven transport for the Voyeur serial protocol.
+
+One EventLoop multiplexes any number of controllers with select(), so a process can drive several boards
+without a SerialCallThread and an acquisition thread per port. Every request of a SerialTransport returns a
+Future, and coroutines written as generators that yield futures can wait on them:
+
+    def run_trial(transport, parameters):
+        started = yield transport.start_trial(parameters)
+        while True:
+            try:
+                stream = yield transport.request_stream(stream_def, timeout=0.5)
+            except EndOfTrialException:
+                break
+        event = yield transport.request_event(event_def)
+        raise Return(event)
+
+    loop = EventLoop()
+    transport = SerialTransport.from_serial_port(loop, SerialPort(config_file, path=emulator.port_name))
+    event = loop.run_until_complete(loop.spawn(run_trial(transport, parameters)))
+
+Every request has a timeout and can be cancelled. QtEventLoop runs the same loop from the Qt event loop,
+with a QSocketNotifier per port, so that UI code can spawn coroutines and add done callbacks to their
+futures. select() on serial ports needs a POSIX platform.
+
+This is a python 2 stand-in for an asyncio transport: generators and Return replace async/await.
+'''
+
+import heapq
+import select
+import time
+from collections import deque
+from timeit import default_timer
+
+from voyeur.arduino import StreamFrameParser, parse_serial
+from voyeur.exceptions import EndOfTrialException, TimeoutException, CancelledException
+
+monotonic = getattr(time, 'monotonic', default_timer)
+
+# Command codes of the serial protocol (see voyeur.arduino.SerialPort)
+USER_COMMAND = 86
+STREAM = 87
+EVENT = 88
+END = 89
+START_PUSH = 92
+STOP_PUSH = 93
+
+
+class Return(Exception):
+    """Raised by a coroutine to return value to whoever waits on it"""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """Result of an operation that completes later, on the event loop thread"""
+
+    def __init__(self):
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def result(self):
+        """Returns the result, or raises the exception, of a completed future"""
+        if not self._done:
+            raise RuntimeError("Future is not done")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) when the future completes, or right away if it has"""
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        if self._done:
+            return
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exception):
+        if self._done:
+            return
+        self._exception = exception
+        self._complete()
+
+    def cancel(self):
+        """Cancels the operation. Returns False if it had already completed"""
+        if self._done:
+            return False
+        self._cancelled = True
+        self.set_exception(CancelledException())
+        return True
+
+    def _complete(self):
+        self._done = True
+        callbacks = self._callbacks
+        self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+
+class Task(Future):
+    """
+    Runs a generator coroutine on the loop. The coroutine yields futures and is resumed with their result,
+    or their exception is thrown into it. The task completes with the value of Return, or with the exception
+    the coroutine raised. Cancelling the task cancels the future it is waiting on.
+    """
+
+    def __init__(self, loop, coroutine):
+        Future.__init__(self)
+        self.loop = loop
+        self.coroutine = coroutine
+        self._waiting = None
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        if self._done:
+            return False
+        if self._waiting is not None:
+            # Throws CancelledException into the coroutine, which may handle it
+            return self._waiting.cancel()
+        return Future.cancel(self)
+
+    def _step(self, value, exception):
+        self._waiting = None
+        if self._done:
+            return
+        try:
+            if exception is not None:
+                future = self.coroutine.throw(exception)
+            else:
+                future = self.coroutine.send(value)
+        except Return as r:
+            self.set_result(r.value)
+            return
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception as e:
+            self.set_exception(e)
+            return
+        if not isinstance(future, Future):
+            self.loop.call_soon(self._step, None, TypeError("Coroutines must yield futures, not " + repr(future)))
+            return
+        self._waiting = future
+        future.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        if future.exception() is not None:
+            self._step(None, future.exception())
+        else:
+            self._step(future.result(), None)
+
+
+class TimerHandle(object):
+    """A call scheduled on the loop"""
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop(object):
+    """
+    select() based event loop calling back readers of file descriptors, scheduled calls and coroutines.
+
+    All callbacks run on the thread that runs the loop. run_once runs one iteration, so the loop can also be
+    driven from another event loop (see QtEventLoop).
+    """
+
+    def __init__(self):
+        self._readers = {}
+        self._ready = deque()
+        self._timers = []
+        self.running = False
+
+    def time(self):
+        return monotonic()
+
+    def add_reader(self, fd, callback):
+        """Calls callback() whenever fd is readable"""
+        self._readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def call_soon(self, fn, *args):
+        handle = TimerHandle(0, fn, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_later(self, delay, fn, *args):
+        """Calls fn(*args) after delay seconds. Returns a handle that can cancel the call"""
+        handle = TimerHandle(self.time() + delay, fn, args)
+        heapq.heappush(self._timers, handle)
+        return handle
+
+    def spawn(self, coroutine):
+        """Runs a generator coroutine. Returns its Task"""
+        return Task(self, coroutine)
+
+    def wait_for(self, future, timeout):
+        """
+        Returns a future with the result of future, or failing with TimeoutException if future is not done
+        within timeout seconds, in which case future is cancelled
+        """
+        waiter = Future()
+
+        def expire():
+            if not future.done():
+                waiter.set_exception(TimeoutException(timeout))
+                future.cancel()
+
+        handle = self.call_later(timeout, expire)
+
+        def complete(done):
+            handle.cancel()
+            if done.exception() is not None:
+                waiter.set_exception(done.exception())
+            else:
+                waiter.set_result(done.result())
+
+        future.add_done_callback(complete)
+        return waiter
+
+    def sleep(self, seconds):
+        """Returns a future completing after seconds"""
+        future = Future()
+        self.call_later(seconds, future.set_result, None)
+        return future
+
+    def next_timeout(self):
+        """Seconds until the next scheduled call, 0 if calls are ready, None if nothing is scheduled"""
+        if self._ready:
+            return 0
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0].when - self.time())
+
+    def run_once(self, timeout=None):
+        """Waits at most timeout seconds (default until the next scheduled call) for readers, then runs callbacks"""
+        next_timeout = self.next_timeout()
+        if timeout is None or (next_timeout is not None and next_timeout < timeout):
+            timeout = next_timeout
+        if self._readers:
+            readable, _, _ = select.select(list(self._readers), [], [], timeout)
+            for fd in readable:
+                callback = self._readers.get(fd)
+                if callback is not None:
+                    callback()
+        elif timeout:
+            time.sleep(timeout)
+        self._run_due()
+
+    def _run_due(self):
+        now = self.time()
+        while self._timers and self._timers[0].when <= now:
+            self._ready.append(heapq.heappop(self._timers))
+        for i in range(len(self._ready)):
+            handle = self._ready.popleft()
+            if not handle.cancelled:
+                handle.fn(*handle.args)
+
+    def run_until_complete(self, future):
+        """Runs the loop until future is done and returns its result"""
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+
+class QtEventLoop(EventLoop):
+    """
+    EventLoop run by the Qt event loop of the UI thread.
+
+    Readers are watched with QSocketNotifiers and scheduled calls with a single shot QTimer, so no thread
+    is involved and coroutine results are delivered on the UI thread.
+    """
+
+    def __init__(self):
+        from PyQt4.QtCore import QSocketNotifier, QTimer
+        EventLoop.__init__(self)
+        self._notifier_class = QSocketNotifier
+        self._notifiers = {}
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._process)
+
+    def add_reader(self, fd, callback):
+        EventLoop.add_reader(self, fd, callback)
+        notifier = self._notifier_class(fd, self._notifier_class.Read)
+        notifier.activated.connect(lambda fd: self._on_readable(fd))
+        self._notifiers[fd] = notifier
+
+    def remove_reader(self, fd):
+        EventLoop.remove_reader(self, fd)
+        notifier = self._notifiers.pop(fd, None)
+        if notifier is not None:
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+
+    def call_soon(self, fn, *args):
+        handle = EventLoop.call_soon(self, fn, *args)
+        self._schedule()
+        return handle
+
+    def call_later(self, delay, fn, *args):
+        handle = EventLoop.call_later(self, delay, fn, *args)
+        self._schedule()
+        return handle
+
+    def run_until_complete(self, future):
+        raise RuntimeError("QtEventLoop is run by the Qt event loop; add a done callback to the future instead")
+
+    def _on_readable(self, fd):
+        callback = self._readers.get(fd)
+        if callback is not None:
+            callback()
+        self._process()
+
+    def _process(self):
+        self._run_due()
+        self._schedule()
+
+    def _schedule(self):
+        timeout = self.next_timeout()
+        if timeout is not None:
+            self._timer.start(int(timeout * 1000))
+
+
+class _Request(object):
+    """A command sent to the controller and the reply it waits for"""
+
+    def __init__(self, data, kind, parse, future, timeout):
+        self.data = data
+        # 'stream' if the reply is a stream packet, 'line' if it is a text line
+        self.kind = kind
+        # Converts the reply to the result of the future
+        self.parse = parse
+        self.future = future
+        self.timeout = timeout
+        self.timer = None
+
+
+class SerialTransport(object):
+    """
+    Non blocking client of one behaviour controller on an EventLoop.
+
+    Requests are queued and sent one at a time, as the controller answers each command before reading
+    the next. Commands (trial control, events, user commands) are sent ahead of queued stream requests.
+    A request that gets no reply within its timeout fails with TimeoutException; the input is then
+    discarded to resynchronize with the controller. A cancelled request still waits for its reply, which
+    is dropped.
+    """
+
+    # Seconds to wait for a reply when no timeout is given
+    DEFAULT_TIMEOUT = 1.0
+
+    def __init__(self, loop, serial, decoder_factory, packer_factory):
+        self.loop = loop
+        self.serial = serial
+        self.serial.timeout = 0
+        self.decoder_factory = decoder_factory
+        self.packer_factory = packer_factory
+        self._parser = StreamFrameParser()
+        self._commands = deque()
+        self._streams = deque()
+        self._current = None
+        # Push mode callbacks (see start_streaming)
+        self._stream_def = None
+        self._on_packet = None
+        self._on_end_of_trial = None
+        self.timeouts = 0
+        loop.add_reader(self.serial.fileno(), self._on_readable)
+
+    @classmethod
+    def from_serial_port(cls, loop, serial_port):
+        """Takes over the port of a voyeur.arduino.SerialPort, with its decoder and parameter packer"""
+        transport = cls(loop, serial_port.serial, serial_port.stream_decoder, serial_port.parameter_packer)
+        transport.serial_port = serial_port
+        return transport
+
+    def close(self):
+        self.loop.remove_reader(self.serial.fileno())
+        for request in [self._current] + list(self._commands) + list(self._streams):
+            if request is not None:
+                request.future.cancel()
+        self._current = None
+        self._commands.clear()
+        self._streams.clear()
+
+    #--------------------------------------------------------------------------
+    # Requests
+    #--------------------------------------------------------------------------
+
+    def request_stream(self, stream_def, timeout=None):
+        """Future of the next stream packet. Fails with EndOfTrialException at the end of the trial"""
+        decoder = self.decoder_factory(stream_def)
+
+        def parse(reply):
+            if reply[0] == 'stream':
+                self._record_stream_time()
+                return decoder.decode(reply[2], reply[1])
+            # Text reply to a stream request, e.g. the end of trial code
+            return parse_serial(reply[1], stream_def, None)
+
+        return self._send(chr(STREAM), 'stream', parse, timeout, self._streams)
+
+    def request_event(self, event_def, timeout=None):
+        """Future of the event (trial results) of the last trial"""
+        return self._send(chr(EVENT), 'line', lambda reply: parse_serial(reply[1], event_def, None), timeout)
+
+    def start_trial(self, parameters, timeout=None):
+        """Future of True if the controller acknowledged the start of the trial"""
+        frame = self.packer_factory(parameters).pack(parameters)
+        return self._send(frame, 'line', lambda reply: _acknowledged(reply, '2'), timeout)
+
+    def end_trial(self, timeout=None):
+        """Future of True if the controller acknowledged the end of the trial"""
+        return self._send(chr(END), 'line', lambda reply: _acknowledged(reply, '3'), timeout)
+
+    def user_def_command(self, command, timeout=None):
+        """Future of True if the controller acknowledged the user defined command"""
+        return self._send(chr(USER_COMMAND) + command + "\r", 'line', lambda reply: _acknowledged(reply, '2'),
+                          timeout)
+
+    def start_streaming(self, stream_def, on_packet, on_end_of_trial=None, timeout=None):
+        """
+        Switches the controller to push mode. on_packet(stream) is then called for every stream packet and
+        on_end_of_trial() when the controller signals the end of a trial. Future of True if acknowledged.
+        """
+        self._stream_def = stream_def
+        self._on_packet = on_packet
+        self._on_end_of_trial = on_end_of_trial
+        return self._send(chr(START_PUSH), 'line', lambda reply: _acknowledged(reply, '2'), timeout)
+
+    def stop_streaming(self, timeout=None):
+        """Switches the controller back to request mode. Future of True if acknowledged"""
+        def parse(reply):
+            self._on_packet = None
+            self._on_end_of_trial = None
+            return _acknowledged(reply, '2')
+        return self._send(chr(STOP_PUSH), 'line', parse, timeout)
+
+    #--------------------------------------------------------------------------
+    # Internals
+    #--------------------------------------------------------------------------
+
+    def _send(self, data, kind, parse, timeout, lane=None):
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+        if lane is None:
+            lane = self._commands
+        request = _Request(data, kind, parse, Future(), timeout)
+        lane.append(request)
+        if self._current is None:
+            self._send_next()
+        return request.future
+
+    def _send_next(self):
+        self._current = None
+        while self._commands or self._streams:
+            lane = self._commands if self._commands else self._streams
+            request = lane.popleft()
+            if request.future.done():
+                # Cancelled before it was sent
+                continue
+            self._current = request
+            request.timer = self.loop.call_later(request.timeout, self._expire, request)
+            self.serial.write(request.data)
+            return
+
+    def _expire(self, request):
+        if request is not self._current:
+            return
+        self.timeouts += 1
+        # The reply may still arrive, possibly in the middle of a stream packet. Start over.
+        self.serial.flushInput()
+        self._parser = StreamFrameParser()
+        request.future.set_exception(TimeoutException(request.timeout))
+        self._send_next()
+
+    def _on_readable(self):
+        data = self.serial.read(max(1, self.serial.inWaiting()))
+        for frame in self._parser.feed(data):
+            self._dispatch(frame)
+
+    def _dispatch(self, frame):
+        request = self._current
+        if frame[0] == 'stream':
+            if request is not None and request.kind == 'stream':
+                self._complete(request, frame)
+            elif self._on_packet is not None:
+                self._record_stream_time()
+                self._on_packet(self.decoder_factory(self._stream_def).decode(frame[2], frame[1]))
+            return
+        if frame[1][:1] == '5' and self._on_end_of_trial is not None and \
+                (request is None or request.kind != 'stream'):
+            self._on_end_of_trial()
+            return
+        if request is not None:
+            self._complete(request, frame)
+
+    def _complete(self, request, reply):
+        request.timer.cancel()
+        try:
+            request.future.set_result(request.parse(reply))
+        except Exception as e:
+            request.future.set_exception(e)
+        self._send_next()
+
+    def _record_stream_time(self):
+        serial_port = getattr(self, 'serial_port', None)
+        if serial_port is not None:
+            serial_port.record_stream_time()
+
+
+def _acknowledged(reply, code):
+    return reply[0] == 'line' and reply[1][:1] == code
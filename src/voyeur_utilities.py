@@ -10,7 +10,10 @@ Version: 1.1
 @author: Pei-Ching Chang
 '''
 
-from pyface.api import Dialog, ConfirmationDialog, FileDialog, YES, NO, OK, DirectoryDialog, error, warning, information, CANCEL
+from voyeur.qtcompat import HEADLESS
+if not HEADLESS:
+    # Dialogs of save_data_file
+    from pyface.api import Dialog, ConfirmationDialog, FileDialog, YES, NO, OK, DirectoryDialog, error, warning, information, CANCEL
 
 from configobj import ConfigObj
 from shutil import copy2
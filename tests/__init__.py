@@ -0,0 +1,19 @@
+'''
+Tests of the parts of Voyeur and the protocols that run without hardware.
+
+Modules are imported as the protocols import them, so both the repository root and src have to be on
+the path. The tests run headless (see voyeur.qtcompat), so no GUI toolkit is needed. Run from the
+repository root:
+    python -m unittest discover -s tests -t .
+'''
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, 'src'), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Before voyeur is first imported
+os.environ.setdefault('VOYEUR_HEADLESS', '1')
@@ -0,0 +1,64 @@
+'''
+Small session files written with the Persistors, in either layout, for the reader and replay tests.
+'''
+
+import os
+from numpy import array, float32, int32
+
+import voyeur.db as db
+
+STREAM_DEFINITION = {
+    "packet_sent_time": (1, 'unsigned long', db.Int),
+    "sniff_samples": (2, 'unsigned int', db.Int),
+    "sniff": (3, 'int', db.FloatArray),
+    "lick1": (4, 'unsigned long', db.IntArray),
+}
+
+PROTOCOL_PARAMETERS = {"odorvalve": db.Int, "trial_category": db.String32}
+CONTROLLER_PARAMETERS = {"trialNumber": db.Int}
+EVENT_DEFINITION = {"trial_start": (1, db.Int), "response": (2, db.Int)}
+
+# A lost packet decodes to None in every stream
+LOST = {"packet_sent_time": None, "sniff_samples": None, "sniff": None, "lick1": None}
+
+
+def packet(time, sniff=None, lick1=None):
+    """Stream packet as decoded from the controller. Channels that sent nothing are None"""
+    return {"packet_sent_time": time,
+            "sniff_samples": len(sniff) if sniff is not None else 0,
+            "sniff": array(sniff, dtype=float32) if sniff is not None else None,
+            "lick1": array(lick1, dtype=int32) if lick1 is not None else None}
+
+
+# (trial number, protocol parameters, stream packets, event) of each trial. Trial 1 has packets with no
+# sniff or no lick samples and a lost packet.
+TRIALS = [
+    (1, {"odorvalve": 5, "trial_category": "Left"},
+     [packet(10, [1, 2]),
+      packet(20, [3], [15, 18]),
+      LOST,
+      packet(40, None, [35]),
+      packet(50, [5, 6])],
+     {"trial_start": 12, "response": 1}),
+    (2, {"odorvalve": 8, "trial_category": "Right"},
+     [packet(60, [7], [55]),
+      packet(70, [8])],
+     {"trial_start": 61, "response": 3}),
+]
+
+
+def write_session(directory, layout=db.TRIAL_LAYOUT, trials=TRIALS, metadata=None):
+    """Writes trials to a new session file in directory with the Persistor of layout. Returns the file name"""
+    persistor = db.SessionPersistor() if layout == db.SESSION_LAYOUT else db.Persistor()
+    filename = os.path.join(directory, 'session_' + layout)
+    session_group = persistor.create_database(filename, metadata or {})
+    persistor.create_trials(PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS, EVENT_DEFINITION, session_group, '')
+    for number, parameters, packets, event in trials:
+        controller_parameters = {"trialNumber": (1, db.Int, number)}
+        trial_group = persistor.add_trial(number, parameters, controller_parameters, STREAM_DEFINITION,
+                                          session_group, '')
+        for stream in packets:
+            persistor.insert_stream(stream, trial_group)
+        persistor.insert_event(event, session_group)
+    persistor.close_database()
+    return filename + '.h5'
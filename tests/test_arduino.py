@@ -0,0 +1,376 @@
+import os
+import struct
+import threading
+import unittest
+
+from numpy import float32, int32
+from numpy.testing import assert_array_equal
+from serial import SerialException
+
+import voyeur.db as db
+import voyeur.arduino as arduino
+from voyeur.arduino import SerialPort, StreamDecoder, StreamFrameParser, StreamReaderThread, ParameterPacker,\
+    parse_stream_header, SerialCallThread, LaneStats, COMMAND_PRIORITY, STREAM_PRIORITY
+from voyeur.buffers import PacketRingBuffer
+from tests.session_files import STREAM_DEFINITION
+
+# Stream packet of trial time 1000 with two sniff samples and no lick, as pushed by the controller
+PACKET_HEADER = '6,4,4,2,4,0\r\n'
+PACKET_PAYLOAD = struct.pack('<IH2h', 1000, 2, 3, -4)
+
+
+class Clock(object):
+    """Stands in for arduino.monotonic, advanced by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SerialCallThreadTest(unittest.TestCase):
+    """The lanes are driven through _put and _get, without starting the thread"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.addCleanup(setattr, arduino, 'monotonic', arduino.monotonic)
+        arduino.monotonic = self.clock
+        self.thread = SerialCallThread(max_queue_size=2)
+
+    def put(self, priority, name):
+        self.thread._put(priority, (name, (), {}))
+
+    def get(self):
+        call = self.thread._get(timeout=0)
+        return call and call[0]
+
+    def test_commands_preempt_stream_calls(self):
+        self.put(STREAM_PRIORITY, 'stream1')
+        self.put(COMMAND_PRIORITY, 'command1')
+        self.put(STREAM_PRIORITY, 'stream2')
+        self.put(COMMAND_PRIORITY, 'command2')
+        self.assertEqual([self.get() for i in range(4)], ['command1', 'command2', 'stream1', 'stream2'])
+        self.assertTrue(self.thread.empty())
+
+    def test_get_times_out(self):
+        self.assertIsNone(self.thread._get(timeout=0.01))
+
+    def test_full_stream_lane_blocks_put(self):
+        self.put(STREAM_PRIORITY, 'stream1')
+        self.put(STREAM_PRIORITY, 'stream2')
+        blocked = threading.Thread(target=self.put, args=(STREAM_PRIORITY, 'stream3'))
+        blocked.start()
+        blocked.join(0.05)
+        self.assertTrue(blocked.is_alive())
+        # The command lane is unbounded and still accepts calls
+        self.put(COMMAND_PRIORITY, 'command')
+        self.assertEqual(self.get(), 'command')
+        self.assertTrue(blocked.is_alive())
+        self.assertEqual(self.get(), 'stream1')
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        self.assertEqual([self.get(), self.get()], ['stream2', 'stream3'])
+
+    def test_lane_stats(self):
+        self.put(STREAM_PRIORITY, 'stream1')
+        self.put(STREAM_PRIORITY, 'stream2')
+        self.put(COMMAND_PRIORITY, 'command')
+        self.clock.now += 0.25
+        self.get()
+        self.clock.now += 0.5
+        self.get()
+        self.clock.now += 0.25
+        self.get()
+        self.assertEqual(self.thread.stats[COMMAND_PRIORITY].summary(), (1, 1, 250.0, 250.0))
+        self.assertEqual(self.thread.stats[STREAM_PRIORITY].summary(), (2, 2, 875.0, 1000.0))
+
+    def test_run_serves_the_remaining_calls_once_stopped(self):
+        calls = []
+
+        class Monitor(object):
+            running = False
+
+        thread = SerialCallThread(Monitor(), max_queue_size=2)
+        thread.enqueue(calls.append, 'stream')
+        thread.enqueue_command(calls.append, 'command')
+        thread.run()
+        self.assertEqual(calls, ['command', 'stream'])
+
+
+class LaneStatsTest(unittest.TestCase):
+
+    def test_summary(self):
+        stats = LaneStats()
+        self.assertEqual(stats.summary(), (0, 0, 0.0, 0.0))
+        stats.queued(3)
+        stats.queued(1)
+        stats.served(0.002)
+        stats.served(0.004)
+        calls, depth, mean_wait, max_wait = stats.summary()
+        self.assertEqual((calls, depth), (2, 3))
+        self.assertAlmostEqual(mean_wait, 3.0)
+        self.assertAlmostEqual(max_wait, 4.0)
+
+
+class StreamDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = StreamDecoder(STREAM_DEFINITION)
+
+    def test_fields_in_index_order(self):
+        self.assertEqual([field[0] for field in self.decoder.fields],
+                         ['packet_sent_time', 'sniff_samples', 'sniff', 'lick1'])
+
+    def test_decode(self):
+        payload = struct.pack('<IH3hII', 1000, 3, 3, -4, 500, 15, 70000)
+        data = self.decoder.decode(payload, [4, 2, 6, 8])
+        self.assertEqual(data['packet_sent_time'], 1000)
+        self.assertIsInstance(data['packet_sent_time'], int)
+        self.assertEqual(data['sniff_samples'], 3)
+        self.assertEqual(data['sniff'].dtype, float32)
+        assert_array_equal(data['sniff'], [3, -4, 500])
+        self.assertEqual(data['lick1'].dtype, int32)
+        assert_array_equal(data['lick1'], [15, 70000])
+
+    def test_empty_streams(self):
+        data = self.decoder.decode(struct.pack('<IH', 20, 0), [4, 2, 0, 0])
+        self.assertEqual(data['packet_sent_time'], 20)
+        self.assertIsNone(data['sniff'])
+        self.assertIsNone(data['lick1'])
+
+    def test_lost_packet(self):
+        self.assertEqual(self.decoder.decode(None, [4, 2, 6, 0]),
+                         dict((name, None) for name in STREAM_DEFINITION))
+
+
+class StreamFrameParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = StreamFrameParser()
+
+    def test_stream_header(self):
+        self.assertEqual(parse_stream_header(PACKET_HEADER), [4, 2, 4, 0])
+        self.assertIsNone(parse_stream_header('6,*\r\n'))
+        self.assertIsNone(parse_stream_header('2,*\r\n'))
+
+    def test_lines_and_packets(self):
+        frames = self.parser.feed('2,*\r\n' + PACKET_HEADER + PACKET_PAYLOAD + '5,*\r\n')
+        self.assertEqual(frames, [('line', '2,*\r\n'), ('stream', [4, 2, 4, 0], PACKET_PAYLOAD), ('line', '5,*\r\n')])
+
+    def test_end_trial_reply_followed_by_packet(self):
+        frames = self.parser.feed('3,*\r\n' + PACKET_HEADER + PACKET_PAYLOAD)
+        self.assertEqual(frames, [('line', '3,*\r\n'), ('stream', [4, 2, 4, 0], PACKET_PAYLOAD)])
+
+    def test_split_reads(self):
+        # The payload contains a newline byte, which must not end the frame
+        payload = struct.pack('<IH2h', 10, 2, 3, 10)
+        data = PACKET_HEADER + payload + '4,1,2*\r\n'
+        frames = []
+        for i in range(len(data)):
+            frames.extend(self.parser.feed(data[i]))
+        self.assertEqual(frames, [('stream', [4, 2, 4, 0], payload), ('line', '4,1,2*\r\n')])
+
+
+class FakeSerial(object):
+    """Port returning chunks of bytes, then failing"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def inWaiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size):
+        if not self.chunks:
+            raise SerialException('device disconnected')
+        return self.chunks.pop(0)
+
+
+class FakeSerialPort(object):
+    """The parts of SerialPort used by StreamReaderThread"""
+
+    def __init__(self, chunks):
+        self.serial = FakeSerial(chunks)
+        self.latencies = []
+
+    def stream_decoder(self, stream_def):
+        return StreamDecoder(stream_def)
+
+    def record_stream_time(self):
+        pass
+
+    def record_latency(self, stage, seconds):
+        self.latencies.append(stage)
+
+
+class StreamReaderThreadTest(unittest.TestCase):
+
+    def run_reader(self, chunks):
+        self.calls = []
+        self.buffer = PacketRingBuffer(capacity=8)
+        self.reader = StreamReaderThread(FakeSerialPort(chunks), STREAM_DEFINITION, self.buffer,
+                                         on_packets=lambda: self.calls.append('packets'),
+                                         on_end_of_trial=lambda: self.calls.append('end_of_trial'),
+                                         on_error=lambda error: self.calls.append(error))
+        self.reader.running = True
+        # Runs on this thread until the fake port fails
+        self.reader.run()
+
+    def test_packets_replies_and_end_of_trial(self):
+        self.run_reader(['2,*\r\n6,4,', '4,2,4,0\r\n' + PACKET_PAYLOAD[:3], PACKET_PAYLOAD[3:] + '5,*\r\n'])
+        packets = self.buffer.drain()
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0]['packet_sent_time'], 1000)
+        assert_array_equal(packets[0]['sniff'], [3, -4])
+        self.assertEqual(self.reader.read_line(0), '2,*\r\n')
+        self.assertEqual(self.reader.read_line(0), '')
+        self.assertEqual(self.calls[:2], ['packets', 'end_of_trial'])
+
+    def test_consumer_notified_when_buffer_becomes_non_empty(self):
+        self.run_reader([PACKET_HEADER + PACKET_PAYLOAD] * 3)
+        self.assertEqual(len(self.buffer), 3)
+        self.assertEqual(self.calls.count('packets'), 1)
+
+    def test_port_failure_is_reported(self):
+        self.run_reader([])
+        self.assertFalse(self.reader.running)
+        self.assertEqual(len(self.calls), 1)
+        self.assertIsInstance(self.calls[0], SerialException)
+
+
+class RepliesSerial(object):
+    """Port answering every write with the next of a list of reply lines"""
+
+    timeout = 1
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def readline(self):
+        return self.replies.pop(0)
+
+
+class StreamingModeTest(unittest.TestCase):
+
+    def serial_port(self, replies):
+        # A SerialPort without a configuration file
+        port = SerialPort.__new__(SerialPort)
+        port.serial = RepliesSerial(replies)
+        return port
+
+    def test_start_streaming_rejects_other_replies(self):
+        for reply in ['6,4,4,2\r\n', '\x87\x01*\r\n', '', None]:
+            port = self.serial_port([reply])
+            self.assertFalse(port.start_streaming(STREAM_DEFINITION, PacketRingBuffer()))
+            self.assertEqual(port.serial.written, [chr(92)])
+            self.assertIsNone(port._reader)
+
+    def test_stop_streaming_on_a_late_packet_header(self):
+        port = self.serial_port([])
+        reader = StreamReaderThread(port, STREAM_DEFINITION, PacketRingBuffer())
+        reader.replies.put('6,4,4,2,4,0\r\n')
+        port._reader = reader
+        self.assertFalse(port.stop_streaming())
+        self.assertIsNone(port._reader)
+
+
+class PipeSerial(object):
+    """Port receiving bytes through a pipe, whose timeout must not change"""
+
+    def __init__(self):
+        self.received = ''
+        self.flushed = False
+        self._read_fd, self._write_fd = os.pipe()
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    @property
+    def timeout(self):
+        return 1
+
+    @timeout.setter
+    def timeout(self, value):
+        raise AssertionError("Port reconfigured")
+
+    def receive(self, data):
+        self.received += data
+        os.write(self._write_fd, 'x')
+
+    def fileno(self):
+        return self._read_fd
+
+    def inWaiting(self):
+        return len(self.received)
+
+    def read(self, size):
+        data, self.received = self.received[:size], self.received[size:]
+        if not self.received:
+            os.read(self._read_fd, 4096)
+        return data
+
+    def flushInput(self):
+        self.flushed = True
+        self.received = ''
+
+
+@unittest.skipIf(os.name != 'posix', "Waits on a pipe")
+class ReadByteStreamsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = SerialPort.__new__(SerialPort)
+        self.port.serial = PipeSerial()
+
+    def tearDown(self):
+        self.port.serial.close()
+
+    def test_bytes_arriving_later(self):
+        self.port.serial.receive('ab')
+        timer = threading.Timer(0.02, self.port.serial.receive, ('cdef',))
+        timer.start()
+        self.assertEqual(self.port.read_byte_streams(4, timeout=5), 'abcd')
+        timer.join()
+        # The rest is left for the next frame
+        self.assertEqual(self.port.serial.received, 'ef')
+
+    def test_deadline(self):
+        self.port.serial.receive('ab')
+        self.assertIsNone(self.port.read_byte_streams(4, timeout=0.02))
+        self.assertTrue(self.port.serial.flushed)
+
+
+class ParameterPackerTest(unittest.TestCase):
+
+    PARAMETERS = {
+        "trialNumber": (1, db.Int, 12),
+        "odorvalve": (3, db.Int, -5),
+        "duration": (2, db.Int16, 500),
+        "flow": (4, db.Float, 0.5),
+    }
+
+    def test_pack_in_index_order(self):
+        frame = ParameterPacker(self.PARAMETERS).pack(self.PARAMETERS)
+        self.assertEqual(frame, chr(90) + struct.pack('<ihif', 12, 500, -5, 0.5))
+
+    def test_without_trial_number(self):
+        packer = ParameterPacker(self.PARAMETERS, send_trial_number=False)
+        self.assertEqual(packer.names, ['duration', 'odorvalve', 'flow'])
+        self.assertEqual(packer.pack(self.PARAMETERS), chr(90) + struct.pack('<hif', 500, -5, 0.5))
+
+    def test_definition_without_values(self):
+        definition = dict((name, spec[:2]) for name, spec in self.PARAMETERS.items())
+        packer = ParameterPacker(definition)
+        self.assertEqual(packer.pack(self.PARAMETERS), ParameterPacker(self.PARAMETERS).pack(self.PARAMETERS))
+
+    def test_unknown_type(self):
+        self.assertRaises(ValueError, ParameterPacker, {"sniff": (1, db.FloatArray, None)})
+
+
+if __name__ == '__main__':
+    unittest.main()
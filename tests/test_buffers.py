@@ -0,0 +1,72 @@
+import time
+import threading
+import unittest
+
+from voyeur.buffers import PacketRingBuffer, DROP_NEWEST, BLOCK
+
+
+class PacketRingBufferTest(unittest.TestCase):
+
+    def test_fifo(self):
+        buffer = PacketRingBuffer(capacity=4)
+        self.assertTrue(buffer.put(1))
+        self.assertFalse(buffer.put(2))
+        self.assertFalse(buffer.put(3))
+        self.assertEqual(buffer.drain(2), [1, 2])
+        buffer.put(4)
+        buffer.put(5)
+        self.assertEqual(buffer.drain(), [3, 4, 5])
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.high_water, 3)
+
+    def test_full_buffer_overwrites_oldest(self):
+        buffer = PacketRingBuffer(capacity=3)
+        for packet in range(5):
+            buffer.put(packet)
+        self.assertEqual(buffer.overflows, 2)
+        self.assertEqual(buffer.drain(), [2, 3, 4])
+
+    def test_wait_and_clear(self):
+        buffer = PacketRingBuffer(capacity=3)
+        self.assertFalse(buffer.wait(0.01))
+        buffer.put('packet')
+        self.assertTrue(buffer.wait(0.01))
+        buffer.clear()
+        self.assertEqual(buffer.drain(), [])
+        self.assertTrue(buffer.put('packet'))
+
+    def test_full_buffer_drops_newest(self):
+        buffer = PacketRingBuffer(capacity=3, policy=DROP_NEWEST)
+        for packet in range(5):
+            buffer.put(packet)
+        self.assertEqual(buffer.dropped, 2)
+        self.assertEqual(buffer.overflows, 0)
+        self.assertEqual(buffer.drain(), [0, 1, 2])
+
+    def test_full_buffer_blocks_until_timeout(self):
+        buffer = PacketRingBuffer(capacity=2, policy=BLOCK, timeout=0.05)
+        buffer.put(0)
+        buffer.put(1)
+        start = time.time()
+        self.assertFalse(buffer.put(2))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(buffer.drain(), [0, 1])
+
+    def test_full_buffer_blocks_until_drained(self):
+        buffer = PacketRingBuffer(capacity=2, policy=BLOCK, timeout=5)
+        buffer.put(0)
+        buffer.put(1)
+        consumer = threading.Timer(0.05, buffer.drain, (1,))
+        consumer.start()
+        buffer.put(2)
+        consumer.join()
+        self.assertEqual(buffer.dropped, 0)
+        self.assertEqual(buffer.drain(), [1, 2])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, PacketRingBuffer, 4, 'drop_all')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import voyeur.db as db
+from voyeur.reader import SessionReader
+from tests.session_files import (STREAM_DEFINITION, PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS,
+                                 EVENT_DEFINITION, packet)
+
+
+class PersistorWriterTest(unittest.TestCase):
+    """A PersistorWriter writing a session file in a temporary directory"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'session')
+
+    def tearDown(self):
+        self.writer.stop()
+        if self.writer.persistor.h5file is not None and self.writer.persistor.h5file.isopen:
+            self.writer.persistor.close_database()
+        shutil.rmtree(self.directory)
+
+    def start_writer(self, **settings):
+        """Starts a writer with a new session file and its first trial"""
+        persistor = db.Persistor()
+        self.writer = db.PersistorWriter(persistor, **settings)
+        self.writer.start()
+        self.session_group = self.writer.call(persistor.create_database, self.filename, {})
+        self.writer.call(persistor.create_trials, PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS, EVENT_DEFINITION,
+                         self.session_group, '')
+        self.writer.add_trial(1, {"odorvalve": 5, "trial_category": "Left"}, {"trialNumber": (1, db.Int, 1)},
+                              STREAM_DEFINITION, self.session_group, '')
+        return persistor
+
+    def state(self):
+        """(flushes, packets not flushed yet), read on the writer thread after everything queued so far"""
+        return self.writer.call(lambda: (self.writer.flushes, self.writer._pending_packets))
+
+    def test_calls_run_in_order_on_the_writer_thread(self):
+        self.writer = db.PersistorWriter(db.Persistor())
+        self.writer.start()
+        calls = []
+        for i in range(5):
+            self.writer.submit(lambda i=i: calls.append((i, threading.current_thread().name)))
+        self.assertEqual(self.writer.call(len, calls), 5)
+        self.assertEqual(calls, [(i, 'PersistorWriter') for i in range(5)])
+
+    def test_errors(self):
+        self.writer = db.PersistorWriter(db.Persistor())
+        self.writer.start()
+        self.assertRaises(ZeroDivisionError, self.writer.call, lambda: 1 / 0)
+        # Submitted calls cannot raise in the caller, they are counted
+        self.writer.submit(lambda: 1 / 0)
+        self.assertEqual(self.writer.call(lambda: self.writer.errors), 1)
+        self.assertTrue(self.writer.is_alive())
+
+    def test_flushed_every_flush_packets(self):
+        self.start_writer(flush_packets=3, flush_bytes=1 << 20, flush_interval=60)
+        self.writer.insert_streams([packet(10, [1]), packet(20, [2])])
+        self.assertEqual(self.state(), (0, 2))
+        self.writer.insert_streams([packet(30, [3])])
+        self.assertEqual(self.state(), (1, 0))
+        self.assertEqual(self.writer.packets_written, 3)
+
+    def test_flushed_every_flush_bytes(self):
+        self.start_writer(flush_packets=1000, flush_bytes=20, flush_interval=60)
+        self.writer.insert_streams([packet(10, [1])])
+        self.assertEqual(self.state(), (0, 1))
+        self.writer.insert_streams([packet(20, [2, 3, 4], [15])])
+        self.assertEqual(self.state(), (1, 0))
+
+    def test_flushed_after_flush_interval(self):
+        self.start_writer(flush_packets=1000, flush_bytes=1 << 20, flush_interval=0.05)
+        self.writer.insert_streams([packet(10, [1])])
+        deadline = time.time() + 5
+        while self.writer.flushes == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.state(), (1, 0))
+
+    def test_event_flushed_at_once(self):
+        self.start_writer(flush_packets=1000, flush_bytes=1 << 20, flush_interval=60)
+        self.writer.insert_streams([packet(10, [1])])
+        self.writer.insert_event({"trial_start": 12, "response": 1}, self.session_group)
+        self.assertEqual(self.state(), (1, 0))
+
+    def test_stop_drains_the_queue(self):
+        persistor = self.start_writer(flush_packets=1000, flush_bytes=1 << 20, flush_interval=60)
+        packets = [packet(time, [time]) for time in range(10, 510, 10)]
+        for start in range(0, len(packets), 5):
+            self.writer.insert_streams(packets[start:start + 5])
+        self.writer.insert_event({"trial_start": 12, "response": 1}, self.session_group)
+        self.writer.stop()
+        self.assertFalse(self.writer.is_alive())
+        self.assertEqual(self.writer.packets_written, 50)
+        self.assertEqual(self.writer._pending_packets, 0)
+        persistor.close_database()
+        reader = SessionReader(self.filename + '.h5')
+        try:
+            self.assertEqual([stream['packet_sent_time'] for stream in reader.packets(1)], range(10, 510, 10))
+            self.assertEqual(reader.trial_row(1)['response'], 1)
+        finally:
+            reader.close()
+
+    def test_drain(self):
+        self.start_writer(flush_packets=1000, flush_bytes=1 << 20, flush_interval=60)
+        self.writer.insert_streams([packet(10, [1]), packet(20, [2])])
+        self.writer.drain()
+        self.assertEqual((self.writer.flushes, self.writer._pending_packets), (1, 0))
+        self.assertEqual(self.writer.packets_written, 2)
+
+    def test_packets_without_a_trial(self):
+        self.writer = db.PersistorWriter(db.Persistor())
+        self.writer.start()
+        self.writer.insert_streams([packet(10, [1])])
+        self.assertEqual(self.writer.call(lambda: self.writer.errors), 1)
+        self.assertEqual(self.writer.packets_written, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import tables
+from numpy.testing import assert_array_equal
+
+import voyeur.db as db
+import voyeur.exceptions as ex
+from voyeur.arduino import SerialPort
+from voyeur.buffers import PacketRingBuffer
+from voyeur.reader import SessionReader
+from voyeur.replay import SessionReplay, MAX_SPEED
+from voyeur.monitor import Monitor
+from tests import session_files
+from tests.test_replay import RecordingProtocol
+from tests.test_session_schedule import schedule
+
+try:
+    from voyeur.emulator import ArduinoEmulator
+except ImportError:
+    # No pty module
+    ArduinoEmulator = None
+
+# Streams sent by the emulator, as in the Passive_odor_presentation protocols
+STREAM_DEFINITION = {
+    "packet_sent_time": (1, 'unsigned long', db.Int),
+    "sniff_samples": (2, 'unsigned int', db.Int),
+    "sniff": (3, 'int', db.FloatArray),
+    "lick1": (4, 'unsigned long', db.IntArray),
+    "lick2": (5, 'unsigned long', db.IntArray),
+    "mri": (6, 'unsigned long', db.IntArray),
+}
+
+EVENT_DEFINITION = {
+    "parameters_received_time": (1, db.Int),
+    "trial_start": (2, db.Int),
+    "trial_end": (3, db.Int),
+    "final_valve_onset": (4, db.Int),
+    "response": (5, db.Int),
+    "first_lick": (6, db.Int),
+}
+
+CONTROLLER_PARAMETERS = {
+    "trialNumber": (1, db.Int, 3),
+    "odorvalve": (2, db.Int, 5),
+    "duration": (3, db.Int, 500),
+}
+
+CONFIG = """
+[serial]
+baudrate = 115200
+[platform]
+board1 = uno
+"""
+
+
+def open_emulator(directory, **settings):
+    """Starts an emulator and returns it with a SerialPort connected to it"""
+    config = os.path.join(directory, 'voyeur_rig_config.conf')
+    with open(config, 'w') as config_file:
+        config_file.write(CONFIG)
+    emulator = ArduinoEmulator(num_parameters=3, seed=1, **settings)
+    return emulator, SerialPort(config, send_trial_number=True, path=emulator.start())
+
+
+def run_trial(serial, number, timeout=5):
+    """Runs trial number in request mode. Returns its stream packets and event"""
+    parameters = dict(CONTROLLER_PARAMETERS, trialNumber=(1, db.Int, number))
+    if not serial.start_trial(parameters):
+        raise AssertionError("Trial not started")
+    packets = []
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            packets.append(serial.request_stream(STREAM_DEFINITION))
+        except ex.EndOfTrialException:
+            break
+        time.sleep(0.005)
+    else:
+        raise AssertionError("No end of trial")
+    event = serial.request_event(EVENT_DEFINITION)
+    serial.end_trial()
+    return packets, event
+
+
+@unittest.skipIf(ArduinoEmulator is None, "No pseudo-terminals on this platform")
+class ArduinoEmulatorTest(unittest.TestCase):
+    """A SerialPort talking to the emulator on its pseudo-terminal"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.emulator, self.serial = open_emulator(self.directory, trial_duration=200, mri_rate=30)
+
+    def tearDown(self):
+        self.serial.stop_streaming()
+        self.serial.close()
+        self.emulator.stop()
+        shutil.rmtree(self.directory)
+
+    def test_protocol_name(self):
+        self.assertEqual(self.serial.request_protocol_name(), 'Passive_exposure_2AFC')
+
+    def test_user_command(self):
+        self.assertTrue(self.serial.user_def_command('valve 5 on'))
+        self.assertEqual(self.emulator.commands, ['valve 5 on'])
+
+    def test_trial(self):
+        packets, event = run_trial(self.serial, 3)
+        self.assertGreater(len(packets), 1)
+        times = [packet['packet_sent_time'] for packet in packets]
+        self.assertEqual(times, sorted(times))
+        for packet in packets:
+            sniff = packet['sniff']
+            self.assertEqual(0 if sniff is None else len(sniff), packet['sniff_samples'])
+        # Each packet holds the trigger times after the previous packet, up to its own time
+        previous = 0
+        for packet in packets:
+            if packet['mri'] is not None:
+                self.assertGreater(packet['mri'][0], previous)
+                self.assertLessEqual(packet['mri'][-1], packet['packet_sent_time'])
+            previous = packet['packet_sent_time']
+        self.assertIn(event['response'], self.emulator.responses)
+        self.assertGreaterEqual(event['trial_end'] - event['parameters_received_time'], 200)
+        self.assertTrue(self.serial.end_trial())
+
+    def test_push_mode(self):
+        ends = []
+        buffer = PacketRingBuffer()
+        self.assertTrue(self.serial.start_trial(CONTROLLER_PARAMETERS))
+        self.assertTrue(self.serial.start_streaming(STREAM_DEFINITION, buffer,
+                                                    on_end_of_trial=lambda: ends.append(time.time())))
+        deadline = time.time() + 5
+        while not ends and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(ends), 1)
+        # Replies are still read while the controller pushes packets
+        self.assertEqual(self.serial.request_protocol_name(), 'Passive_exposure_2AFC')
+        self.assertTrue(self.serial.stop_streaming())
+        self.assertTrue(self.serial.end_trial())
+        packets = buffer.drain()
+        self.assertGreater(len(packets), 1)
+        times = [packet['packet_sent_time'] for packet in packets]
+        self.assertEqual(times, sorted(times))
+
+    def test_truncated_packet_is_lost(self):
+        self.emulator.packet_loss = 1.0
+        self.emulator.loss_mode = 'truncate'
+        self.assertTrue(self.serial.start_trial(CONTROLLER_PARAMETERS))
+        time.sleep(0.05)
+        packet = self.serial.request_stream(STREAM_DEFINITION)
+        self.assertEqual(packet, dict((name, None) for name in STREAM_DEFINITION))
+        self.assertEqual(self.emulator.packets_lost, 1)
+
+
+@unittest.skipIf(ArduinoEmulator is None, "No pseudo-terminals on this platform")
+class MonitorDatabaseLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.emulator, self.serial = open_emulator(self.directory)
+
+    def tearDown(self):
+        self.serial.close()
+        self.emulator.stop()
+        shutil.rmtree(self.directory)
+
+    def monitor(self, **traits):
+        monitor = Monitor(serial1=self.serial, **traits)
+        self.addCleanup(monitor.persistor_writer.stop)
+        return monitor
+
+    def test_layout_given_to_the_constructor(self):
+        monitor = self.monitor(database_layout=db.SESSION_LAYOUT)
+        self.assertIsInstance(monitor.persistor, db.SessionPersistor)
+        self.assertIs(monitor.persistor_writer.persistor, monitor.persistor)
+
+    def test_layout_changed_between_sessions(self):
+        monitor = self.monitor()
+        self.assertNotIsInstance(monitor.persistor, db.SessionPersistor)
+        monitor.database_layout = db.SESSION_LAYOUT
+        self.assertIsInstance(monitor.persistor, db.SessionPersistor)
+        self.assertIs(monitor.persistor_writer.persistor, monitor.persistor)
+        self.assertFalse(monitor.persistor.auto_flush)
+
+    def test_layout_kept_during_a_session(self):
+        monitor = self.monitor()
+        persistor = monitor.persistor
+        monitor.running = True
+        monitor.database_layout = db.SESSION_LAYOUT
+        self.assertEqual(monitor.database_layout, db.TRIAL_LAYOUT)
+        self.assertIs(monitor.persistor, persistor)
+
+
+class ScheduleProtocol(object):
+    """The parts of a protocol used to create the database, with a precomputed schedule"""
+
+    metadata = {}
+
+    def __init__(self):
+        self.schedule = schedule(7)
+
+    def protocol_parameters_definition(self):
+        return session_files.PROTOCOL_PARAMETERS
+
+    def controller_parameters_definition(self):
+        return session_files.CONTROLLER_PARAMETERS
+
+    def event_definition(self):
+        return EVENT_DEFINITION
+
+    def storage_settings(self):
+        return db.StorageSettings()
+
+    def session_tables(self):
+        return {"SessionSchedule": self.schedule.plan,
+                "ScheduleOverrides": self.schedule.overrides_array()}
+
+
+@unittest.skipIf(ArduinoEmulator is None, "No pseudo-terminals on this platform")
+class MonitorSessionTablesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.emulator, self.serial = open_emulator(self.directory)
+        self.monitor = Monitor(serial1=self.serial)
+        self.protocol = ScheduleProtocol()
+        self.monitor.protocol = self.protocol
+
+    def tearDown(self):
+        self.monitor.persistor_writer.stop()
+        self.serial.close()
+        self.emulator.stop()
+        shutil.rmtree(self.directory)
+
+    def stored_tables(self):
+        """Closes the database without ending the session, as a crash would, and reads its tables"""
+        self.monitor.persistor_writer.call(self.monitor.persistor.close_database)
+        with tables.open_file(os.path.join(self.directory, 'session.h5')) as h5file:
+            return dict((name, h5file.root._f_get_child(name).read())
+                        for name in ('SessionSchedule', 'ScheduleOverrides') if name in h5file.root)
+
+    def test_schedule_written_with_the_database(self):
+        self.monitor.database_file = os.path.join(self.directory, 'session')
+        stored = self.stored_tables()
+        self.assertEqual(stored['SessionSchedule'].tolist(), self.protocol.schedule.plan.tolist())
+        self.assertNotIn('ScheduleOverrides', stored)
+
+    def test_extensions_and_overrides_appended(self):
+        self.monitor.database_file = os.path.join(self.directory, 'session')
+        self.protocol.schedule.trial(30)
+        self.protocol.schedule.override(3, iti=100)
+        self.monitor._write_session_tables()
+        self.protocol.schedule.override(4, free_water=True)
+        self.monitor._write_session_tables()
+        stored = self.stored_tables()
+        self.assertEqual(len(stored['SessionSchedule']), 40)
+        self.assertEqual(stored['SessionSchedule'].tolist(), self.protocol.schedule.plan.tolist())
+        self.assertEqual(stored['ScheduleOverrides'].tolist(), [(3, 'iti', 100.0), (4, 'free_water', 1.0)])
+
+
+@unittest.skipIf(ArduinoEmulator is None, "No pseudo-terminals on this platform")
+class RecordedSessionTestMixin(object):
+    """Sessions recorded from the emulator, read back in each layout"""
+
+    layout = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Frequent licks and triggers, so that most packets have some and some have none
+        emulator, serial = open_emulator(self.directory, trial_duration=150, lick_rate=20, mri_rate=30)
+        try:
+            self.trials = [run_trial(serial, number) for number in (1, 2)]
+        finally:
+            serial.close()
+            emulator.stop()
+        persistor = db.SessionPersistor() if self.layout == db.SESSION_LAYOUT else db.Persistor()
+        session_group = persistor.create_database(os.path.join(self.directory, 'session'), {})
+        persistor.create_trials(session_files.PROTOCOL_PARAMETERS, session_files.CONTROLLER_PARAMETERS,
+                                EVENT_DEFINITION, session_group, '')
+        for number, (packets, event) in enumerate(self.trials, 1):
+            trial_group = persistor.add_trial(number, {"odorvalve": 5, "trial_category": "Left"},
+                                              {"trialNumber": (1, db.Int, number)}, STREAM_DEFINITION,
+                                              session_group, '')
+            for packet in packets:
+                persistor.insert_stream(packet, trial_group)
+            persistor.insert_event(event, session_group)
+        persistor.close_database()
+        self.reader = SessionReader(os.path.join(self.directory, 'session.h5'))
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.directory)
+
+    def test_packets(self):
+        for number, (recorded, event) in enumerate(self.trials, 1):
+            packets = self.reader.packets(number)
+            self.assertEqual(len(packets), len(recorded))
+            for packet, expected in zip(packets, recorded):
+                for name in STREAM_DEFINITION:
+                    if expected[name] is None:
+                        self.assertIsNone(packet[name])
+                    else:
+                        assert_array_equal(packet[name], expected[name])
+            self.assertEqual(self.reader.trial_row(number)['response'], event['response'])
+
+    def test_channels(self):
+        for name in ('sniff', 'lick1', 'mri'):
+            samples = [packet[name] for packets, event in self.trials for packet in packets
+                       if packet[name] is not None]
+            assert_array_equal(self.reader.channel(name), [value for values in samples for value in values])
+
+    def test_window(self):
+        packets = self.trials[0][0]
+        start, stop = packets[1]['packet_sent_time'], packets[-1]['packet_sent_time']
+        for name in ('sniff', 'lick1'):
+            expected = [value for packet in packets
+                        if start <= packet['packet_sent_time'] < stop and packet[name] is not None
+                        for value in packet[name]]
+            assert_array_equal(self.reader.window(name, start, stop), expected)
+
+    def test_replay(self):
+        protocol = RecordingProtocol()
+        statistics = SessionReplay(os.path.join(self.directory, 'session.h5'), protocol, speed=MAX_SPEED).run()
+        self.assertEqual(statistics['trials'], 2)
+        recorded = [packet for packets, event in self.trials for packet in packets]
+        replayed = [call[1] for call in protocol.named('process_stream_request')]
+        self.assertEqual([packet['packet_sent_time'] for packet in replayed],
+                         [packet['packet_sent_time'] for packet in recorded])
+        self.assertEqual([call[1]['response'] for call in protocol.named('process_event_request')],
+                         [event['response'] for packets, event in self.trials])
+        self.assertEqual([call[1]['trialNumber'] for call in protocol.named('restore_trial')], [1, 2])
+
+
+class TrialLayoutRecordedSessionTest(RecordedSessionTestMixin, unittest.TestCase):
+    layout = db.TRIAL_LAYOUT
+
+
+class SessionLayoutRecordedSessionTest(RecordedSessionTestMixin, unittest.TestCase):
+    layout = db.SESSION_LAYOUT
+
+
+if __name__ == '__main__':
+    unittest.main()
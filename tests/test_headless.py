@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+import subprocess
+
+from voyeur import qtcompat
+from tests import ROOT
+
+# Packages of the GUI, none of which a headless process may import
+GUI_PACKAGES = ('PyQt4', 'PySide', 'pyface', 'traitsui', 'chaco', 'enable')
+
+# Imports the protocols with the GUI packages missing, then lists the GUI modules loaded
+IMPORT_PROTOCOLS = """
+import sys
+GUI_PACKAGES = %r
+for name in GUI_PACKAGES:
+    sys.modules[name] = None
+import src.passive_odor_presentation
+import src.passive_odor_presentation_gonogo
+print sorted(name for name, module in sys.modules.items()
+             if module is not None and name.split('.')[0] in GUI_PACKAGES)
+""" % (GUI_PACKAGES,)
+
+
+class HeadlessImportTest(unittest.TestCase):
+
+    def test_protocols_import_without_gui_packages(self):
+        environment = dict(os.environ, VOYEUR_HEADLESS='1',
+                           PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, 'src')] + sys.path))
+        process = subprocess.Popen([sys.executable, '-c', IMPORT_PROTOCOLS], cwd=ROOT, env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        self.assertEqual(output.splitlines()[-1], '[]')
+
+
+class HeadlessSettingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environment = dict(os.environ)
+        self.addCleanup(self.restore)
+
+    def restore(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+
+    def test_opt_in_only(self):
+        os.environ.pop('VOYEUR_HEADLESS', None)
+        os.environ.pop('DISPLAY', None)
+        self.assertFalse(qtcompat._headless())
+        os.environ['VOYEUR_HEADLESS'] = '0'
+        self.assertFalse(qtcompat._headless())
+        os.environ['VOYEUR_HEADLESS'] = '1'
+        self.assertTrue(qtcompat._headless())
+
+
+if __name__ == '__main__':
+    unittest.main()
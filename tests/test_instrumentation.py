@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import tables
+from numpy.testing import assert_array_equal
+
+import voyeur.db as db
+from voyeur.instrumentation import LatencyHistogram, Instrumentation
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = LatencyHistogram()
+
+    def test_bucket_bounds(self):
+        # Each value is counted in a bucket whose highest value is at most 1% above it
+        for value in [0, 1, 255, 256, 257, 1000, 12345, 999999, 59999999]:
+            highest = self.histogram._value(self.histogram._index(value))
+            self.assertGreaterEqual(highest, value)
+            self.assertLessEqual(highest - value, value / 100.0)
+
+    def test_small_values_are_exact(self):
+        for value in [3, 3, 7]:
+            self.histogram.record_us(value)
+        assert_array_equal(self.histogram.buckets(), [[3, 2], [7, 1]])
+
+    def test_percentiles(self):
+        for value in range(1, 100001):
+            self.histogram.record_us(value)
+        for percent in (50, 90, 99):
+            expected = percent * 1000
+            self.assertAlmostEqual(self.histogram.percentile(percent), expected, delta=expected / 100.0)
+        self.assertEqual(self.histogram.percentile(100), 100000)
+        self.assertEqual(self.histogram.min, 1)
+
+    def test_record_seconds(self):
+        self.histogram.record(0.002)
+        self.histogram.record(-1)
+        self.assertEqual(self.histogram.count, 2)
+        self.assertEqual(self.histogram.max, 2000)
+        self.assertEqual(self.histogram.min, 0)
+        self.assertEqual(self.histogram.mean(), 1000.0)
+
+    def test_values_above_highest(self):
+        histogram = LatencyHistogram(highest=1000)
+        histogram.record_us(5000)
+        # Counted in the last bucket, while max keeps the value
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.percentile(50), histogram._value(len(histogram.counts) - 1))
+        self.assertEqual(histogram.max, 5000)
+
+    def test_merge_and_reset(self):
+        other = LatencyHistogram()
+        self.histogram.record_us(10)
+        other.record_us(5)
+        other.record_us(2000)
+        self.histogram.merge(other)
+        self.assertEqual(self.histogram.count, 3)
+        self.assertEqual(self.histogram.total, 2015)
+        self.assertEqual((self.histogram.min, self.histogram.max), (5, 2000))
+        self.histogram.reset()
+        self.assertEqual(self.histogram.count, 0)
+        self.assertIsNone(self.histogram.min)
+        self.assertEqual(len(self.histogram.buckets()), 0)
+        self.assertEqual(self.histogram.percentile(50), 0)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instrumentation = Instrumentation()
+
+    def test_snapshot_trial(self):
+        self.instrumentation.record('decode', 0.001)
+        self.instrumentation.record('decode', 0.003)
+        self.instrumentation.record('plot', 0.010)
+        rows = self.instrumentation.snapshot_trial(7)
+        self.assertEqual(list(rows['stage']), ['decode', 'plot'])
+        assert_array_equal(rows['trial_number'], [7, 7])
+        assert_array_equal(rows['count'], [2, 1])
+        self.assertEqual(rows['mean_us'][0], 2000.0)
+        self.assertEqual(rows['max_us'][1], 10000)
+        # The trial histograms start over and the session ones keep the trial
+        self.assertEqual(len(self.instrumentation.snapshot_trial(8)), 0)
+        self.assertEqual(self.instrumentation.session['decode'].count, 2)
+
+    def test_disabled(self):
+        self.instrumentation.enabled = False
+        self.instrumentation.record('decode', 0.001)
+        self.assertEqual(len(self.instrumentation.snapshot_trial(1)), 0)
+
+    def test_session_histograms_include_current_trial(self):
+        self.instrumentation.record('decode', 0.000005)
+        self.instrumentation.snapshot_trial(1)
+        self.instrumentation.record('decode', 0.000005)
+        self.instrumentation.record('receive', 0.000009)
+        histograms = self.instrumentation.session_histograms()
+        self.assertEqual(sorted(histograms), ['decode', 'receive'])
+        assert_array_equal(histograms['decode'], [[5, 2]])
+        assert_array_equal(histograms['receive'], [[9, 1]])
+
+    def test_session_histograms_are_stored(self):
+        self.instrumentation.record('decode', 0.000005)
+        self.instrumentation.record('plot', 0.002)
+        directory = tempfile.mkdtemp()
+        try:
+            persistor = db.Persistor()
+            session_group = persistor.create_database(os.path.join(directory, 'session'), {})
+            persistor.store_group_arrays('LatencyHistograms', '', self.instrumentation.session_histograms(),
+                                         session_group)
+            persistor.close_database()
+            h5file = tables.open_file(os.path.join(directory, 'session.h5'), mode='r')
+            try:
+                assert_array_equal(h5file.root.LatencyHistograms.decode.read(), [[5, 1]])
+                self.assertEqual(h5file.root.LatencyHistograms.plot.read()[0, 1], 1)
+            finally:
+                h5file.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
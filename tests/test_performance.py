@@ -0,0 +1,74 @@
+import random
+import unittest
+
+from numpy import int32
+from numpy.testing import assert_array_equal
+
+from src.performance import GrowableArray, SlidingWindowRate, PerformanceTracker
+
+
+class GrowableArrayTest(unittest.TestCase):
+
+    def test_append_grows(self):
+        values = GrowableArray(dtype=int32, capacity=2)
+        for value in range(5):
+            values.append(value)
+        self.assertEqual(len(values), 5)
+        self.assertEqual(values[-1], 4)
+        assert_array_equal(values.data, [0, 1, 2, 3, 4])
+        self.assertEqual(values.data.dtype, int32)
+
+    def test_clear(self):
+        values = GrowableArray()
+        values.append(1.5)
+        values.clear()
+        self.assertEqual(len(values.data), 0)
+        values.append(2.5)
+        assert_array_equal(values.data, [2.5])
+
+
+class SlidingWindowRateTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(SlidingWindowRate(3).rate, 0.0)
+
+    def test_matches_the_last_window_outcomes(self):
+        window = SlidingWindowRate(7)
+        generator = random.Random(3)
+        outcomes = []
+        for i in range(50):
+            outcomes.append(generator.random() < 0.6)
+            window.add(outcomes[-1])
+            last = outcomes[-7:]
+            self.assertAlmostEqual(window.rate, float(sum(last)) / len(last))
+        window.clear()
+        self.assertEqual((window.count, window.successes), (0, 0))
+
+
+class PerformanceTrackerTest(unittest.TestCase):
+
+    def test_add(self):
+        tracker = PerformanceTracker(['Left', 'Right'], window=2)
+        tracker.add('Left', True, 1)
+        tracker.add('Right', False, 2)
+        tracker.add('Left', False, 3)
+        tracker.add('Left', False, 4)
+        assert_array_equal(tracker.trials.data, [1, 2, 3, 4])
+        # Every category gets a point after each trial
+        assert_array_equal(tracker.line('Left'), [100, 100, 50, 0])
+        assert_array_equal(tracker.line('Right'), [0, 0, 0, 0])
+        self.assertAlmostEqual(tracker.percent_correct('Left'), 100.0 / 3)
+        self.assertEqual(tracker.percent_correct('Right'), 0.0)
+
+    def test_reset(self):
+        tracker = PerformanceTracker(['Go', 'NoGo'])
+        tracker.add('Go', True, 1)
+        tracker.reset()
+        self.assertEqual(len(tracker.trials), 0)
+        self.assertEqual(len(tracker.line('Go')), 0)
+        self.assertEqual(tracker.percent_correct('Go'), 0.0)
+        self.assertEqual(tracker.windows['Go'].rate, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
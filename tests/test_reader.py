@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+import unittest
+
+from numpy.testing import assert_array_equal
+
+from voyeur.db import TRIAL_LAYOUT, SESSION_LAYOUT
+from voyeur.reader import SessionReader
+from tests.session_files import write_session
+
+
+class SessionReaderTestMixin(object):
+    """Tests run on a session file of each layout. Trial 1 has packets without sniff or lick samples and a lost packet"""
+
+    layout = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reader = SessionReader(write_session(self.directory, self.layout))
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.directory)
+
+    def test_layout(self):
+        self.assertEqual(self.reader.layout, self.layout)
+
+    def test_trial_numbers(self):
+        self.assertEqual(list(self.reader.trial_numbers()), [1, 2])
+
+    def test_channel(self):
+        assert_array_equal(self.reader.channel('sniff'), [1, 2, 3, 5, 6, 7, 8])
+        assert_array_equal(self.reader.channel('lick1', 2, 2), [55])
+
+    def test_events_keep_lost_packets(self):
+        assert_array_equal(self.reader.events(1, 1)['packet_sent_time'], [10, 20, 0, 40, 50])
+
+    def test_trial_row(self):
+        row = self.reader.trial_row(2)
+        self.assertEqual(row['odorvalve'], 8)
+        self.assertEqual(row['trial_category'], 'Right')
+        self.assertEqual(row['response'], 3)
+
+    def test_window_skips_packets_without_samples(self):
+        # Packet 40 has no sniff samples and the lost packet between 20 and 40 has none either
+        assert_array_equal(self.reader.window('sniff', 15, 45), [3])
+        assert_array_equal(self.reader.window('sniff', 30, 55), [5, 6])
+
+    def test_window_on_timestamp_channel(self):
+        assert_array_equal(self.reader.window('lick1', 15, 45), [15, 18, 35])
+        assert_array_equal(self.reader.window('lick1', 30, 55), [35])
+        assert_array_equal(self.reader.window('lick1', 45, 65), [55])
+
+    def test_empty_window(self):
+        self.assertEqual(len(self.reader.window('sniff', 100, 200)), 0)
+
+    def test_packets(self):
+        packets = self.reader.packets(1)
+        self.assertEqual([packet['packet_sent_time'] for packet in packets], [10, 20, 0, 40, 50])
+        sniff = [packet['sniff'] for packet in packets]
+        assert_array_equal(sniff[0], [1, 2])
+        assert_array_equal(sniff[1], [3])
+        self.assertIsNone(sniff[2])
+        self.assertIsNone(sniff[3])
+        assert_array_equal(sniff[4], [5, 6])
+        licks = [packet['lick1'] for packet in packets]
+        self.assertIsNone(licks[0])
+        assert_array_equal(licks[1], [15, 18])
+        self.assertIsNone(licks[2])
+        assert_array_equal(licks[3], [35])
+        self.assertIsNone(licks[4])
+
+
+class TrialLayoutReaderTest(SessionReaderTestMixin, unittest.TestCase):
+    layout = TRIAL_LAYOUT
+
+
+class SessionLayoutReaderTest(SessionReaderTestMixin, unittest.TestCase):
+    layout = SESSION_LAYOUT
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import shutil
+import tempfile
+import unittest
+
+from numpy.testing import assert_array_equal
+
+from voyeur.db import TRIAL_LAYOUT, SESSION_LAYOUT
+from voyeur.replay import SessionReplay, MAX_SPEED
+from tests.session_files import write_session, EVENT_DEFINITION
+
+
+class RecordingProtocol(object):
+    """Records the calls SessionReplay makes, in order"""
+
+    def __init__(self):
+        self.calls = []
+
+    def event_definition(self):
+        return EVENT_DEFINITION
+
+    def restore_trial(self, parameters):
+        self.calls.append(('restore_trial', parameters))
+
+    def trial_parameters(self):
+        self.calls.append(('trial_parameters',))
+
+    def start_of_trial(self):
+        self.calls.append(('start_of_trial',))
+
+    def process_stream_request(self, stream):
+        self.calls.append(('process_stream_request', stream))
+
+    def end_of_trial(self):
+        self.calls.append(('end_of_trial',))
+
+    def process_event_request(self, event):
+        self.calls.append(('process_event_request', event))
+
+    def named(self, name):
+        return [call for call in self.calls if call[0] == name]
+
+
+class SessionReplayTestMixin(object):
+
+    layout = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = write_session(self.directory, self.layout)
+        self.protocol = RecordingProtocol()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_call_order(self):
+        SessionReplay(self.filename, self.protocol, speed=MAX_SPEED).run()
+        names = [call[0] for call in self.protocol.calls]
+        trial = ['restore_trial', 'trial_parameters', 'start_of_trial']
+        self.assertEqual(names, trial + ['process_stream_request'] * 5 + ['end_of_trial', 'process_event_request']
+                         + trial + ['process_stream_request'] * 2 + ['end_of_trial', 'process_event_request'])
+
+    def test_recorded_trials_are_restored(self):
+        SessionReplay(self.filename, self.protocol, speed=MAX_SPEED).run()
+        restored = [call[1] for call in self.protocol.named('restore_trial')]
+        self.assertEqual([row['trialNumber'] for row in restored], [1, 2])
+        self.assertEqual([row['odorvalve'] for row in restored], [5, 8])
+        self.assertEqual([row['trial_category'] for row in restored], ['Left', 'Right'])
+
+    def test_recorded_events(self):
+        SessionReplay(self.filename, self.protocol, speed=MAX_SPEED).run()
+        events = [call[1] for call in self.protocol.named('process_event_request')]
+        self.assertEqual(events, [{'trial_start': 12, 'response': 1}, {'trial_start': 61, 'response': 3}])
+
+    def test_recorded_packets(self):
+        SessionReplay(self.filename, self.protocol, speed=MAX_SPEED).run()
+        packets = [call[1] for call in self.protocol.named('process_stream_request')]
+        self.assertEqual([packet['packet_sent_time'] for packet in packets], [10, 20, 0, 40, 50, 60, 70])
+        assert_array_equal(packets[3]['lick1'], [35])
+        self.assertIsNone(packets[3]['sniff'])
+
+    def test_trial_range(self):
+        statistics = SessionReplay(self.filename, self.protocol, speed=MAX_SPEED, first_trial=2).run()
+        self.assertEqual(statistics['trials'], 1)
+        self.assertEqual(statistics['packets'], 2)
+
+    def test_paced_replay(self):
+        # 60 ms of session time at 10 times real time
+        statistics = SessionReplay(self.filename, self.protocol, speed=10).run()
+        self.assertEqual(statistics['packets'], 7)
+        self.assertGreaterEqual(statistics['seconds'], 0.005)
+
+
+class TrialLayoutReplayTest(SessionReplayTestMixin, unittest.TestCase):
+    layout = TRIAL_LAYOUT
+
+
+class SessionLayoutReplayTest(SessionReplayTestMixin, unittest.TestCase):
+    layout = SESSION_LAYOUT
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from src.session_schedule import SessionSchedule
+
+
+class Stimulus(object):
+    """The parts of an odor stimulus the schedule stores"""
+
+    def __init__(self, trial_type, odorvalve):
+        self.trial_type = trial_type
+        self.odorvalves = [odorvalve]
+        self.flows = [(900, 100)]
+
+
+LEFT = Stimulus("Left", 5)
+RIGHT = Stimulus("Right", 8)
+
+
+def next_block(trial_number, rng):
+    """Blocks of four trials, two of each side in random order"""
+    block = [LEFT, LEFT, RIGHT, RIGHT]
+    rng.shuffle(block)
+    return block
+
+
+def free_water(trial_number, rng):
+    return rng.random() < 0.2
+
+
+def schedule(seed, trials=20):
+    return SessionSchedule(next_block, free_water, (2000, 4000), (8000, 9000), seed=seed, trials=trials)
+
+
+class SessionScheduleTest(unittest.TestCase):
+
+    def test_plan(self):
+        plan = schedule(7).plan
+        self.assertEqual(list(plan['trial_number']), range(1, 21))
+        for start in range(0, 20, 4):
+            self.assertEqual(sorted(plan['trial_type'][start:start + 4]), ['Left', 'Left', 'Right', 'Right'])
+        self.assertTrue(((plan['iti'] >= 2000) & (plan['iti'] <= 4000)).all())
+        self.assertTrue(((plan['iti_false_alarm'] >= 8000) & (plan['iti_false_alarm'] <= 9000)).all())
+
+    def test_same_seed_same_plan(self):
+        self.assertEqual(schedule(7).plan.tolist(), schedule(7).plan.tolist())
+        self.assertNotEqual(schedule(7).plan.tolist(), schedule(8).plan.tolist())
+
+    def test_seed_is_chosen_and_kept(self):
+        first = schedule(None)
+        self.assertIsNotNone(first.seed)
+        self.assertEqual(schedule(first.seed).plan.tolist(), first.plan.tolist())
+
+    def test_trial(self):
+        plan = schedule(7)
+        trial = plan.trial(3)
+        self.assertEqual(trial['trial_number'], 3)
+        self.assertIs(trial['stimulus'], LEFT if trial['trial_type'] == 'Left' else RIGHT)
+        self.assertEqual(trial['odorvalve'], trial['stimulus'].odorvalves[0])
+        self.assertEqual((trial['air_flow'], trial['nitrogen_flow']), (900, 100))
+
+    def test_override(self):
+        plan = schedule(7)
+        plan.override(3, free_water=True)
+        plan.override(3, iti=100)
+        trial = plan.trial(3)
+        self.assertTrue(trial['free_water'])
+        self.assertEqual(trial['iti'], 100)
+        # The plan itself is unchanged
+        self.assertNotEqual(plan.plan['iti'][2], 100)
+        rows = plan.overrides_array()
+        self.assertEqual(rows.tolist(), [(3, 'free_water', 1.0), (3, 'iti', 100.0)])
+
+    def test_overrides_only_grow(self):
+        plan = schedule(7)
+        plan.override(5, iti=100)
+        plan.override(5, iti=200)
+        self.assertEqual(plan.trial(5)['iti'], 200)
+        self.assertEqual(plan.overrides_array().tolist(), [(5, 'iti', 100.0), (5, 'iti', 200.0)])
+
+    def test_extended_past_the_plan(self):
+        plan = schedule(7, trials=4)
+        longer = schedule(7, trials=12)
+        self.assertEqual(plan.trial(10)['trial_number'], 10)
+        self.assertEqual(len(plan), 16)
+        # Extending continues the same random sequence
+        self.assertEqual(plan.plan[:12].tolist(), longer.plan.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from random import Random
+from collections import Counter
+
+from src.stimulus_blocks import generate_block, block_quotas, block_is_feasible
+
+STIMULI = {"Left": ["odor1", "odor2"], "Right": ["odor3", "odor4"], "Probe": []}
+CATEGORIES = dict((stimulus, category) for category, items in STIMULI.items() for stimulus in items)
+
+
+def longest_run(block):
+    """Longest number of consecutive trials of one category in block"""
+    longest = run = 0
+    last = None
+    for stimulus in block:
+        category = CATEGORIES[stimulus]
+        run = run + 1 if category == last else 1
+        last = category
+        longest = max(longest, run)
+    return longest
+
+
+class GenerateBlockTest(unittest.TestCase):
+
+    def test_block_quotas(self):
+        self.assertEqual(block_quotas(STIMULI, 10), {"Left": 4, "Right": 4})
+        self.assertEqual(block_quotas(STIMULI, 2), {"Left": 2, "Right": 2})
+        self.assertRaises(ValueError, block_quotas, {"Left": []}, 10)
+
+    def test_block_is_feasible(self):
+        self.assertTrue(block_is_feasible({"Left": 6, "Right": 2}, 2))
+        self.assertFalse(block_is_feasible({"Left": 7, "Right": 2}, 2))
+        # Two Left trials were just presented, so the first Left run is already used up
+        self.assertFalse(block_is_feasible({"Left": 6, "Right": 2}, 2, "Left", 2))
+
+    def test_default_block_presents_the_whole_set(self):
+        block = generate_block(STIMULI, block_size=8, rng=Random(1))
+        self.assertEqual(Counter(block), Counter(["odor1", "odor2", "odor3", "odor4"] * 2))
+
+    def test_quotas_and_runs(self):
+        quotas = {"Left": 9, "Right": 3}
+        for seed in range(100):
+            block = generate_block(STIMULI, quotas=quotas, max_run=3, rng=Random(seed))
+            counts = Counter(block)
+            self.assertEqual(counts["odor1"] + counts["odor2"], 9)
+            self.assertEqual(counts["odor3"] + counts["odor4"], 3)
+            # Stimuli of a category are used equally often
+            self.assertLessEqual(abs(counts["odor1"] - counts["odor2"]), 1)
+            self.assertLessEqual(longest_run(block), 3)
+
+    def test_seeded_blocks_are_reproducible(self):
+        first = generate_block(STIMULI, block_size=20, max_run=2, rng=Random(42))
+        self.assertEqual(generate_block(STIMULI, block_size=20, max_run=2, rng=Random(42)), first)
+        self.assertNotEqual(generate_block(STIMULI, block_size=20, max_run=2, rng=Random(43)), first)
+
+    def test_impossible_block(self):
+        self.assertRaises(ValueError, generate_block, STIMULI, {"Left": 10, "Right": 2}, None, 3, Random(0))
+        self.assertRaises(ValueError, generate_block, STIMULI, {"Left": 0, "Right": 0})
+        self.assertRaises(ValueError, generate_block, STIMULI, {"Probe": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+
+from numpy import arange, isnan, nan
+from numpy.testing import assert_array_equal, assert_allclose
+
+from src.stream_buffers import SignalRingBuffer, EventChannelRasterizer, MinMaxDecimator, decimate_minmax,\
+    IntervalMask
+
+
+class SignalRingBufferTest(unittest.TestCase):
+
+    def test_initial_fill(self):
+        buffer = SignalRingBuffer(4)
+        self.assertEqual(len(buffer), 4)
+        self.assertTrue(isnan(buffer.data).all())
+
+    def test_append_wraps(self):
+        buffer = SignalRingBuffer(4, fill_value=0)
+        buffer.append([1, 2, 3])
+        assert_array_equal(buffer.data, [0, 1, 2, 3])
+        buffer.append([4, 5])
+        assert_array_equal(buffer.data, [2, 3, 4, 5])
+        self.assertEqual(buffer.last, 5)
+
+    def test_append_longer_than_buffer(self):
+        buffer = SignalRingBuffer(4, fill_value=0)
+        buffer.append(arange(10))
+        assert_array_equal(buffer.data, [6, 7, 8, 9])
+
+    def test_data_is_a_view(self):
+        buffer = SignalRingBuffer(4, fill_value=0)
+        buffer.append([1, 2, 3, 4, 5])
+        self.assertFalse(buffer.data.flags.owndata)
+
+    def test_pad(self):
+        buffer = SignalRingBuffer(4, fill_value=0)
+        buffer.append([1, 2])
+        buffer.pad(2)
+        assert_array_equal(buffer.data, [1, 2, 2, 2])
+        buffer.pad(1, 7)
+        assert_array_equal(buffer.data, [2, 2, 2, 7])
+        buffer.pad(0)
+        assert_array_equal(buffer.data, [2, 2, 2, 7])
+
+    def test_overwrite(self):
+        buffer = SignalRingBuffer(4, fill_value=0)
+        buffer.append([1, 2, 3, 4, 5])
+        buffer.overwrite([8, 9])
+        assert_array_equal(buffer.data, [2, 3, 8, 9])
+
+    def test_channels(self):
+        buffer = SignalRingBuffer(3, fill_value=0, channels=2)
+        buffer.append([[1, 2], [10, 20]])
+        buffer.pad(2)
+        assert_array_equal(buffer.data, [[2, 2, 2], [20, 20, 20]])
+        assert_array_equal(buffer.last, [2, 20])
+
+
+class EventChannelRasterizerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Two lick channels drawn at 1 and 2 while on, 0 while off, on a 10 ms window
+        self.rasterizer = EventChannelRasterizer(['lick1', 'lick2'], 10, [1, 2], [0, 0])
+
+    def test_no_changes_yet(self):
+        self.assertFalse(self.rasterizer.update(5, {'lick1': None, 'lick2': []}))
+        self.assertIsNone(self.rasterizer.last_change)
+
+    def test_state_changes(self):
+        self.assertTrue(self.rasterizer.update(5, {'lick1': [2, 4]}))
+        # Samples of times -4 to 5: lick1 is on from 2 to 3, lick2 has not changed yet
+        assert_array_equal(self.rasterizer.channel('lick1'), [nan] * 6 + [1, 1, 0, 0])
+        self.assertTrue(isnan(self.rasterizer.channel('lick2')).all())
+        self.assertEqual(self.rasterizer.last_change, 4)
+
+    def test_scrolling_keeps_the_state(self):
+        self.rasterizer.update(5, {'lick1': [2]})
+        self.assertTrue(self.rasterizer.update(8, {}))
+        assert_array_equal(self.rasterizer.channel('lick1'), [nan] * 3 + [1] * 7)
+        # The last change has scrolled off the window
+        self.assertFalse(self.rasterizer.update(30, {}))
+        assert_array_equal(self.rasterizer.channel('lick1'), [1] * 10)
+
+    def test_change_after_packet_time(self):
+        self.rasterizer.update(5, {'lick2': [40]})
+        self.assertEqual(self.rasterizer.channel('lick2')[-1], 2)
+        assert_array_equal(self.rasterizer.states, [0, 1])
+
+    def test_change_before_previous_packet(self):
+        self.rasterizer.update(5, {'lick1': [2, 4]})
+        self.rasterizer.update(8, {})
+        # Sent in the packet of time 10, for a change at time 7
+        self.rasterizer.update(10, {'lick1': [7]})
+        # Samples of times 1 to 10
+        assert_array_equal(self.rasterizer.channel('lick1'), [nan, 1, 1, 0, 0, 0, 1, 1, 1, 1])
+
+
+class MinMaxDecimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        # Three columns of two samples
+        self.decimator = MinMaxDecimator(3, 2)
+
+    def test_axis(self):
+        assert_allclose(self.decimator.axis(), [0.002, 0.002, 0.004, 0.004, 0.006, 0.006])
+        assert_allclose(MinMaxDecimator(3, 1).axis(), [0.001, 0.002, 0.003])
+
+    def test_packets_across_columns(self):
+        self.decimator.append([1, 5])
+        self.decimator.append([3])
+        self.decimator.append([0, 9, 4])
+        self.assertEqual(self.decimator.columns_started, 3)
+        assert_array_equal(self.decimator.y(), [1, 5, 0, 3, 4, 9])
+        assert_array_equal(self.decimator.y(), decimate_minmax([1, 5, 3, 0, 9, 4], 2))
+
+    def test_column_being_filled(self):
+        self.decimator.append([1, 5, 3])
+        assert_array_equal(self.decimator.y(), [nan, nan, 1, 5, 3, 3])
+        self.assertEqual(self.decimator.columns_started, 2)
+
+    def test_nans_are_ignored(self):
+        self.decimator.append([nan, 2, 7, nan])
+        assert_array_equal(self.decimator.y()[2:], [2, 2, 7, 7])
+
+    def test_long_packet_skips_hidden_columns(self):
+        self.decimator.append(arange(20))
+        self.assertEqual(self.decimator.columns_started, 10)
+        assert_array_equal(self.decimator.y(), [14, 15, 16, 17, 18, 19])
+
+    def test_pad(self):
+        self.decimator.append([1, 5, 3])
+        self.decimator.pad(3)
+        assert_array_equal(self.decimator.y(), [1, 5, 3, 3, 3, 3])
+        # Padding much longer than the window keeps the column boundaries
+        self.decimator.pad(101, 8)
+        self.assertEqual(self.decimator.columns_started, 54)
+        assert_array_equal(self.decimator.y(), [8] * 6)
+
+    def test_one_sample_per_column(self):
+        decimator = MinMaxDecimator(3, 1)
+        decimator.append([4, 5, 6, 7])
+        assert_array_equal(decimator.y(), [5, 6, 7])
+
+    def test_x_of(self):
+        self.decimator.append(arange(6))
+        # Samples of times 1 to 6; the last column starts at time 5
+        assert_allclose(self.decimator.x_of([3, 5], 6), [0.004, 0.006])
+
+
+class IntervalMaskTest(unittest.TestCase):
+
+    def test_add_and_cull(self):
+        mask = IntervalMask()
+        self.assertEqual(len(mask), 0)
+        mask.add(10, 20)
+        mask.add(30, 45)
+        mask.add(50, 60)
+        assert_array_equal(mask.intervals, [[10, 20], [30, 45], [50, 60]])
+        # An interval is kept while its end is in the window
+        mask.cull(45)
+        assert_array_equal(mask.intervals, [[30, 45], [50, 60]])
+        mask.cull(100)
+        self.assertEqual(len(mask), 0)
+        self.assertEqual(mask.intervals.shape, (0, 2))
+
+    def test_mapped_to_the_plot_axis(self):
+        decimator = MinMaxDecimator(3, 2)
+        decimator.append(arange(6))
+        mask = IntervalMask()
+        mask.add(3, 5)
+        assert_allclose(decimator.x_of(mask.intervals, 6), [[0.004, 0.006]])
+
+
+if __name__ == '__main__':
+    unittest.main()
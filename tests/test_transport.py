@@ -0,0 +1,133 @@
+import shutil
+import tempfile
+import unittest
+
+import voyeur.db as db
+from voyeur.exceptions import EndOfTrialException, TimeoutException, CancelledException
+from voyeur.transport import EventLoop, Future, SerialTransport, Return
+from tests.test_emulator import ArduinoEmulator, open_emulator, STREAM_DEFINITION, EVENT_DEFINITION,\
+    CONTROLLER_PARAMETERS
+
+
+def trial(transport, number):
+    """Coroutine running trial number in request mode. Returns its stream packets and event"""
+    parameters = dict(CONTROLLER_PARAMETERS, trialNumber=(1, db.Int, number))
+    started = yield transport.start_trial(parameters)
+    if not started:
+        raise AssertionError("Trial not started")
+    packets = []
+    while True:
+        try:
+            packet = yield transport.request_stream(STREAM_DEFINITION)
+        except EndOfTrialException:
+            break
+        packets.append(packet)
+        yield transport.loop.sleep(0.005)
+    event = yield transport.request_event(EVENT_DEFINITION)
+    ended = yield transport.end_trial()
+    raise Return((packets, event, ended))
+
+
+@unittest.skipIf(ArduinoEmulator is None, "No pseudo-terminals on this platform")
+class SerialTransportTest(unittest.TestCase):
+    """A SerialTransport talking to the emulator on its pseudo-terminal"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.emulator, self.serial = open_emulator(self.directory, trial_duration=200)
+        self.loop = EventLoop()
+        self.transport = SerialTransport.from_serial_port(self.loop, self.serial)
+
+    def tearDown(self):
+        self.transport.close()
+        self.serial.close()
+        self.emulator.stop()
+        shutil.rmtree(self.directory)
+
+    def run_loop(self, future, timeout=5):
+        return self.loop.run_until_complete(self.loop.wait_for(future, timeout))
+
+    def completions(self, futures):
+        """Names of futures, a {name: future} dictionary, in the order they complete"""
+        order = []
+        for name, future in futures.items():
+            future.add_done_callback(lambda done, name=name: order.append(name))
+        return order
+
+    def test_trial(self):
+        packets, event, ended = self.run_loop(self.loop.spawn(trial(self.transport, 3)))
+        self.assertGreater(len(packets), 1)
+        times = [packet['packet_sent_time'] for packet in packets]
+        self.assertEqual(times, sorted(times))
+        self.assertIn(event['response'], self.emulator.responses)
+        self.assertGreaterEqual(event['trial_end'] - event['parameters_received_time'], 200)
+        self.assertTrue(ended)
+        # The next trial runs on the same transport
+        packets, event, ended = self.run_loop(self.loop.spawn(trial(self.transport, 4)))
+        self.assertTrue(ended)
+        self.assertEqual(self.transport.timeouts, 0)
+
+    def test_push_mode(self):
+        packets = []
+        end = Future()
+        self.assertTrue(self.run_loop(self.transport.start_trial(CONTROLLER_PARAMETERS)))
+        started = self.transport.start_streaming(STREAM_DEFINITION, packets.append,
+                                                 on_end_of_trial=lambda: end.set_result(True))
+        self.assertTrue(self.run_loop(started))
+        self.assertTrue(self.run_loop(end))
+        # Commands are still answered while the controller pushes packets
+        self.assertTrue(self.run_loop(self.transport.user_def_command('valve 5 on')))
+        self.assertTrue(self.run_loop(self.transport.stop_streaming()))
+        self.assertTrue(self.run_loop(self.transport.end_trial()))
+        self.assertGreater(len(packets), 1)
+        times = [packet['packet_sent_time'] for packet in packets]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(self.emulator.commands, ['valve 5 on'])
+
+    def test_timeout_and_recovery(self):
+        self.assertTrue(self.run_loop(self.transport.start_trial(CONTROLLER_PARAMETERS)))
+        # Lost packets are not answered at all
+        self.emulator.packet_loss = 1.0
+        lost = self.transport.request_stream(STREAM_DEFINITION, timeout=0.1)
+        self.assertRaises(TimeoutException, self.loop.run_until_complete, lost)
+        self.assertEqual(self.transport.timeouts, 1)
+        self.emulator.packet_loss = 0.0
+        packet = self.run_loop(self.transport.request_stream(STREAM_DEFINITION))
+        self.assertIsNotNone(packet['packet_sent_time'])
+        self.assertTrue(self.run_loop(self.transport.end_trial()))
+
+    def test_cancel_queued_request(self):
+        started = self.transport.start_trial(CONTROLLER_PARAMETERS)
+        event = self.transport.request_event(EVENT_DEFINITION)
+        self.assertTrue(event.cancel())
+        self.assertTrue(event.cancelled())
+        self.assertTrue(self.run_loop(started))
+        # The event request was never sent, so the next reply is the one to this command
+        self.assertTrue(self.run_loop(self.transport.user_def_command('valve 5 on')))
+        self.assertRaises(CancelledException, event.result)
+
+    def test_cancel_request_in_flight(self):
+        first = self.transport.user_def_command('valve 5 on')
+        self.assertTrue(first.cancel())
+        # The reply to the cancelled command is dropped, not taken for the next one
+        second = self.transport.user_def_command('valve 6 on')
+        self.assertTrue(self.run_loop(second))
+        self.assertRaises(CancelledException, first.result)
+        self.assertEqual(self.emulator.commands, ['valve 5 on', 'valve 6 on'])
+        self.assertEqual(self.transport.timeouts, 0)
+
+    def test_commands_overtake_queued_stream_requests(self):
+        futures = {'start': self.transport.start_trial(CONTROLLER_PARAMETERS),
+                   'stream1': self.transport.request_stream(STREAM_DEFINITION),
+                   'stream2': self.transport.request_stream(STREAM_DEFINITION),
+                   'command': self.transport.user_def_command('valve 5 on')}
+        order = self.completions(futures)
+        self.run_loop(futures['stream2'])
+        self.assertEqual(order, ['start', 'command', 'stream1', 'stream2'])
+        for name in ('stream1', 'stream2'):
+            self.assertIsNotNone(futures[name].result()['packet_sent_time'])
+        self.assertTrue(futures['command'].result())
+
+
+if __name__ == '__main__':
+    unittest.main()